@@ -0,0 +1,211 @@
+import base64
+import io
+import logging
+import statistics
+import threading
+
+from PIL import Image
+
+
+def otsu_threshold(histogram) -> int:
+    """灰度直方图的 Otsu 阈值（类间方差最大），适应扫描件的灰底和低对比度"""
+    total = sum(histogram)
+    sum_all = sum(i * count for i, count in enumerate(histogram))
+    best, threshold = -1.0, 128
+    weight_bg = sum_bg = 0
+    for i, count in enumerate(histogram):
+        weight_bg += count
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += i * count
+        mean_bg, mean_fg = sum_bg / weight_bg, (sum_all - sum_bg) / weight_fg
+        between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if between > best:
+            best, threshold = between, i
+    return threshold
+
+
+class AdaptivePageScaler:
+    """
+    按页面内容密度自适应缩放 VLM 请求中的页面图片。
+    docling 按 max_scale 渲染页面，代理收到后用廉价的栅格启发式估计文本行高：
+    行高很大或内容稀疏（标题页）就缩小到接近 min_scale，小字号密集页（表格、多栏报纸）保持原分辨率，
+    扫描件（底色不是白色）一律按 max_scale 发送。
+    """
+
+    def __init__(self, min_scale: float = 0.5, max_scale: float = 1.5, target_line_px: float = 8.0,
+                 sparse_ink_ratio: float = 0.02, strips: int = 12, scan_background: int = 200):
+        """
+        min_scale/max_scale: 缩放上下限（与 ApiVlmOptions.scale 同单位，页面按 max_scale 渲染）
+        target_line_px: 期望发送给模型的文本行（字形）高度，像素；正文在 max_scale=1.5 下约 12px，缩放后约 scale=1.0
+        sparse_ink_ratio: 墨迹占比低于该值视为稀疏页面
+        strips: 按列切成的竖条数，逐条做行投影，避免多栏页面的各栏文本行合并成很高的"行"
+        scan_background: 页面背景（灰度中位数）低于该值视为扫描件
+        """
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.target_line_px = target_line_px
+        self.sparse_ink_ratio = sparse_ink_ratio
+        self.strips = strips
+        self.scan_background = scan_background
+        self.pages = []
+        self._lock = threading.Lock()
+
+    def estimate_line_height(self, image: Image.Image):
+        """
+        返回 (文本行高像素中位数, 墨迹占比, 是否扫描件)。
+        Otsu 阈值二值化后把页面切成竖条，逐条做行投影统计连续有墨迹的行数，全部在 PIL 的 C 实现中完成。
+        """
+        gray = image.convert("L")
+        histogram = gray.histogram()
+        total = sum(histogram)
+        if not total:
+            return None, 0.0, False
+        running, background = 0, 255
+        for value, count in enumerate(histogram):
+            running += count
+            if running * 2 >= total:
+                background = value
+                break
+        scanned = background < self.scan_background
+        if max(i for i, c in enumerate(histogram) if c) - min(i for i, c in enumerate(histogram) if c) < 32:
+            return None, 0.0, scanned  # 几乎单色，空白页
+        threshold = otsu_threshold(histogram)
+        ink = gray.point(lambda v: 255 if v <= threshold else 0)
+        width, height = ink.size
+        ink_ratio = ink.histogram()[255] / (width * height)
+        strip_width = max(1, width // self.strips)
+        runs = []
+        for left in range(0, width - strip_width + 1, strip_width):
+            rows = list(ink.crop((left, 0, left + strip_width, height)).resize((1, height), Image.BOX).getdata())
+            threshold_row = max(max(rows, default=0) * 0.05, 255 * 0.01)  # 相对该条最密的行判断，短行不漏
+            run = 0
+            for value in rows:
+                if value > threshold_row:  # 该行有墨迹
+                    run += 1
+                elif run:
+                    runs.append(run)
+                    run = 0
+            if run:
+                runs.append(run)
+        runs = [r for r in runs if r >= 3]  # 忽略细线和噪点
+        return (statistics.median(runs) if runs else None), ink_ratio, scanned
+
+    def choose_scale(self, image: Image.Image) -> float:
+        line_height, ink_ratio, scanned = self.estimate_line_height(image)
+        if scanned or ink_ratio > 0.5:  # 扫描件（灰底、噪点）需要高分辨率才能识别
+            return self.max_scale
+        if line_height is None or ink_ratio < self.sparse_ink_ratio:
+            return self.min_scale
+        scale = self.max_scale * self.target_line_px / line_height
+        return max(self.min_scale, min(self.max_scale, scale))
+
+    def rescale(self, request_data: dict):
+        """缩放请求中的页面图片，返回 (新请求, 页面统计)"""
+        page_stat = {"original_bytes": 0, "sent_bytes": 0, "scale": self.max_scale}
+        for message in request_data.get("messages", []):
+            content = message.get("content")
+            if not isinstance(content, list):
+                continue
+            for part in content:
+                if part.get("type") != "image_url":
+                    continue
+                url = part["image_url"].get("url", "")
+                header, sep, data = url.partition(";base64,")
+                if not sep:
+                    continue
+                raw = base64.b64decode(data)
+                page_stat["original_bytes"] += len(raw)
+                image = Image.open(io.BytesIO(raw))
+                scale = self.choose_scale(image)
+                page_stat["scale"] = round(scale, 3)
+                if scale < self.max_scale:
+                    ratio = scale / self.max_scale
+                    image = image.resize((max(1, int(image.width * ratio)), max(1, int(image.height * ratio))),
+                                         Image.LANCZOS)
+                    buffer = io.BytesIO()
+                    image.save(buffer, "PNG", optimize=False)
+                    raw = buffer.getvalue()
+                    part["image_url"]["url"] = "data:image/png;base64," + base64.b64encode(raw).decode()
+                page_stat["sent_bytes"] += len(raw)
+        return request_data, page_stat
+
+    def record(self, page_stat: dict, usage: dict = None):
+        usage = usage or {}
+        page_stat["prompt_tokens"] = usage.get("prompt_tokens", 0)
+        page_stat["completion_tokens"] = usage.get("completion_tokens", 0)
+        with self._lock:
+            self.pages.append(page_stat)
+        logging.info(f"页面缩放 {page_stat['scale']}，发送 {page_stat['sent_bytes']}/{page_stat['original_bytes']} 字节，"
+                     f"tokens {page_stat['prompt_tokens']}+{page_stat['completion_tokens']}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            pages = list(self.pages)
+        if not pages:
+            return {"pages": 0}
+        original = sum(p["original_bytes"] for p in pages)
+        sent = sum(p["sent_bytes"] for p in pages)
+        return {
+            "pages": len(pages),
+            "original_bytes": original,
+            "sent_bytes": sent,
+            "bytes_saved_ratio": round(1 - sent / original, 3) if original else 0.0,
+            "avg_scale": round(sum(p["scale"] for p in pages) / len(pages), 3),
+            "prompt_tokens": sum(p["prompt_tokens"] for p in pages),
+            "completion_tokens": sum(p["completion_tokens"] for p in pages),
+        }
+
+
+# ---------- 自检：合成标题页 / 正文页 / 多栏小字页 / 扫描页，确认缩放的相对顺序 ----------
+
+def _render_sample(kind: str, scale: float = 1.5) -> Image.Image:
+    import random
+    import fitz
+    from PIL import ImageFilter
+    words = "the quick brown fox jumps over the lazy dog while invoices tables and reports".split()
+    rng = random.Random(0)
+    with fitz.open() as doc:
+        page = doc.new_page(width=612, height=792)
+        if kind == "title":
+            page.insert_text((72, 300), "Annual Report", fontsize=40)
+            page.insert_text((72, 360), "2024", fontsize=28)
+        elif kind in ("text", "scan"):
+            for y in range(72, 720, 14):
+                page.insert_text((72, y), " ".join(rng.choice(words) for _ in range(12)), fontsize=10)
+        elif kind == "dense":
+            for column in range(4):
+                for y in range(40, 760, 7):
+                    page.insert_text((30 + column * 140, y), " ".join(rng.choice(words) for _ in range(5)), fontsize=5.5)
+        image = Image.open(io.BytesIO(page.get_pixmap(matrix=fitz.Matrix(scale, scale)).tobytes("png"))).convert("L")
+    if kind == "scan":  # 灰黄底色、噪点和轻微模糊
+        noise = Image.effect_noise(image.size, 40)
+        image = Image.blend(image.point(lambda v: 60 + v * 0.55), noise, 0.25).filter(ImageFilter.GaussianBlur(0.6))
+    return image
+
+
+def self_check(scaler: AdaptivePageScaler = None) -> dict:
+    """合成页面上检查：多栏小字页和扫描页不低于正文页，标题页不高于正文页；不满足时抛 AssertionError"""
+    scaler = scaler or AdaptivePageScaler()
+    scales = {kind: round(scaler.choose_scale(_render_sample(kind, scaler.max_scale)), 3)
+              for kind in ("title", "text", "dense", "scan")}
+    assert scales["dense"] >= scales["text"], f"多栏小字页缩放低于正文页: {scales}"
+    assert scales["scan"] >= scales["text"], f"扫描页缩放低于正文页: {scales}"
+    assert scales["title"] <= scales["text"], f"标题页缩放高于正文页: {scales}"
+    return scales
+
+
+if __name__ == "__main__":
+    import sys
+    import fitz
+    print(f"自检通过: {self_check()}")
+    scaler = AdaptivePageScaler()
+    for pdf_path in sys.argv[1:]:  # python adaptive_scale.py a.pdf b.pdf：输出各页选择的缩放
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                pixmap = page.get_pixmap(matrix=fitz.Matrix(scaler.max_scale, scaler.max_scale))
+                image = Image.open(io.BytesIO(pixmap.tobytes("png")))
+                print(f"{pdf_path} 第 {page.number + 1} 页: scale={scaler.choose_scale(image):.2f}")
@@ -0,0 +1,267 @@
+"""
+跨引擎吞吐与内存基准：生成可复现的合成 PDF 语料，分别在独立子进程中运行 docling / marker / MinerU 入口，
+记录 pages/sec、首个输出耗时、峰值 RSS 和 CPU 利用率，结果写入 JSON 报告，可与上次报告对比发现性能回退。
+
+用法：
+    python benchmark_engines.py --engines docling_default marker_default minerU_default --pages 1 10
+    python benchmark_engines.py --compare bench/report_old.json bench/report_new.json
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = "./bench"
+CORPUS_KINDS = ["text", "scanned", "table", "formula", "figure"]
+ENGINES = ["docling_default", "docling_gemini", "docling_internvl3", "marker_default", "marker_gemini", "minerU_default"]
+VLM_ENGINES = {"docling_gemini", "docling_internvl3", "marker_gemini"}
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore "
+         "et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut "
+         "aliquip ex ea commodo consequat.")
+FORMULAS = ["E = mc²", "∫₀^∞ e^(−x²) dx = √π / 2", "∑ᵢ aᵢ xᵢ ≤ ‖a‖·‖x‖", "∂u/∂t = α ∇²u",
+            "f(x) = a₀ + ∑ₙ (aₙ cos nx + bₙ sin nx)"]
+
+
+def _text_page(page, rng, lines=45):
+    y = 60
+    for _ in range(lines):
+        words = LOREM.split()
+        rng.shuffle(words)
+        page.insert_text((50, y), " ".join(words[:12]), fontsize=10)
+        y += 16
+
+
+def _table_page(page, rng, rows=25, cols=6):
+    import fitz
+    x0, y0, cw, rh = 40, 60, 85, 24
+    for r in range(rows + 1):
+        page.draw_line(fitz.Point(x0, y0 + r * rh), fitz.Point(x0 + cols * cw, y0 + r * rh))
+    for c in range(cols + 1):
+        page.draw_line(fitz.Point(x0 + c * cw, y0), fitz.Point(x0 + c * cw, y0 + rows * rh))
+    for r in range(rows):
+        for c in range(cols):
+            text = f"H{c}" if r == 0 else f"{rng.uniform(0, 1000):.2f}"
+            page.insert_text((x0 + c * cw + 5, y0 + r * rh + 16), text, fontsize=9)
+
+
+def _formula_page(page, rng):
+    y = 60
+    for i in range(20):
+        page.insert_text((50, y), LOREM[:90], fontsize=10)
+        page.insert_text((120, y + 22), rng.choice(FORMULAS) + f"   ({i + 1})", fontsize=12, fontname="helv")
+        y += 38
+
+
+def _figure_page(page, rng):
+    import fitz
+    page.insert_text((50, 50), "Figure overview", fontsize=14)
+    for i in range(4):
+        rect = fitz.Rect(50 + (i % 2) * 260, 80 + (i // 2) * 330, 290 + (i % 2) * 260, 380 + (i // 2) * 330)
+        for _ in range(30):
+            a = fitz.Point(rng.uniform(rect.x0, rect.x1), rng.uniform(rect.y0, rect.y1))
+            b = fitz.Point(rng.uniform(rect.x0, rect.x1), rng.uniform(rect.y0, rect.y1))
+            page.draw_line(a, b, color=(rng.random(), rng.random(), rng.random()), width=2)
+        page.insert_text((rect.x0, rect.y1 + 14), f"Figure {i + 1}: synthetic chart", fontsize=9)
+
+
+def build_corpus(corpus_dir, page_counts, seed=0):
+    """生成合成语料，同一 seed 下内容完全一致；返回 {文件路径: 页数}"""
+    import fitz
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = {}
+    for kind in CORPUS_KINDS:
+        for pages in page_counts:
+            path = os.path.join(corpus_dir, f"{kind}_{pages}p.pdf")
+            corpus[path] = pages
+            if os.path.exists(path):
+                continue
+            rng = random.Random(f"{seed}-{kind}-{pages}")
+            doc = fitz.open()
+            for _ in range(pages):
+                page = doc.new_page()
+                if kind == "table":
+                    _table_page(page, rng)
+                elif kind == "formula":
+                    _formula_page(page, rng)
+                elif kind == "figure":
+                    _figure_page(page, rng)
+                else:
+                    _text_page(page, rng)
+            if kind == "scanned":
+                # 把每页栅格化后作为图片重新放回，模拟没有文本层的扫描件
+                scanned = fitz.open()
+                for page in doc:
+                    pix = page.get_pixmap(dpi=150, colorspace=fitz.csGRAY)
+                    new_page = scanned.new_page(width=page.rect.width, height=page.rect.height)
+                    new_page.insert_image(new_page.rect, pixmap=pix)
+                doc.close()
+                doc = scanned
+            doc.save(path, deflate=True)
+            doc.close()
+    return corpus
+
+
+def run_engine(engine, input_dir, output_dir):
+    """在子进程中执行：启动需要的假 VLM 后端，然后调用引擎的批处理入口"""
+    fake = None
+    if engine in VLM_ENGINES:
+        from fake_openai_server import FakeOpenAIServer
+        fake = FakeOpenAIServer(latency=float(os.getenv("BENCH_FAKE_LATENCY", "0.2"))).start()
+        os.environ["LM_STUDIO_URLS"] = fake.url
+        os.environ.setdefault("GEMINI_API_KEY", "fake")
+    if engine == "docling_default":
+        import docling_default
+        pdfs = sorted(glob.glob(os.path.join(input_dir, "*.pdf")))
+        docling_default.process_pdf_folder(docling_default.converter, pdfs, output_dir)
+    elif engine == "docling_gemini":
+        import docling_gemini
+        from local_vlm_client import LocalVLMClient
+        docling_gemini.api_server.completion_fn = LocalVLMClient(fake.url).completion
+        docling_gemini.process_pdf_folder(input_dir, output_dir)
+    elif engine == "docling_internvl3":
+        import docling_internvl3
+        docling_internvl3.process_pdf_folder(input_dir, output_dir)
+    elif engine == "marker_default":
+        import marker_default
+        marker_default.main(input_dir, output_dir, workers=1)
+    elif engine == "marker_gemini":
+        import marker_gemini
+        marker_gemini.main(input_dir, output_dir, workers=1, llm_config={
+            "llm_service": "marker.services.openai.OpenAIService",
+            "openai_base_url": f"{fake.url}/v1",
+            "openai_api_key": "fake",
+            "openai_model": "fake-vlm",
+        })
+    elif engine == "minerU_default":
+        import minerU_default
+        minerU_default.process_pdf_folder(input_dir, output_dir)
+    else:
+        raise ValueError(f"未知引擎: {engine}")
+    if fake is not None:
+        fake.stop()
+
+
+def measure(engine, pdf_path, pages, work_dir):
+    """在独立子进程中转换单个文件，返回指标字典"""
+    input_dir = os.path.join(work_dir, "input")
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(input_dir, exist_ok=True)
+    os.symlink(os.path.abspath(pdf_path), os.path.join(input_dir, os.path.basename(pdf_path)))
+    env = dict(os.environ, VLM_CACHE_BYPASS="1", PAGE_DEDUP_BYPASS="1",
+               RUN_MANIFEST_PATH=os.path.join(work_dir, "manifest.sqlite"))
+    log_path = os.path.join(work_dir, "engine.log")
+    with open(log_path, "w") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-engine", engine,
+                                 "--input", input_dir, "--output", output_dir],
+                                stdout=log, stderr=subprocess.STDOUT, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        first_output = None
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            if first_output is None and glob.glob(os.path.join(output_dir, "**", "*.md"), recursive=True):
+                first_output = time.perf_counter() - start
+            time.sleep(0.05)
+        wall = time.perf_counter() - start
+    exit_code = os.waitstatus_to_exitcode(status)
+    cpu = rusage.ru_utime + rusage.ru_stime
+    max_rss_mb = rusage.ru_maxrss / 1024 if sys.platform != "darwin" else rusage.ru_maxrss / 1024 ** 2
+    ok = exit_code == 0 and bool(glob.glob(os.path.join(output_dir, "**", "*.md"), recursive=True))
+    if ok and first_output is None:
+        first_output = wall  # 输出在最后一次轮询之后才出现
+    return {
+        "engine": engine,
+        "document": os.path.basename(pdf_path),
+        "pages": pages,
+        "ok": ok,
+        "wall_seconds": round(wall, 3),
+        "pages_per_sec": round(pages / wall, 3) if ok and wall else 0.0,
+        "time_to_first_output": round(first_output, 3) if ok else None,
+        "peak_rss_mb": round(max_rss_mb, 1),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_utilization": round(cpu / wall, 2) if wall else 0.0,
+        "log": log_path if exit_code else None,
+    }
+
+
+def run_benchmark(engines, page_counts, seed, report_path):
+    corpus = build_corpus(os.path.join(BENCH_DIR, "corpus"), page_counts, seed)
+    results = []
+    for engine in engines:
+        for pdf_path, pages in corpus.items():
+            work_dir = tempfile.mkdtemp(prefix=f"{engine}_", dir=os.path.abspath(BENCH_DIR))
+            result = measure(engine, pdf_path, pages, work_dir)
+            results.append(result)
+            print(f"{engine:>18} {result['document']:>18} ok={result['ok']!s:>5} "
+                  f"{result['pages_per_sec']:>8.2f} pages/s  首个输出 {result['time_to_first_output'] or 0:>7.2f}s  "
+                  f"RSS {result['peak_rss_mb']:>8.1f}MB  CPU {result['cpu_utilization']:>5.2f}")
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "seed": seed,
+        "page_counts": page_counts,
+        "results": results,
+    }
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"报告已保存到: {report_path}")
+    return report
+
+
+def compare_reports(old_path, new_path, tolerance=0.1):
+    """对比两份报告，pages/sec 下降或峰值内存上升超过 tolerance 视为回退，返回回退条目数"""
+    with open(old_path, encoding="utf-8") as f:
+        old = {(r["engine"], r["document"]): r for r in json.load(f)["results"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = {(r["engine"], r["document"]): r for r in json.load(f)["results"]}
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        o, n = old[key], new[key]
+        notes = []
+        if o["pages_per_sec"] and n["pages_per_sec"] < o["pages_per_sec"] * (1 - tolerance):
+            notes.append(f"pages/sec {o['pages_per_sec']} -> {n['pages_per_sec']}")
+        if o["peak_rss_mb"] and n["peak_rss_mb"] > o["peak_rss_mb"] * (1 + tolerance):
+            notes.append(f"peak RSS {o['peak_rss_mb']}MB -> {n['peak_rss_mb']}MB")
+        if o["ok"] and not n["ok"]:
+            notes.append("转换失败")
+        if notes:
+            regressions += 1
+            print(f"回退 {key[0]} / {key[1]}: {'; '.join(notes)}")
+    print(f"共对比 {len(old.keys() & new.keys())} 项，发现 {regressions} 项回退")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="docling / marker / MinerU 跨引擎基准")
+    parser.add_argument("--engines", nargs="+", default=["docling_default", "marker_default", "minerU_default"],
+                        choices=ENGINES)
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10], help="合成文档的页数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", default=None, help="报告路径，默认 bench/report_<时间>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="对比两份报告")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--run-engine", help=argparse.SUPPRESS)
+    parser.add_argument("--input", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_engine:
+        run_engine(args.run_engine, args.input, args.output)
+        return
+    if args.compare:
+        sys.exit(1 if compare_reports(*args.compare, tolerance=args.tolerance) else 0)
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    report_path = args.report or os.path.join(BENCH_DIR, f"report_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    run_benchmark(args.engines, args.pages, args.seed, report_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+本地代理吞吐基准：用假的上游（固定延迟）替代 Gemini，测量不同并发下的 pages/sec。
+用法：python benchmark_proxy.py --pages 64 --latency 0.5 --concurrency 1 2 4 8 16
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from vlm_proxy import VLMProxyServer
+
+
+def make_fake_completion(latency: float):
+    """假上游：休眠 latency 秒后返回一页固定的 markdown"""
+    def completion(request_data: dict) -> dict:
+        time.sleep(latency)
+        return {
+            "id": "fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request_data.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "# page"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1000, "completion_tokens": 200, "total_tokens": 1200},
+        }
+    return completion
+
+
+def run_client(port: int, pages: int, workers: int) -> float:
+    """模拟 VlmPipeline：workers 个线程各自复用一条 keep-alive 连接发送页面请求，返回耗时"""
+    body = json.dumps({
+        "model": "fake",
+        "messages": [{"role": "user", "content": [{"type": "text", "text": "OCR"}]}],
+    }).encode()
+    local = threading.local()
+
+    def send_page(_):
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        conn.request("POST", "/v1/chat/completions", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"代理返回状态码 {response.status}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(send_page, range(pages)))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 VLM 代理并发吞吐基准")
+    parser.add_argument("--pages", type=int, default=64, help="每轮发送的页面数")
+    parser.add_argument("--latency", type=float, default=0.5, help="假上游每页的往返延迟（秒）")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="要测试的并发数")
+    args = parser.parse_args()
+
+    print(f"{'concurrency':>12} {'seconds':>10} {'pages/sec':>10}")
+    for concurrency in args.concurrency:
+        server = VLMProxyServer(host="127.0.0.1", port=0, max_inflight=concurrency,
+                                completion_fn=make_fake_completion(args.latency))
+        server.start()
+        try:
+            elapsed = run_client(server.port, args.pages, concurrency)
+        finally:
+            server.stop()
+        print(f"{concurrency:>12} {elapsed:>10.2f} {args.pages / elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
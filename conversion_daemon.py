@@ -0,0 +1,461 @@
+"""
+常驻转换服务：模型只在服务启动（或首次使用某引擎）时加载一次，之后通过本地 HTTP 接收任务，
+小批量、临时的转换不再每次支付几十秒的模型加载时间。
+
+启动服务：python conversion_daemon.py serve --preload minerU_default marker_default
+监视目录：python conversion_daemon.py watch ./input --engine minerU_default（新文件写完后自动提交，见 watch_folder）
+提交任务：python conversion_daemon.py submit input/a.pdf --engine minerU_default --wait
+查询状态：python conversion_daemon.py status <job_id>
+获取结果：python conversion_daemon.py result <job_id> > a.md
+
+HTTP 接口（仅监听 127.0.0.1）：
+    POST /jobs                 {"path", "engine", "output_dir"?, "profile"?, "priority"?}，队列满时返回 503
+    GET  /jobs                 所有任务概要
+    GET  /jobs/<id>?wait=30    任务状态，wait 秒内任务完成会立即返回（长轮询）
+    GET  /jobs/<id>/result     流式返回主输出文件（markdown）
+    GET  /health               已加载的引擎和队列深度
+"""
+import argparse
+import http.server
+import itertools
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import OrderedDict
+
+import tracing
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 4100
+DEFAULT_URL = os.getenv("CONVERSION_DAEMON_URL", f"http://{DEFAULT_HOST}:{DEFAULT_PORT}")
+MAX_FINISHED_JOBS = 1000  # 内存中保留的已完成任务数
+
+
+# ---------- 各引擎的加载与转换，均为延迟导入，只加载用到的引擎 ----------
+
+def _load_docling_default():
+    import docling_default
+    return docling_default.converter
+
+
+def _convert_docling_default(converter, path, output_dir, profile):
+    import docling_default
+    return [docling_default.process_single_pdf(converter, path, output_dir)]
+
+
+def _load_marker_default():
+    import marker_default
+    return marker_default.build_converter()
+
+
+def _load_marker_gemini():
+    import marker_gemini
+    return marker_gemini.build_converter()
+
+
+def _convert_marker(converter, path, output_dir, profile):
+    from marker_gemini import save_results
+    from page_selection import marker_convert, output_name, select_pages
+    pages = select_pages(path)
+    fname_base = output_name(os.path.splitext(os.path.basename(path))[0], pages)
+    with tracing.span("marker.convert"):
+        rendered_output = marker_convert(converter, path, pages)
+    with tracing.span("save_results"):
+        return [save_results(rendered_output, output_dir=output_dir, fname_base=fname_base)]
+
+
+def _load_minerU_default():
+    import minerU_default
+    return minerU_default
+
+
+def _convert_minerU_default(module, path, output_dir, profile):
+    fname_base = os.path.splitext(os.path.basename(path))[0]
+    profile = profile or module.OUTPUT_PROFILE
+    if module.CHUNK_PAGES > 0 and not module.PAGE_SELECTION:
+        module.process_single_pdf_chunked(fname_base, path, output_dir, module.CHUNK_PAGES, profile)
+        return [os.path.join(output_dir, fname_base, fname_base + ".md")]
+    return [module.process_single_pdf(fname_base, path, output_dir, profile)]
+
+
+def _load_docling_gemini():
+    import docling_gemini
+    docling_gemini.api_server.start()
+    return docling_gemini.create_session().warm_up()
+
+
+def _load_docling_internvl3():
+    import docling_internvl3
+    docling_internvl3.api_server.start()
+    docling_internvl3.local_client.start_health_checks()
+    return docling_internvl3.create_session().warm_up()
+
+
+def _convert_docling_vlm(module_name):
+    def convert(session, path, output_dir, profile):
+        from pathlib import Path
+        module = __import__(module_name)
+        os.makedirs(output_dir, exist_ok=True)
+        ok, output_file = module.process_single_pdf(Path(path), Path(output_dir),
+                                                    session.vlm_options.params.get("model"), session)
+        if not ok:
+            raise RuntimeError(f"{module_name} 转换失败")
+        return [str(output_file)]
+    return convert
+
+
+# 引擎名 -> (加载函数, 转换函数, 默认输出目录)
+ENGINES = {
+    "docling_default": (_load_docling_default, _convert_docling_default, "./output/default"),
+    "docling_gemini": (_load_docling_gemini, _convert_docling_vlm("docling_gemini"), "./output/Gemini"),
+    "docling_internvl3": (_load_docling_internvl3, _convert_docling_vlm("docling_internvl3"), "./output"),
+    "marker_default": (_load_marker_default, _convert_marker, "./output/default"),
+    "marker_gemini": (_load_marker_gemini, _convert_marker, "./output/Gemini"),
+    "minerU_default": (_load_minerU_default, _convert_minerU_default, "./output/minerU"),
+}
+
+
+class ConversionDaemon:
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, max_queue: int = 16, workers: int = 1):
+        """
+        max_queue: 排队任务上限，超过时提交返回 503（监视目录时暂缓提交）；队列按 (优先级, 文件大小) 排序，小文件先转
+        workers: 工作线程数；同一引擎的任务始终串行执行，多个线程只让不同引擎的任务并行
+        """
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.jobs = OrderedDict()
+        self.queue = queue.PriorityQueue(maxsize=max_queue)
+        self._seq = itertools.count()  # 相同优先级按提交顺序
+        self.engines = {}  # 引擎名 -> 已加载的模型/会话
+        self.load_seconds = {}
+        self._engine_locks = {name: threading.Lock() for name in ENGINES}
+        self._lock = threading.Lock()
+        self._threads = []
+        self.httpd = None
+
+    # ---------- 引擎与任务 ----------
+
+    def load_engine(self, name):
+        """加载引擎（只加载一次），之后所有任务复用"""
+        with self._engine_locks[name]:
+            if name not in self.engines:
+                start = time.perf_counter()
+                logging.info(f"正在加载引擎 {name}")
+                with tracing.span("daemon.load_engine", engine=name):
+                    self.engines[name] = ENGINES[name][0]()
+                self.load_seconds[name] = round(time.perf_counter() - start, 3)
+                logging.info(f"引擎 {name} 加载完成，耗时 {self.load_seconds[name]}s")
+        return self.engines[name]
+
+    def submit(self, path, engine, output_dir=None, profile=None, priority=None, callback=None):
+        """
+        提交任务，返回任务字典；引擎未知或文件不存在时抛 ValueError，队列满时抛 queue.Full。
+        priority: 数值越小越先执行，默认 0；同优先级按文件大小从小到大
+        callback: 任务结束（成功或失败）后在工作线程中以任务字典调用
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"未知引擎 {engine}，可选: {sorted(ENGINES)}")
+        if not os.path.isfile(path):
+            raise ValueError(f"文件不存在: {path}")
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "path": os.path.abspath(path),
+            "engine": engine,
+            "output_dir": output_dir or ENGINES[engine][2],
+            "profile": profile,
+            "priority": int(priority or 0),
+            "size": os.path.getsize(path),
+            "status": "queued",
+            "outputs": [],
+            "error": None,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "_done": threading.Event(),
+            "_callback": callback,
+        }
+        with self._lock:
+            self.queue.put_nowait((job["priority"], job["size"], next(self._seq), job))
+            self.jobs[job["id"]] = job
+            self._trim_jobs()
+        return job
+
+    def _trim_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job["status"] in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()[-1]
+            if job is None:
+                break
+            name = job["engine"]
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            try:
+                model = self.load_engine(name)
+                with self._engine_locks[name], tracing.document(os.path.basename(job["path"]), engine=name):
+                    job["outputs"] = ENGINES[name][1](model, job["path"], job["output_dir"], job["profile"])
+                job["status"] = "done"
+            except Exception as e:
+                job["status"] = "failed"
+                job["error"] = f"{e}\n{traceback.format_exc()}"
+                logging.error(f"任务 {job['id']} 失败: {e}")
+            finally:
+                job["finished_at"] = time.time()
+                job["_done"].set()
+                logging.info(f"任务 {job['id']} {job['status']}，耗时 {job['finished_at'] - job['started_at']:.2f}s")
+                if job["_callback"] is not None:
+                    try:
+                        job["_callback"](job)
+                    except Exception as e:
+                        logging.error(f"任务 {job['id']} 回调失败: {e}")
+
+    @staticmethod
+    def public(job):
+        return {key: value for key, value in job.items() if not key.startswith("_")}
+
+    def health(self):
+        return {"engines": sorted(self.engines), "load_seconds": self.load_seconds, "queued": self.queue.qsize(),
+                "max_queue": self.queue.maxsize, "jobs": len(self.jobs)}
+
+    # ---------- HTTP ----------
+
+    def _make_handler(self):
+        daemon = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _send_json(self, status, payload, headers=None):
+                body = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                if self.path != "/jobs":
+                    self._send_json(404, {"error": "not found"})
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    request_data = json.loads(self.rfile.read(length) or b"{}")
+                    job = daemon.submit(request_data.get("path", ""), request_data.get("engine", ""),
+                                        request_data.get("output_dir"), request_data.get("profile"),
+                                        request_data.get("priority"))
+                except queue.Full:
+                    self._send_json(503, {"error": "队列已满，请稍后重试"}, {"Retry-After": "5"})
+                    return
+                except (ValueError, json.JSONDecodeError) as e:
+                    self._send_json(400, {"error": str(e)})
+                    return
+                self._send_json(202, daemon.public(job))
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                parts = [p for p in url.path.split("/") if p]
+                if parts == ["health"]:
+                    self._send_json(200, daemon.health())
+                elif parts == ["jobs"]:
+                    with daemon._lock:
+                        jobs = [daemon.public(job) for job in daemon.jobs.values()]
+                    self._send_json(200, jobs)
+                elif len(parts) in (2, 3) and parts[0] == "jobs":
+                    job = daemon.jobs.get(parts[1])
+                    if job is None:
+                        self._send_json(404, {"error": "任务不存在"})
+                    elif len(parts) == 2:
+                        wait = float(urllib.parse.parse_qs(url.query).get("wait", ["0"])[0])
+                        if wait > 0:
+                            job["_done"].wait(min(wait, 300))
+                        self._send_json(200, daemon.public(job))
+                    elif parts[2] == "result":
+                        self._send_result(job)
+                    else:
+                        self._send_json(404, {"error": "not found"})
+                else:
+                    self._send_json(404, {"error": "not found"})
+
+            def _send_result(self, job):
+                if job["status"] != "done" or not job["outputs"]:
+                    self._send_json(409, {"error": f"任务状态为 {job['status']}", "job": daemon.public(job)})
+                    return
+                path = job["outputs"][0]
+                self.send_response(200)
+                self.send_header("Content-Type", "text/markdown; charset=utf-8")
+                self.send_header("Content-Length", str(os.path.getsize(path)))
+                self.end_headers()
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, self.wfile)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self, preload=()):
+        for name in preload:
+            self.load_engine(name)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self.httpd = http.server.ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        logging.info(f"转换服务监听 http://{self.host}:{self.port}，队列上限 {self.queue.maxsize}")
+        return self
+
+    def serve_forever(self):
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        for _ in self._threads:
+            try:
+                self.queue.put((float("inf"), 0, next(self._seq), None), timeout=1)
+            except queue.Full:
+                pass  # 工作线程是守护线程，队列满时不再等待
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+        if self.httpd:
+            self.httpd.server_close()
+        tracing.get_tracer().close()
+
+
+# ---------- 客户端 ----------
+
+def _request(url, data=None):
+    body = json.dumps(data).encode() if data is not None else None
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"} if body else {})
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, json.loads(resp.read() or b"null")
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b"null")
+
+
+def submit_job(path, engine, output_dir=None, profile=None, url=DEFAULT_URL, priority=None):
+    """提交任务，返回 (HTTP 状态码, 任务字典或错误)"""
+    data = {"path": os.path.abspath(path), "engine": engine, "profile": profile, "priority": priority,
+            "output_dir": os.path.abspath(output_dir) if output_dir else None}
+    return _request(f"{url}/jobs", data)
+
+
+def job_status(job_id, wait=0, url=DEFAULT_URL):
+    return _request(f"{url}/jobs/{job_id}?wait={wait}")
+
+
+def wait_for_job(job_id, url=DEFAULT_URL, poll=30):
+    """长轮询直到任务完成，返回任务字典"""
+    while True:
+        status, job = job_status(job_id, poll, url)
+        if status != 200 or job["status"] in ("done", "failed"):
+            return job
+
+
+def stream_result(job_id, out=None, url=DEFAULT_URL):
+    """把主输出文件流式写到 out（默认标准输出）"""
+    out = out or sys.stdout.buffer
+    with urllib.request.urlopen(f"{url}/jobs/{job_id}/result") as resp:
+        shutil.copyfileobj(resp, out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="常驻转换服务及客户端")
+    parser.add_argument("--url", default=DEFAULT_URL, help="客户端命令连接的服务地址")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve = sub.add_parser("serve", help="启动服务")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve.add_argument("--queue-size", type=int, default=16)
+    serve.add_argument("--workers", type=int, default=1)
+    serve.add_argument("--preload", nargs="*", default=[], choices=sorted(ENGINES), help="启动时预加载的引擎")
+
+    submit = sub.add_parser("submit", help="提交转换任务")
+    submit.add_argument("paths", nargs="+")
+    submit.add_argument("--engine", required=True, choices=sorted(ENGINES))
+    submit.add_argument("--output-dir")
+    submit.add_argument("--profile", help="输出档位（minerU_default: minimal/standard/debug）")
+    submit.add_argument("--priority", type=int, help="数值越小越先执行，默认 0（同优先级小文件先转）")
+    submit.add_argument("--wait", action="store_true", help="等待任务完成并输出结果路径")
+
+    watch = sub.add_parser("watch", help="启动服务并监视目录，新增或修改的文件写完后自动转换")
+    watch.add_argument("input_dir")
+    watch.add_argument("--engine", required=True, choices=sorted(ENGINES))
+    watch.add_argument("--output-dir")
+    watch.add_argument("--profile", help="输出档位（minerU_default: minimal/standard/debug）")
+    watch.add_argument("--debounce", type=float, default=1.0, help="文件保持不变多少秒后视为写完")
+    watch.add_argument("--poll-interval", type=float, default=2.0, help="inotify 不可用时的扫描间隔（秒）")
+    watch.add_argument("--priority", type=int, help="提交任务的优先级，省略时按文件大小（小文件先转）")
+    watch.add_argument("--port", type=int, default=DEFAULT_PORT)
+    watch.add_argument("--queue-size", type=int, default=16)
+    watch.add_argument("--workers", type=int, default=1)
+
+    status = sub.add_parser("status", help="查询任务状态")
+    status.add_argument("job_id", nargs="?", help="省略时列出所有任务")
+
+    result = sub.add_parser("result", help="输出任务的 markdown 结果")
+    result.add_argument("job_id")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+        ConversionDaemon(port=args.port, max_queue=args.queue_size, workers=args.workers) \
+            .start(args.preload).serve_forever()
+    elif args.command == "watch":
+        from watch_folder import FolderWatcher
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+        daemon = ConversionDaemon(port=args.port, max_queue=args.queue_size, workers=args.workers).start([args.engine])
+        watcher = FolderWatcher(daemon, args.input_dir, args.engine, args.output_dir, args.profile,
+                                debounce=args.debounce, poll_interval=args.poll_interval,
+                                priority=args.priority).start()
+        try:
+            daemon.serve_forever()
+        finally:
+            watcher.stop()
+    elif args.command == "submit":
+        jobs = []
+        for path in args.paths:
+            code, job = submit_job(path, args.engine, args.output_dir, args.profile, args.url, args.priority)
+            if code != 202:
+                print(f"提交失败 {path}: {job.get('error') if job else code}", file=sys.stderr)
+                continue
+            print(f"{job['id']}\t{path}")
+            jobs.append(job)
+        if args.wait:
+            failed = 0
+            for job in jobs:
+                job = wait_for_job(job["id"], args.url)
+                print(f"{job['id']}\t{job['status']}\t{', '.join(job['outputs']) or job['error']}")
+                failed += job["status"] != "done"
+            sys.exit(1 if failed else 0)
+    elif args.command == "status":
+        code, payload = job_status(args.job_id, url=args.url) if args.job_id else _request(f"{args.url}/jobs")
+        print(json.dumps(payload, ensure_ascii=False, indent=2))
+    elif args.command == "result":
+        stream_result(args.job_id, url=args.url)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,29 @@
-import base64
+import multiprocessing as mp
 import os
-import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
 from docling.datamodel.base_models import InputFormat
 from docling.document_converter import DocumentConverter, PdfFormatOption, WordFormatOption
-from docling_core.types.doc import ImageRefMode
+from docling_core.types.doc import ImageRef, ImageRefMode, PictureItem, Size
 from docling.datamodel.pipeline_options import PdfPipelineOptions, AcceleratorOptions
+from docling_tuning import load_tuned_config
+from page_selection import PAGE_SELECTION, describe, docling_source, output_name, select_pages
+from run_manifest import RunManifest
+import tracing
+
+tracing.enable_docling_page_timings()
 
 source = "./input"  # document per local path or URL
 output_dir = "./output/default"  # 修改为你希望保存的路径
-
-document_path_list = [os.path.join(source, file) for file in os.listdir(source) if file.endswith(".pdf")]
-# print(document_path)
+# 线程数和并行文档数取本机标定结果（python docling_tuning.py），未标定时 8 线程、逐个文档转换
+tuned = load_tuned_config()
 
 pipeline_options = PdfPipelineOptions(
     generate_picture_images=True,
     images_scale=2.0,
-    accelerator_options=AcceleratorOptions(device="cpu", num_threads=8)  # 配置device为cpu，线程数为8
+    accelerator_options=AcceleratorOptions(device="cpu", num_threads=tuned["num_threads"])  # 配置device为cpu
 )
 
 # 默认支持直接传入各种格式 参考：InputFormat类
@@ -29,64 +36,116 @@ converter = DocumentConverter(
     }
 )
 
-def save_images_and_update_markdown(markdown_text, output_dir):
+def save_picture_images(document, output_dir):
+    """
+    单次遍历文档中的图片项：直接把图片写到 images/ 目录，并把图片项的 uri 改为相对路径，
+    之后用 REFERENCED 模式导出 markdown，不再经过 base64 内嵌再正则替换。
+    """
     # 创建图片保存目录
     img_dir = os.path.join(output_dir, "images")
     os.makedirs(img_dir, exist_ok=True)
 
-    # 匹配Base64图片的正则表达式
-    pattern = r"!\[Image\]\(data:image/(.*?);base64,(.*?)\)"
-
-    # 查找所有Base64图片
-    matches = re.findall(pattern, markdown_text, re.DOTALL)
-
-    # 替换图片路径并保存图片
-    for i, (img_type, data) in enumerate(matches, start=1):
-        # 生成文件名
-        filename = f"image_{i}.{img_type.split('/')[0]}"
+    count = 0
+    for element, _level in document.iterate_items():
+        if not isinstance(element, PictureItem):
+            continue
+        image = element.get_image(document)
+        if image is None:
+            continue
+        count += 1
+        filename = f"image_{count}.png"
         img_path = os.path.join("images", filename)
-
-        # 解码并保存图片
         try:
-            img_data = base64.b64decode(data)
-            with open(os.path.join(output_dir, img_path), "wb") as img_file:
-                img_file.write(img_data)
+            image.save(os.path.join(output_dir, img_path), "PNG")
         except Exception as e:
             print(f"图片保存失败：{str(e)}")
             continue
-
-        # 替换Markdown中的Base64为相对路径
-        markdown_text = markdown_text.replace(
-            f"data:image/{img_type};base64,{data}",
-            img_path,
-            1
-        )
-
-    return markdown_text
-
-def process_single_pdf(converter, document_path, output_dir):
-    result = converter.convert(document_path)
-
-    markdown_text = result.document.export_to_markdown(image_mode=ImageRefMode.EMBEDDED)
-
-
-    output_basename = str(os.path.splitext(os.path.basename(document_path))[0])
+        # 图片引用改为相对路径，并释放内存中的图片
+        element.image = ImageRef(mimetype="image/png", dpi=element.image.dpi if element.image else 72,
+                                 size=Size(width=image.width, height=image.height), uri=Path(img_path))
+
+    return count
+
+def process_single_pdf(converter, document_path, output_dir, page_selection=PAGE_SELECTION):
+    # 设置了页面选择（PAGE_SELECTION）时只转换选定页面组成的子文档
+    pages = select_pages(document_path, page_selection)
+    if pages:
+        print(f"{os.path.basename(document_path)}: 只转换第 {describe(pages)} 页")
+    with tracing.span("converter.convert"):
+        result = converter.convert(docling_source(document_path, pages))
+    tracing.record_docling_timings(result)
+
+    output_basename = output_name(str(os.path.splitext(os.path.basename(document_path))[0]), pages)  # 试转结果不覆盖整篇输出
     output_subdir = os.path.join(output_dir, output_basename)
     output_path = os.path.join(output_subdir, output_basename + ".md")
 
-    markdown_text = save_images_and_update_markdown(markdown_text, output_subdir)
+    with tracing.span("save_picture_images") as attrs:
+        attrs["images"] = save_picture_images(result.document, output_subdir)
+    with tracing.span("export_to_markdown"):
+        markdown_text = result.document.export_to_markdown(image_mode=ImageRefMode.REFERENCED)
 
     # 保存到本地 Markdown 文件
-    with open(output_path, "w", encoding="utf-8") as f:
+    with tracing.span("write_markdown"), open(output_path, "w", encoding="utf-8") as f:
         f.write(markdown_text)
 
     print(f"Markdown 已保存到：{output_path}")
     print(f"图片已保存到：{os.path.join(output_subdir, 'images')}")
-
-def process_pdf_folder(converter, document_path_list, output_dir):
+    return output_path
+
+def _convert_in_worker(document_path, output_dir):
+    """并行模式的 worker：使用本进程导入时构建的 converter"""
+    start = time.perf_counter()
+    with tracing.document(os.path.basename(document_path), engine="docling_default"):
+        output_path = process_single_pdf(converter, document_path, output_dir)
+    return output_path, time.perf_counter() - start
+
+
+def process_pdf_folder_parallel(document_path_list, output_dir, workers, manifest):
+    """多进程转换，每个进程各自加载模型并使用 tuned["num_threads"] 个线程，大文件优先分发"""
+    print(f"启动 {workers} 个进程，每个 {tuned['num_threads']} 线程")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+        futures = {}
+        for document_path in sorted(document_path_list, key=os.path.getsize, reverse=True):
+            manifest.start(document_path)
+            futures[pool.submit(_convert_in_worker, document_path, output_dir)] = document_path
+        for future in as_completed(futures):
+            document_path = futures[future]
+            try:
+                output_path, seconds = future.result()
+                manifest.finish(document_path, [output_path], seconds)
+            except Exception as e:
+                manifest.fail(document_path, e)
+                print(f"转换失败 {document_path}: {str(e)}")
+
+
+def process_pdf_folder(converter, document_path_list, output_dir, workers=None):
+    manifest = RunManifest("docling_default", {"output_dir": output_dir, "images_scale": pipeline_options.images_scale,
+                                               "page_selection": PAGE_SELECTION})
+    pending = []
     for document_path in document_path_list:
-        process_single_pdf(converter, document_path, output_dir)
+        if manifest.is_done(document_path):
+            print(f"跳过已处理文件: {document_path} (输入未变化)")
+            continue
+        pending.append(document_path)
+    workers = min(workers or tuned["concurrent_documents"], len(pending))
+    if workers > 1:
+        process_pdf_folder_parallel(pending, output_dir, workers, manifest)
+        return
+    for document_path in pending:
+        start = time.perf_counter()
+        manifest.start(document_path)
+        try:
+            with tracing.document(os.path.basename(document_path), engine="docling_default"):
+                output_path = process_single_pdf(converter, document_path, output_dir)
+            manifest.finish(document_path, [output_path], time.perf_counter() - start)
+        except Exception as e:
+            manifest.fail(document_path, e, time.perf_counter() - start)
+            print(f"转换失败 {document_path}: {str(e)}")
 
 
 if __name__ == '__main__':
-    process_pdf_folder(converter, document_path_list, output_dir)
\ No newline at end of file
+    document_path_list = [os.path.join(source, file) for file in os.listdir(source) if file.endswith(".pdf")]
+    try:
+        process_pdf_folder(converter, document_path_list, output_dir)
+    finally:
+        tracing.get_tracer().close()
\ No newline at end of file
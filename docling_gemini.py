@@ -1,104 +1,50 @@
 import logging
 import os
-from pathlib import Path
-import threading
 import time
-import litellm
-from docling.datamodel.base_models import InputFormat
+from pathlib import Path
 from docling.datamodel.pipeline_options import (
     ApiVlmOptions,
     ResponseFormat,
-    VlmPipelineOptions,
     AcceleratorOptions,
 )
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling.pipeline.vlm_pipeline import VlmPipeline
-import traceback
 from dotenv import load_dotenv
+from adaptive_scale import AdaptivePageScaler
+from docling_hybrid import get_hybrid_session
+from docling_session import get_session
+from docling_tuning import tuned_accelerator_options
+from page_batcher import PageBatcher
+from page_checkpoint import convert_with_checkpoints
+from page_dedup import PageDedupIndex
+from page_selection import PAGE_SELECTION, describe, output_name, select_pages
+from rate_limiter import get_scheduler
+from run_manifest import RunManifest
+import tracing
+from vlm_cache import VLMResponseCache
+from vlm_proxy import GeminiAPIServer
 load_dotenv()
 
-# 本地 Gemini API 服务器
-class GeminiAPIServer:
-    def __init__(self):
-        self.is_running = False
-        self.server_thread = None
-
-    def start(self):
-        import http.server
-        import socketserver
-        import json
-
-        class CustomHandler(http.server.SimpleHTTPRequestHandler):
-            def do_POST(self):
-                if self.path == '/v1/chat/completions':
-                    content_length = int(self.headers['Content-Length'])
-                    post_data = self.rfile.read(content_length)
-                    try:
-                        request_data = json.loads(post_data.decode('utf-8'))
-                        model = request_data.get("model", "gemini-2.5-flash-preview-05-20")
-                        messages = request_data.get("messages", [])
-                        response = litellm.completion(
-                            model=f"gemini/{model}",
-                            messages=messages,
-                            temperature=request_data.get("temperature", 0.1),
-                            max_tokens=request_data.get("max_tokens", 8192)
-                        )
-                        result = {
-                            "id": response.id,
-                            "object": "chat.completion",
-                            "created": int(time.time()),
-                            "model": model,
-                            "choices": [
-                                {
-                                    "index": 0,
-                                    "message": {
-                                        "role": "assistant",
-                                        "content": response.choices[0].message.content
-                                    },
-                                    "finish_reason": "stop"
-                                }
-                            ],
-                            "usage": response.usage.dict() if response.usage else {}
-                        }
-                        self.send_response(200)
-                        self.send_header('Content-type', 'application/json')
-                        self.end_headers()
-                        self.wfile.write(json.dumps(result).encode())
-                    except Exception as e:
-                        self.send_response(500)
-                        self.send_header('Content-type', 'application/json')
-                        self.end_headers()
-                        tb = traceback.format_exc()
-                        error_response = {"error": str(e), "traceback": tb}
-                        self.wfile.write(json.dumps(error_response).encode())
-                else:
-                    self.send_response(404)
-                    self.end_headers()
-            def log_message(self, format, *args):
-                pass
+MAX_INFLIGHT = 8  # 代理同时在途的 Gemini 请求数
+USE_CACHE = True  # 设为 False（或环境变量 VLM_CACHE_BYPASS=1）跳过页面响应缓存
+ADAPTIVE_SCALE = True  # 按页面内容密度在 SCALE_BOUNDS 内自适应缩放；False 时固定 scale=1.0
+SCALE_BOUNDS = (0.5, 1.5)
+PAGE_DEDUP = True  # 复用与已转换页面相同或相似的页面结果（跨文档），False 或 PAGE_DEDUP_BYPASS=1 关闭
+DEDUP_MIN_SIMILARITY = 1.0  # 1.0 只复用完全相同的页面；小于 1.0 开启感知哈希近似匹配（命中后还会逐块比对细节）
+HYBRID_MODE = False  # True 时先用标准流水线本地解析，只把图片、复杂表格和低覆盖率页面发给 VLM
+PAGES_PER_REQUEST = 4  # 代理把并发到达的页面合并成多图请求（Gemini 上下文窗口大），1 表示逐页请求
+CHECKPOINT_PAGES = MAX_INFLIGHT * PAGES_PER_REQUEST  # 按页段转换并逐段保存，失败重跑只补缺失页段；0 表示整篇一次转换
 
-        def run_server():
-            with socketserver.TCPServer(("", 4000), CustomHandler) as httpd:
-                httpd.timeout = 1
-                self.httpd = httpd
-                while self.is_running:
-                    httpd.handle_request()
-
-        self.is_running = True
-        self.server_thread = threading.Thread(target=run_server)
-        self.server_thread.start()
-        time.sleep(2)
-
-    def stop(self):
-        self.is_running = False
-        if self.server_thread:
-            self.server_thread.join(timeout=5)
-        logging.info("API 服务器已停止")
-
-api_server = GeminiAPIServer()
+api_server = GeminiAPIServer(
+    port=4000,
+    max_inflight=MAX_INFLIGHT,
+    cache=VLMResponseCache(enabled=USE_CACHE),
+    page_scaler=AdaptivePageScaler(*SCALE_BOUNDS) if ADAPTIVE_SCALE else None,
+    page_index=PageDedupIndex(min_similarity=DEDUP_MIN_SIMILARITY, enabled=PAGE_DEDUP),
+    batcher=PageBatcher(PAGES_PER_REQUEST) if PAGES_PER_REQUEST > 1 else None,
+    scheduler=get_scheduler("gemini", max_concurrency=MAX_INFLIGHT),  # 与 marker_gemini 共用的 Gemini 配额调度
+)
 
-def gemini_vlm_options(model: str, prompt: str, timeout: int = 300):
-    """配置 Gemini 的 VLM 选项"""
+def gemini_vlm_options(model: str, prompt: str, timeout: int = 300, concurrency: int = MAX_INFLIGHT * PAGES_PER_REQUEST):
+    """配置 Gemini 的 VLM 选项，concurrency 为 VlmPipeline 同时发出的页面请求数"""
     return ApiVlmOptions(
         url="http://localhost:4000/v1/chat/completions",
         params=dict(
@@ -108,34 +54,43 @@ def gemini_vlm_options(model: str, prompt: str, timeout: int = 300):
         ),
         prompt=prompt,
         timeout=timeout,
-        scale=1.0,
+        concurrency=concurrency,
+        scale=SCALE_BOUNDS[1] if ADAPTIVE_SCALE else 1.0,  # 自适应模式下按上限渲染，由代理逐页缩小
         response_format=ResponseFormat.MARKDOWN,
     )
 
-def process_single_pdf(pdf_path: Path, output_dir: Path, model_name: str = "gemini-2.5-flash-preview-05-20"):
-    logging.info(f"正在处理: {pdf_path.name}")
-    pipeline_options = VlmPipelineOptions(
-        enable_remote_services=True,
-        # accelerator_options=AcceleratorOptions(device="cpu", num_threads=8)  # 配置device为cpu，线程数为8
-    )
-    pipeline_options.vlm_options = gemini_vlm_options(
-        model=model_name,
-        prompt="请将以下文档转换为Markdown格式，包含：1. 完整文本内容 2. 数学公式（LaTeX格式） 3. 图表标题及引用 4. 表格内容 5. 其他重要信息",
-        timeout=300
-    )
-    doc_converter = DocumentConverter(
-        format_options={
-            InputFormat.PDF: PdfFormatOption(
-                pipeline_options=pipeline_options,
-                pipeline_cls=VlmPipeline,
-            )
-        }
+PROMPT = "请将以下文档转换为Markdown格式，包含：1. 完整文本内容 2. 数学公式（LaTeX格式） 3. 图表标题及引用 4. 表格内容 5. 其他重要信息"
+
+def create_session(model_name: str = "gemini-2.5-flash-preview-05-20"):
+    """按模型配置获取共享的转换会话（同一配置整个运行只构建一次），HYBRID_MODE 时使用混合模式会话"""
+    return (get_hybrid_session if HYBRID_MODE else get_session)(
+        gemini_vlm_options(model=model_name, prompt=PROMPT, timeout=300),
+        accelerator_options=tuned_accelerator_options(),  # 本机标定的线程数（docling_tuning），未标定时用 docling 默认值
     )
+
+def checkpoint_config(session) -> dict:
+    """影响页面结果的配置，变化后已保存的页面作废"""
+    return {"model": session.vlm_options.params.get("model"), "prompt": session.vlm_options.prompt,
+            "scale": session.vlm_options.scale, "hybrid": HYBRID_MODE}
+
+def process_single_pdf(pdf_path: Path, output_dir: Path, model_name: str = "gemini-2.5-flash-preview-05-20", session=None,
+                       page_selection: str = PAGE_SELECTION):
+    logging.info(f"正在处理: {pdf_path.name}")
+    session = session or create_session(model_name)
     try:
-        result = doc_converter.convert(pdf_path)
-        output_file = output_dir / f"{pdf_path.stem}_content.md"
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(result.document.export_to_markdown())
+        pages = select_pages(pdf_path, page_selection)  # 试转时只渲染和发送选定的页面（页数少，不做逐段断点）
+        output_file = output_dir / f"{output_name(pdf_path.stem, pages)}_content.md"  # 试转结果不覆盖整篇输出
+        if pages:
+            logging.info(f"{pdf_path.name}: 只转换第 {describe(pages)} 页")
+        if CHECKPOINT_PAGES > 0 and not pages:
+            # 逐段写入 sidecar，失败重跑时从第一个缺失的页段继续
+            convert_with_checkpoints(session, pdf_path, output_file, CHECKPOINT_PAGES, checkpoint_config(session))
+        else:
+            result = session.convert(pdf_path, pages=pages)
+            with tracing.span("export_to_markdown"):
+                markdown_content = result.document.export_to_markdown()
+            with open(output_file, 'w', encoding='utf-8') as f:
+                f.write(markdown_content)
         logging.info(f"转换完成，结果已保存到: {output_file}")
         return True, output_file
     except Exception as e:
@@ -168,32 +123,41 @@ def process_pdf_folder(input_folder: str, output_folder: str = "./output", model
             logging.warning(f"在 {input_folder} 中未找到PDF文件")
             return
         logging.info(f"找到 {len(pdf_files)} 个PDF文件")
+        session = create_session(model_name).warm_up()
         success_count = 0
         failed_files = []
+        manifest = RunManifest("docling_gemini", {"model": model_name, "prompt": PROMPT,
+                                                  "scale": session.vlm_options.scale, "hybrid": HYBRID_MODE,
+                                                  "pages_per_request": PAGES_PER_REQUEST,
+                                                  "page_selection": PAGE_SELECTION})
         for i, pdf_file in enumerate(pdf_files, 1):
-            fname_base = os.path.splitext(os.path.basename(pdf_file))[0] +  "_content.md"
-            output_file = Path(os.path.join(output_path, fname_base))  # 目标输出路径
-
-            # 🔍 新增检查逻辑
-            if output_file.exists():
-                print(f"跳过已处理文件: {pdf_file} (输出目录已存在)")
+            if manifest.is_done(pdf_file):
+                print(f"跳过已处理文件: {pdf_file} (输入未变化)")
                 continue  # 跳过已处理文件
             logging.info(f"\n=== 处理第 {i}/{len(pdf_files)} 个文件 ===")
-            success, output_file = process_single_pdf(pdf_file, output_path, model_name)
+            start = time.perf_counter()
+            manifest.start(pdf_file)
+            with tracing.document(pdf_file.name, engine="docling_gemini"), api_server.metrics.document(pdf_file.name):
+                success, output_file = process_single_pdf(pdf_file, output_path, model_name, session)
             if success:
+                manifest.finish(pdf_file, [output_file], time.perf_counter() - start)
                 success_count += 1
                 with open(output_file, 'r', encoding='utf-8') as f:
                     content = f.read()
                     print(f"\n--- {pdf_file.name} 转换结果预览 ---")
                     print(content[:200] + "..." if len(content) > 200 else content)
             else:
+                manifest.fail(pdf_file, "转换失败", time.perf_counter() - start)
                 failed_files.append(pdf_file.name)
         logging.info(f"\n=== 处理完成 ===")
         logging.info(f"成功处理: {success_count}/{len(pdf_files)} 个文件")
+        logging.info(f"耗时统计: {session.summary()}")
         if failed_files:
             logging.warning(f"失败文件: {', '.join(failed_files)}")
     finally:
+        api_server.metrics.write_summary(str(output_path / "vlm_metrics_summary.json"))
         api_server.stop()
+        tracing.get_tracer().close()
 
 def main():
     input_folder = "./input"
@@ -0,0 +1,266 @@
+"""
+docling 混合模式：先用标准流水线（PdfPipelineOptions，本地版面分析 + 文本层）解析整份文档，
+只把图片、复杂表格和文本覆盖率/置信度低的页面发给 VLM，结果拼回 DoclingDocument 后再导出 markdown。
+VLM 请求发到与 VlmPipeline 相同的本地代理，缓存、页面去重、自适应缩放同样生效。
+"""
+import base64
+import io
+import logging
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from docling.datamodel.base_models import DocumentStream, InputFormat
+from docling.datamodel.pipeline_options import PdfPipelineOptions
+from docling.document_converter import DocumentConverter, PdfFormatOption
+from docling_core.types.doc import BoundingBox, DocItemLabel, PictureItem, ProvenanceItem, SectionHeaderItem, TableItem
+from docling_core.types.doc.document import PictureDescriptionData
+
+import tracing
+from docling_session import VlmConverterSession
+from page_selection import docling_source
+
+PICTURE_PROMPT = "Describe this figure in detail, including any text, data and trends it shows."
+TABLE_PROMPT = "Convert this table to a markdown table. Output only the table."
+MIN_TEXT_COVERAGE = 0.05  # 文本框面积占页面比例低于该值（且页面不空白）的页面整页交给 VLM
+MIN_PAGE_CONFIDENCE = 0.5  # docling 页面置信度（low_score）低于该值的页面整页交给 VLM
+COMPLEX_TABLE_CELLS = 60  # 单元格数不少于该值，或存在合并单元格的表格交给 VLM
+BLANK_INK_RATIO = 0.005  # 墨迹占比低于该值视为空白页
+_TEXT_LABELS = {DocItemLabel.TEXT, DocItemLabel.PARAGRAPH, DocItemLabel.SECTION_HEADER, DocItemLabel.TITLE,
+                DocItemLabel.LIST_ITEM, DocItemLabel.CAPTION, DocItemLabel.FOOTNOTE, DocItemLabel.FORMULA,
+                DocItemLabel.CODE, DocItemLabel.TABLE}
+_FENCE = re.compile(r"^```[a-zA-Z]*\n|\n?```\s*$")
+
+_sessions = {}
+
+
+def _image_data_url(image) -> str:
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def _page_of(item):
+    return item.prov[0].page_no if getattr(item, "prov", None) else None
+
+
+def is_complex_table(table: TableItem) -> bool:
+    cells = table.data.table_cells
+    if table.data.num_rows * table.data.num_cols >= COMPLEX_TABLE_CELLS:
+        return True
+    return any(cell.row_span > 1 or cell.col_span > 1 for cell in cells)
+
+
+def _is_blank(image) -> bool:
+    histogram = image.convert("L").histogram()
+    total = sum(histogram)
+    return not total or sum(histogram[:160]) / total < BLANK_INK_RATIO
+
+
+class HybridConverterSession(VlmConverterSession):
+    """混合模式的转换会话，接口与 VlmConverterSession 相同（vlm_options 提供代理地址、模型参数、整页 prompt 和渲染比例）"""
+
+    def __init__(self, vlm_options, accelerator_options=None):
+        super().__init__(vlm_options, accelerator_options)
+        self.md_converter = None
+        self.http = requests.Session()
+        self.counts = {"pages": 0, "vlm_pages": 0, "pictures": 0, "complex_tables": 0, "vlm_calls": 0,
+                       "vlm_failed": 0}
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        """构建标准流水线（不做 OCR，扫描页由 VLM 处理）和用于解析 VLM markdown 的转换器"""
+        if self.converter is not None:
+            return self
+        tracing.enable_docling_page_timings()
+        start = time.perf_counter()
+        pipeline_options = PdfPipelineOptions(
+            do_ocr=False,
+            do_table_structure=True,
+            generate_page_images=True,  # 低覆盖率页面和表格裁剪需要页面图片
+            generate_picture_images=True,
+            images_scale=self.vlm_options.scale,
+        )
+        if self.accelerator_options is not None:
+            pipeline_options.accelerator_options = self.accelerator_options
+        self.converter = DocumentConverter(
+            format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)}
+        )
+        self.converter.initialize_pipeline(InputFormat.PDF)
+        self.md_converter = DocumentConverter(allowed_formats=[InputFormat.MD])
+        self.setup_seconds = time.perf_counter() - start
+        logging.info(f"混合模式流水线初始化完成，耗时 {self.setup_seconds:.2f}s")
+        return self
+
+    def _vlm(self, prompt: str, image) -> str:
+        """通过本地代理调用 VLM，返回去掉代码块围栏的 markdown"""
+        payload = dict(self.vlm_options.params)
+        payload["messages"] = [{"role": "user", "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": _image_data_url(image)}},
+        ]}]
+        with self._lock:
+            self.counts["vlm_calls"] += 1
+        response = self.http.post(str(self.vlm_options.url), json=payload, timeout=self.vlm_options.timeout)
+        response.raise_for_status()
+        content = response.json()["choices"][0]["message"]["content"] or ""
+        return _FENCE.sub("", content.strip())
+
+    def _markdown_to_doc(self, markdown: str, name: str):
+        stream = DocumentStream(name=f"{name}.md", stream=io.BytesIO(markdown.encode("utf-8")))
+        return self.md_converter.convert(stream).document
+
+    def select_targets(self, result):
+        """返回 (低覆盖率/低置信度页面号列表, 要描述的图片, 复杂表格)"""
+        doc = result.document
+        coverage = {page_no: 0.0 for page_no in doc.pages}
+        for item, _level in doc.iterate_items():
+            if getattr(item, "label", None) in _TEXT_LABELS:
+                for prov in item.prov:
+                    coverage[prov.page_no] = coverage.get(prov.page_no, 0.0) + prov.bbox.area()
+        confidence_pages = getattr(getattr(result, "confidence", None), "pages", None) or {}
+        vlm_pages = []
+        for page_no, page in doc.pages.items():
+            area = page.size.width * page.size.height
+            scores = confidence_pages.get(page_no - 1)  # 置信度按 0 起始页号记录
+            low_score = getattr(scores, "low_score", None)
+            low_confidence = low_score is not None and not math.isnan(low_score) and low_score < MIN_PAGE_CONFIDENCE
+            low_coverage = bool(area) and coverage.get(page_no, 0.0) / area < MIN_TEXT_COVERAGE
+            if (low_confidence or low_coverage) and page.image is not None and not _is_blank(page.image.pil_image):
+                vlm_pages.append(page_no)
+        pictures, tables = [], []
+        for item, _level in doc.iterate_items():
+            if _page_of(item) in vlm_pages:
+                continue  # 整页交给 VLM 的页面不再单独处理图片和表格
+            if isinstance(item, PictureItem):
+                pictures.append(item)
+            elif isinstance(item, TableItem) and is_complex_table(item):
+                tables.append(item)
+        return vlm_pages, pictures, tables
+
+    def _describe_picture(self, doc, picture):
+        image = picture.get_image(doc)
+        if image is None:
+            return
+        text = self._vlm(PICTURE_PROMPT, image)
+        picture.annotations.append(PictureDescriptionData(text=text, provenance=self.vlm_options.params.get("model", "vlm")))
+
+    def _rebuild_table(self, doc, table):
+        image = table.get_image(doc)
+        if image is None:
+            return
+        parsed = self._markdown_to_doc(self._vlm(TABLE_PROMPT, image), "table")
+        for item, _level in parsed.iterate_items():
+            if isinstance(item, TableItem):
+                table.data = item.data
+                return
+        logging.warning("VLM 未返回可解析的表格，保留本地识别结果")
+
+    def _transcribe_page(self, doc, page_no):
+        return self._markdown_to_doc(self._vlm(self.vlm_options.prompt, doc.pages[page_no].image.pil_image),
+                                     f"page_{page_no}")
+
+    def _splice_page(self, doc, page_no, page_doc):
+        """用 VLM 解析出的页面内容替换该页的本地结果，插入位置为该页第一个顶层节点处"""
+        page_items = [item for item, _level in doc.iterate_items() if _page_of(item) == page_no]
+        top_refs = [child.cref for child in doc.body.children]
+
+        def top_level_index(item):
+            node = item
+            while node.parent is not None and node.parent.cref != doc.body.self_ref:
+                node = node.parent.resolve(doc)
+            return top_refs.index(node.self_ref) if node.self_ref in top_refs else None
+
+        indexes = [i for i in map(top_level_index, page_items) if i is not None]
+        if indexes:
+            position = min(indexes)
+        else:
+            earlier = [top_level_index(item) for item, _level in doc.iterate_items()
+                       if (_page_of(item) or 0) < page_no]
+            earlier = [i for i in earlier if i is not None]
+            position = max(earlier) + 1 if earlier else 0
+
+        size = doc.pages[page_no].size
+        bbox = BoundingBox(l=0, t=0, r=size.width, b=size.height)
+        for item, _level in page_doc.iterate_items():
+            prov = ProvenanceItem(page_no=page_no, bbox=bbox, charspan=(0, len(getattr(item, "text", "") or "")))
+            if isinstance(item, TableItem):
+                doc.add_table(data=item.data, prov=prov)
+            elif isinstance(item, SectionHeaderItem):
+                doc.add_heading(text=item.text, level=item.level, prov=prov)
+            elif getattr(item, "text", None):
+                doc.add_text(label=item.label, text=item.text, prov=prov)
+            else:
+                continue
+            # add_* 追加在 body 末尾，移动到该页原来的位置
+            doc.body.children.insert(position, doc.body.children.pop())
+            position += 1
+        if page_items:
+            doc.delete_items(node_items=[item for item in page_items if item.parent is None
+                                         or _page_of(item.parent.resolve(doc)) != page_no])
+
+    def enrich(self, result):
+        """并发调用 VLM，然后依次把结果拼回文档"""
+        doc = result.document
+        with tracing.span("hybrid.select_targets") as attrs:
+            vlm_pages, pictures, tables = self.select_targets(result)
+            attrs.update(pages=len(doc.pages), vlm_pages=len(vlm_pages), pictures=len(pictures), tables=len(tables))
+        with self._lock:
+            self.counts["pages"] += len(doc.pages)
+            self.counts["vlm_pages"] += len(vlm_pages)
+            self.counts["pictures"] += len(pictures)
+            self.counts["complex_tables"] += len(tables)
+        logging.info(f"混合模式: {len(doc.pages)} 页中 {len(vlm_pages)} 页整页走 VLM，"
+                     f"{len(pictures)} 张图片、{len(tables)} 个复杂表格走 VLM")
+
+        with tracing.span("hybrid.vlm"), ThreadPoolExecutor(max_workers=self.vlm_options.concurrency) as pool:
+            # 图片描述和表格直接修改对应节点；整页结果先收集，最后统一拼接
+            item_futures = [pool.submit(self._describe_picture, doc, p) for p in pictures]
+            item_futures += [pool.submit(self._rebuild_table, doc, t) for t in tables]
+            page_futures = {page_no: pool.submit(self._transcribe_page, doc, page_no) for page_no in vlm_pages}
+            for future in item_futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.counts["vlm_failed"] += 1
+                    logging.warning(f"VLM 处理图片/表格失败，保留本地结果: {e}")
+            page_docs = {}
+            for page_no, future in page_futures.items():
+                try:
+                    page_docs[page_no] = future.result()
+                except Exception as e:
+                    self.counts["vlm_failed"] += 1
+                    logging.warning(f"VLM 处理第 {page_no} 页失败，保留本地结果: {e}")
+
+        with tracing.span("hybrid.splice", pages=len(page_docs)):
+            for page_no in sorted(page_docs):
+                self._splice_page(doc, page_no, page_docs[page_no])
+        return result
+
+    def convert(self, pdf_path: Path, page_range=None, pages=None):
+        """本地解析 + VLM 补充，耗时（含 VLM）记录在 convert_seconds"""
+        self.warm_up()
+        start = time.perf_counter()
+        try:
+            with tracing.span("converter.convert"):
+                result = self.converter.convert(docling_source(pdf_path, pages), **({"page_range": page_range} if page_range else {}))
+            tracing.record_docling_timings(result)
+            return self.enrich(result)
+        finally:
+            self._record(pdf_path, time.perf_counter() - start)
+
+    def summary(self) -> dict:
+        return {**super().summary(), **self.counts}
+
+
+def get_hybrid_session(vlm_options, accelerator_options=None) -> HybridConverterSession:
+    """按 (model, prompt, scale, url) 配置返回共享的混合模式会话"""
+    key = (vlm_options.params.get("model"), vlm_options.prompt, vlm_options.scale, vlm_options.url)
+    session = _sessions.get(key)
+    if session is None:
+        session = _sessions[key] = HybridConverterSession(vlm_options, accelerator_options)
+    return session
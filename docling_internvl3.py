@@ -1,35 +1,62 @@
 import logging
 import os
+import time
 from pathlib import Path
-import requests
-from docling.datamodel.base_models import InputFormat
 from docling.datamodel.pipeline_options import (
     ApiVlmOptions,
     ResponseFormat,
-    VlmPipelineOptions,
 )
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling.pipeline.vlm_pipeline import VlmPipeline
+from adaptive_scale import AdaptivePageScaler
+from docling_hybrid import get_hybrid_session
+from docling_session import get_session
+from docling_tuning import tuned_accelerator_options
+from page_batcher import PageBatcher
+from page_checkpoint import convert_with_checkpoints
+from page_dedup import PageDedupIndex
+from page_selection import PAGE_SELECTION, describe, output_name, select_pages
+from run_manifest import RunManifest
+import tracing
+from vlm_cache import VLMResponseCache
+from local_vlm_client import LocalVLMClient
+from vlm_proxy import VLMProxyServer
+
+# 本地推理服务地址，可配置多个（如两个 LM Studio 实例，或 Ollama 的 http://127.0.0.1:11434），按在途请求数最少路由
+# 也可用环境变量 LM_STUDIO_URLS 以逗号分隔指定
+LM_STUDIO_URLS = os.getenv("LM_STUDIO_URLS", "http://127.0.0.1:1234").split(",")
+PROXY_PORT = 4001  # 本地缓存代理端口，页面请求经代理转发到 LM Studio
+MAX_INFLIGHT = 2 * len(LM_STUDIO_URLS)  # 同时在途的页面请求数
+USE_CACHE = True  # 设为 False（或环境变量 VLM_CACHE_BYPASS=1）跳过页面响应缓存
+ADAPTIVE_SCALE = True  # 按页面内容密度在 SCALE_BOUNDS 内自适应缩放；False 时固定 scale=0.5
+SCALE_BOUNDS = (0.3, 1.0)
+PAGE_DEDUP = True  # 复用与已转换页面相同或相似的页面结果（跨文档），False 或 PAGE_DEDUP_BYPASS=1 关闭
+DEDUP_MIN_SIMILARITY = 1.0  # 1.0 只复用完全相同的页面；小于 1.0 开启感知哈希近似匹配（命中后还会逐块比对细节）
+HYBRID_MODE = False  # True 时先用标准流水线本地解析，只把图片、复杂表格和低覆盖率页面发给 VLM
+PAGES_PER_REQUEST = 1  # 代理把并发到达的页面合并成多图请求（本地小模型上下文有限，默认不合并），1 表示逐页请求
+CHECKPOINT_PAGES = MAX_INFLIGHT * PAGES_PER_REQUEST  # 按页段转换并逐段保存，失败重跑只补缺失页段；0 表示整篇一次转换
+
+local_client = LocalVLMClient(LM_STUDIO_URLS, timeout=300)
+api_server = VLMProxyServer(
+    port=PROXY_PORT,
+    max_inflight=MAX_INFLIGHT,
+    completion_fn=local_client.completion,
+    cache=VLMResponseCache(enabled=USE_CACHE),
+    page_scaler=AdaptivePageScaler(*SCALE_BOUNDS) if ADAPTIVE_SCALE else None,
+    page_index=PageDedupIndex(min_similarity=DEDUP_MIN_SIMILARITY, enabled=PAGE_DEDUP),
+    batcher=PageBatcher(PAGES_PER_REQUEST) if PAGES_PER_REQUEST > 1 else None,
+)
 
-def check_lm_studio_connection(url="http://127.0.0.1:1234", timeout=5):
-    """检查LM Studio是否正常运行"""
-    try:
-        response = requests.get(f"{url}/v1/models", timeout=timeout)
-        if response.status_code == 200:
-            models = response.json()
-            logging.info("LM Studio连接成功")
-            return True, models
-        else:
-            logging.error(f"LM Studio响应异常，状态码: {response.status_code}")
-            return False, None
-    except Exception as e:
-        logging.error(f"无法连接到LM Studio: {e}")
-        return False, None
+def check_lm_studio_connection():
+    """检查LM Studio是否正常运行（至少一个后端可用即可）"""
+    if local_client.check_health():
+        logging.info(f"LM Studio连接成功: {local_client.stats()}")
+        return True, [b.models for b in local_client.backends if b.healthy]
+    logging.error(f"无法连接到LM Studio: {local_client.stats()}")
+    return False, None
 
-def lm_studio_vlm_options(model: str, prompt: str, timeout: int = 300):
+def lm_studio_vlm_options(model: str, prompt: str, timeout: int = 300, concurrency: int = MAX_INFLIGHT * PAGES_PER_REQUEST):
     """配置LM Studio的VLM选项"""
     options = ApiVlmOptions(
-        url="http://localhost:1234/v1/chat/completions",
+        url=f"http://localhost:{PROXY_PORT}/v1/chat/completions",
         params=dict(
             model=model,
             max_tokens=8192,
@@ -37,55 +64,59 @@ def lm_studio_vlm_options(model: str, prompt: str, timeout: int = 300):
         ),
         prompt=prompt,
         timeout=timeout,
-        scale=0.5,  # 可以调整图片缩放比例
+        concurrency=concurrency,
+        scale=SCALE_BOUNDS[1] if ADAPTIVE_SCALE else 0.5,  # 可以调整图片缩放比例，自适应模式下按上限渲染
         response_format=ResponseFormat.MARKDOWN,
     )
     return options
 
-def process_single_pdf(pdf_path: Path, output_dir: Path, model_name: str = "internvl3-9b"):
-    """处理单个PDF文件"""
-    logging.info(f"正在处理: {pdf_path.name}")
-
-    # 配置VLM流水线
-    pipeline_options = VlmPipelineOptions(
-        enable_remote_services=True
-    )
-
-    pipeline_options.vlm_options = lm_studio_vlm_options(
-        model=model_name,
-        prompt="OCR the full page to markdown.",
-
-        #         prompt="""Please accurately extract all text content from this page, including:
+PROMPT = "OCR the full page to markdown."
+# PROMPT = """Please accurately extract all text content from this page, including:
 # 1. Text content
 # 2. Mathematical formulas (in LaTeX format if possible)
 # 3. Figure captions and references
 # 4. Table content
 # 5. Any other relevant information
 #
-# Format the output in markdown.""",
-        timeout=300
-    )
+# Format the output in markdown."""
 
-    # 创建文档转换器
-    doc_converter = DocumentConverter(
-        format_options={
-            InputFormat.PDF: PdfFormatOption(
-                pipeline_options=pipeline_options,
-                pipeline_cls=VlmPipeline,
-            )
-        }
+def create_session(model_name: str = "internvl3-9b"):
+    """按模型配置获取共享的转换会话（同一配置整个运行只构建一次），HYBRID_MODE 时使用混合模式会话"""
+    return (get_hybrid_session if HYBRID_MODE else get_session)(
+        lm_studio_vlm_options(model=model_name, prompt=PROMPT, timeout=300),
+        accelerator_options=tuned_accelerator_options(),  # 本机标定的线程数（docling_tuning），未标定时用 docling 默认值
     )
 
-    try:
-        # 执行转换
-        result = doc_converter.convert(pdf_path)
+def checkpoint_config(session) -> dict:
+    """影响页面结果的配置，变化后已保存的页面作废"""
+    return {"model": session.vlm_options.params.get("model"), "prompt": session.vlm_options.prompt,
+            "scale": session.vlm_options.scale, "hybrid": HYBRID_MODE}
+
+def process_single_pdf(pdf_path: Path, output_dir: Path, model_name: str = "internvl3-9b", session=None,
+                       page_selection: str = PAGE_SELECTION):
+    """处理单个PDF文件"""
+    logging.info(f"正在处理: {pdf_path.name}")
+
+    # 复用已初始化的转换会话
+    session = session or create_session(model_name)
 
-        # 保存结果
-        markdown_content = result.document.export_to_markdown()
-        output_file = output_dir / f"{pdf_path.stem}_content.md"
+    try:
+        pages = select_pages(pdf_path, page_selection)  # 试转时只渲染和发送选定的页面（页数少，不做逐段断点）
+        output_file = output_dir / f"{output_name(pdf_path.stem, pages)}_content.md"  # 试转结果不覆盖整篇输出
+        if pages:
+            logging.info(f"{pdf_path.name}: 只转换第 {describe(pages)} 页")
+        if CHECKPOINT_PAGES > 0 and not pages:
+            # 逐段执行转换并写入 sidecar，失败重跑时从第一个缺失的页段继续
+            convert_with_checkpoints(session, pdf_path, output_file, CHECKPOINT_PAGES, checkpoint_config(session))
+        else:
+            # 执行转换
+            result = session.convert(pdf_path, pages=pages)
 
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(markdown_content)
+            # 保存结果
+            with tracing.span("export_to_markdown"):
+                markdown_content = result.document.export_to_markdown()
+            with open(output_file, 'w', encoding='utf-8') as f:
+                f.write(markdown_content)
 
         logging.info(f"转换完成，结果已保存到: {output_file}")
         return True, output_file
@@ -128,27 +159,54 @@ def process_pdf_folder(input_folder: str, output_folder: str = "./output", model
 
     logging.info(f"找到 {len(pdf_files)} 个PDF文件")
 
+    # 启动本地缓存代理和后端健康检查
+    api_server.start()
+    local_client.start_health_checks()
+
+    # 构建并预热转换会话（整个文件夹共用）
+    session = create_session(model_name).warm_up()
+
+    manifest = RunManifest("docling_internvl3", {"model": model_name, "prompt": PROMPT,
+                                                 "scale": session.vlm_options.scale, "hybrid": HYBRID_MODE,
+                                                 "pages_per_request": PAGES_PER_REQUEST,
+                                                 "page_selection": PAGE_SELECTION})
+
     # 处理每个PDF文件
     success_count = 0
     failed_files = []
 
-    for i, pdf_file in enumerate(pdf_files, 1):
-        logging.info(f"\n=== 处理第 {i}/{len(pdf_files)} 个文件 ===")
-        success, output_file = process_single_pdf(pdf_file, output_path, model_name)
-
-        if success:
-            success_count += 1
-            # 显示部分内容预览
-            with open(output_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-                print(f"\n--- {pdf_file.name} 转换结果预览 ---")
-                print(content[:200] + "..." if len(content) > 200 else content)
-        else:
-            failed_files.append(pdf_file.name)
+    try:
+        for i, pdf_file in enumerate(pdf_files, 1):
+            if manifest.is_done(pdf_file):
+                print(f"跳过已处理文件: {pdf_file} (输入未变化)")
+                continue  # 跳过已处理文件
+            logging.info(f"\n=== 处理第 {i}/{len(pdf_files)} 个文件 ===")
+            start = time.perf_counter()
+            manifest.start(pdf_file)
+            with tracing.document(pdf_file.name, engine="docling_internvl3"), api_server.metrics.document(pdf_file.name):
+                success, output_file = process_single_pdf(pdf_file, output_path, model_name, session)
+
+            if success:
+                manifest.finish(pdf_file, [output_file], time.perf_counter() - start)
+                success_count += 1
+                # 显示部分内容预览
+                with open(output_file, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                    print(f"\n--- {pdf_file.name} 转换结果预览 ---")
+                    print(content[:200] + "..." if len(content) > 200 else content)
+            else:
+                manifest.fail(pdf_file, "转换失败", time.perf_counter() - start)
+                failed_files.append(pdf_file.name)
+    finally:
+        api_server.metrics.write_summary(str(output_path / "vlm_metrics_summary.json"))
+        api_server.stop()
+        tracing.get_tracer().close()
+        local_client.close()
 
     # 输出处理结果统计
     logging.info(f"\n=== 处理完成 ===")
     logging.info(f"成功处理: {success_count}/{len(pdf_files)} 个文件")
+    logging.info(f"耗时统计: {session.summary()}")
     if failed_files:
         logging.warning(f"失败文件: {', '.join(failed_files)}")
 
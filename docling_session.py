@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from docling.datamodel.base_models import InputFormat
+from docling.datamodel.pipeline_options import VlmPipelineOptions
+from docling.datamodel.settings import settings
+from docling.document_converter import DocumentConverter, PdfFormatOption
+from docling.pipeline.vlm_pipeline import VlmPipeline
+from page_selection import docling_source
+import tracing
+
+_sessions = {}
+
+
+class VlmConverterSession:
+    """长生命周期的 VLM 转换会话：整个运行期间复用同一个 DocumentConverter 和已初始化的流水线"""
+
+    def __init__(self, vlm_options, accelerator_options=None):
+        self.vlm_options = vlm_options
+        self.accelerator_options = accelerator_options
+        self.converter = None
+        self.setup_seconds = 0.0
+        self.convert_seconds = []  # 每个文档一项
+        self._document = threading.local()  # 当前线程是否在 document() 内（多次 convert 计为一个文档）
+
+    def warm_up(self):
+        """
+        构建转换器并提前初始化 PDF 流水线，耗时单独记录在 setup_seconds。
+        VlmPipeline 每批只并发 settings.perf.page_batch_size 页，这里把它调到不低于 concurrency，代理才能攒到足够的页面合并请求。
+        该设置是 docling 的进程级配置，同一进程中之后的所有转换器（包括 docling_default）都按这个批大小处理页面；
+        走代理的运行（docling_gemini / docling_internvl3）应只加载 VLM 引擎，
+        需要保持 docling_default 默认批大小时不要在同一个转换服务进程中同时加载两类引擎。
+        """
+        if self.converter is not None:
+            return self
+        tracing.enable_docling_page_timings()
+        start = time.perf_counter()
+        settings.perf.page_batch_size = max(settings.perf.page_batch_size, self.vlm_options.concurrency)
+        pipeline_options = VlmPipelineOptions(enable_remote_services=True)
+        if self.accelerator_options is not None:
+            pipeline_options.accelerator_options = self.accelerator_options
+        pipeline_options.vlm_options = self.vlm_options
+        self.converter = DocumentConverter(
+            format_options={
+                InputFormat.PDF: PdfFormatOption(
+                    pipeline_options=pipeline_options,
+                    pipeline_cls=VlmPipeline,
+                )
+            }
+        )
+        self.converter.initialize_pipeline(InputFormat.PDF)
+        self.setup_seconds = time.perf_counter() - start
+        logging.info(f"转换流水线初始化完成，耗时 {self.setup_seconds:.2f}s")
+        return self
+
+    def convert(self, pdf_path: Path, page_range=None, pages=None):
+        """转换单个文档，耗时记录在 convert_seconds；pages 为选定的页码列表（page_selection），只转换这些页面"""
+        self.warm_up()
+        start = time.perf_counter()
+        try:
+            with tracing.span("converter.convert"):
+                result = self.converter.convert(docling_source(pdf_path, pages), **({"page_range": page_range} if page_range else {}))
+            tracing.record_docling_timings(result)
+            return result
+        finally:
+            self._record(pdf_path, time.perf_counter() - start)
+
+    def _record(self, pdf_path, elapsed):
+        """记录一次 convert 的耗时；在 document() 内时由 document() 统一记录"""
+        if not getattr(self._document, "active", False):
+            self.convert_seconds.append(elapsed)
+        logging.info(f"{Path(pdf_path).name} 转换耗时 {elapsed:.2f}s")
+
+    @contextmanager
+    def document(self):
+        """把期间的多次 convert（如按页段断点续传）计为一个文档，convert_seconds 只记录一次总耗时"""
+        self.warm_up()
+        self._document.active = True
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self._document.active = False
+            self.convert_seconds.append(time.perf_counter() - start)
+
+    def summary(self) -> dict:
+        total = sum(self.convert_seconds)
+        count = len(self.convert_seconds)
+        return {
+            "setup_seconds": round(self.setup_seconds, 3),
+            "documents": count,
+            "convert_seconds": round(total, 3),
+            "avg_convert_seconds": round(total / count, 3) if count else 0.0,
+        }
+
+
+def get_session(vlm_options, accelerator_options=None) -> VlmConverterSession:
+    """按 (model, prompt, scale) 配置返回共享会话，相同配置只构建一次"""
+    key = (vlm_options.params.get("model"), vlm_options.prompt, vlm_options.scale, vlm_options.url)
+    session = _sessions.get(key)
+    if session is None:
+        session = _sessions[key] = VlmConverterSession(vlm_options, accelerator_options)
+    return session
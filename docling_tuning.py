@@ -0,0 +1,215 @@
+"""
+docling 线程数与文档级并行度的自动标定：取真实输入中的少量文档，在 (num_threads, 并行文档数) 网格上
+逐一试跑，记录 pages/sec 和内存，把本机最优配置写入 cache/docling_tuning.json。
+docling_default（以及 docling_gemini / docling_internvl3 的本地模型部分）启动时自动读取本机的标定结果。
+
+用法：python docling_tuning.py --input ./input --sample 6 --max-pages 5
+环境变量 DOCLING_NUM_THREADS / DOCLING_CONCURRENT_DOCUMENTS 可临时覆盖标定结果。
+"""
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+TUNING_PATH = os.getenv("DOCLING_TUNING_PATH", "./cache/docling_tuning.json")
+DEFAULT_THREADS = 8
+THREAD_GRID = [1, 2, 4, 8, 16, 32, 64]
+DOCUMENT_GRID = [1, 2, 4, 8, 16]
+
+
+def host_key() -> str:
+    """标定结果按主机区分：主机名、CPU 核数和架构"""
+    return f"{platform.node()}:{os.cpu_count()}:{platform.machine()}"
+
+
+def _read_results(path=TUNING_PATH) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_tuned_config(default_threads: int = DEFAULT_THREADS, default_documents: int = 1, path=TUNING_PATH) -> dict:
+    """返回本机的 {"num_threads", "concurrent_documents"}：环境变量优先，其次标定结果，最后是默认值"""
+    tuned = _read_results(path).get(host_key(), {})
+    return {
+        "num_threads": int(os.getenv("DOCLING_NUM_THREADS") or tuned.get("num_threads") or default_threads),
+        "concurrent_documents": int(os.getenv("DOCLING_CONCURRENT_DOCUMENTS")
+                                    or tuned.get("concurrent_documents") or default_documents),
+    }
+
+
+def tuned_accelerator_options(device: str = "cpu"):
+    """已标定（或设置了 DOCLING_NUM_THREADS）时返回对应线程数的 AcceleratorOptions，否则返回 None 使用 docling 默认值"""
+    if host_key() not in _read_results() and not os.getenv("DOCLING_NUM_THREADS"):
+        return None
+    from docling.datamodel.pipeline_options import AcceleratorOptions
+    return AcceleratorOptions(device=device, num_threads=load_tuned_config()["num_threads"])
+
+
+def save_tuned_config(result: dict, path=TUNING_PATH):
+    results = _read_results(path)
+    results[host_key()] = result
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+# ---------- 试跑（在独立子进程中执行，线程设置和模型内存互不影响） ----------
+
+def _trial_worker_init(num_threads):
+    os.environ["DOCLING_NUM_THREADS"] = str(num_threads)
+    os.environ["DOCLING_CONCURRENT_DOCUMENTS"] = "1"
+    import docling_default
+    from docling.datamodel.base_models import InputFormat
+    docling_default.converter.initialize_pipeline(InputFormat.PDF)  # 模型加载不计入吞吐
+
+
+def _trial_convert(pdf_path, output_dir):
+    import docling_default
+    start = time.time()
+    docling_default.process_single_pdf(docling_default.converter, pdf_path, output_dir, page_selection="")  # 样本已截取
+    end = time.time()
+    try:
+        import resource
+        rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != "darwin" else 1024 ** 2)
+    except ImportError:
+        rss_mb = None
+    return os.getpid(), start, end, rss_mb
+
+
+def run_trial(sample_dir, num_threads, documents, output_dir):
+    """用 documents 个进程（每个 num_threads 线程）转换 sample_dir 中的文档，返回吞吐和内存"""
+    pdfs = sorted(glob.glob(os.path.join(sample_dir, "*.pdf")), key=os.path.getsize, reverse=True)
+    ctx = mp.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=documents, mp_context=ctx, initializer=_trial_worker_init,
+                             initargs=(num_threads,)) as pool:
+        results = list(pool.map(_trial_convert, pdfs, [output_dir] * len(pdfs)))
+    peak_rss = {}
+    for pid, _, _, rss_mb in results:
+        peak_rss[pid] = max(peak_rss.get(pid, 0.0), rss_mb or 0.0)
+    return {
+        "seconds": max(r[2] for r in results) - min(r[1] for r in results),
+        "peak_rss_mb": round(sum(peak_rss.values()), 1),  # 各 worker 峰值之和，近似同时占用的内存
+    }
+
+
+def build_sample(input_dir, sample_dir, sample=6, max_pages=5):
+    """从真实输入中均匀取 sample 个文档，每个只保留前 max_pages 页，返回总页数"""
+    import fitz
+    pdfs = sorted(glob.glob(os.path.join(input_dir, "*.pdf")), key=os.path.getsize)
+    if not pdfs:
+        raise ValueError(f"{input_dir} 中没有 PDF 文件")
+    step = max(1, len(pdfs) // sample)
+    pages = 0
+    for pdf_path in pdfs[::step][:sample]:  # 按大小均匀取样，覆盖大小文档
+        with fitz.open(pdf_path) as src, fitz.open() as dst:
+            dst.insert_pdf(src, from_page=0, to_page=min(src.page_count, max_pages) - 1)
+            dst.save(os.path.join(sample_dir, os.path.basename(pdf_path)))
+            pages += dst.page_count
+    return pages
+
+
+def default_grid(cpus, documents_limit):
+    """线程数 × 并行文档数不超过 CPU 核数的组合"""
+    return [(threads, docs) for threads in THREAD_GRID for docs in DOCUMENT_GRID
+            if threads * docs <= cpus and docs <= documents_limit]
+
+
+def total_memory_mb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 2
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def calibrate(input_dir, sample=6, max_pages=5, grid=None, max_memory_mb=None, save=True):
+    """在网格上逐一试跑，返回并（默认）保存最优配置；超出内存上限的组合不参与选择"""
+    cpus = os.cpu_count() or 1
+    memory_limit = max_memory_mb or (total_memory_mb() or 0) * 0.8 or None
+    work_dir = tempfile.mkdtemp(prefix="docling_tuning_")
+    trials = []
+    try:
+        sample_dir = os.path.join(work_dir, "sample")
+        os.makedirs(sample_dir)
+        pages = build_sample(input_dir, sample_dir, sample, max_pages)
+        documents_limit = len(glob.glob(os.path.join(sample_dir, "*.pdf")))
+        grid = grid or default_grid(cpus, documents_limit)
+        print(f"标定样本: {documents_limit} 个文档共 {pages} 页，{len(grid)} 组配置，本机 {cpus} 核")
+        for threads, docs in grid:
+            output_dir = os.path.join(work_dir, f"out_{threads}x{docs}")
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run-trial", str(threads), str(docs),
+                 "--input", sample_dir, "--output", output_dir],
+                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+            trial = {"num_threads": threads, "concurrent_documents": docs}
+            if proc.returncode != 0:
+                trial["error"] = ((proc.stderr or proc.stdout).strip().splitlines() or ["unknown"])[-1]
+                print(f"threads={threads:>3} docs={docs:>3}  失败: {trial['error']}")
+                trials.append(trial)
+                continue
+            measured = json.loads(proc.stdout.strip().splitlines()[-1])
+            trial["pages_per_second"] = round(pages / measured["seconds"], 3) if measured["seconds"] else 0.0
+            trial["peak_rss_mb"] = measured["peak_rss_mb"]
+            trial["over_memory"] = bool(memory_limit and measured["peak_rss_mb"] > memory_limit)
+            trials.append(trial)
+            print(f"threads={threads:>3} docs={docs:>3}  {trial['pages_per_second']:>8.2f} pages/s  "
+                  f"RSS {trial['peak_rss_mb']:>9.1f}MB{'  超出内存上限' if trial['over_memory'] else ''}")
+            shutil.rmtree(output_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    candidates = [t for t in trials if "error" not in t and not t["over_memory"]]
+    if not candidates:
+        print("没有可用的配置，未保存标定结果")
+        return None
+    best = max(candidates, key=lambda t: t["pages_per_second"])
+    result = {**best, "measured_at": time.strftime("%Y-%m-%d %H:%M:%S"), "sample_pages": pages, "trials": trials}
+    print(f"最优配置: num_threads={best['num_threads']}，并行文档数 {best['concurrent_documents']}，"
+          f"{best['pages_per_second']} pages/s")
+    if save:
+        save_tuned_config(result)
+        print(f"已保存到 {TUNING_PATH}（{host_key()}）")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="标定 docling 的线程数与并行文档数")
+    parser.add_argument("--input", default="./input")
+    parser.add_argument("--sample", type=int, default=6, help="取样文档数")
+    parser.add_argument("--max-pages", type=int, default=5, help="每个样本文档最多保留的页数")
+    parser.add_argument("--threads", type=int, nargs="*", help="自定义线程数网格")
+    parser.add_argument("--docs", type=int, nargs="*", help="自定义并行文档数网格")
+    parser.add_argument("--max-memory-mb", type=float, help="内存上限，默认物理内存的 80%%")
+    parser.add_argument("--dry-run", action="store_true", help="只输出结果，不保存")
+    parser.add_argument("--show", action="store_true", help="显示本机当前使用的配置")
+    parser.add_argument("--run-trial", type=int, nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_trial:
+        print(json.dumps(run_trial(args.input, *args.run_trial, args.output)))
+        return
+    if args.show:
+        print(f"{host_key()}: {load_tuned_config()}")
+        return
+    grid = None
+    if args.threads or args.docs:
+        grid = [(t, d) for t in (args.threads or [DEFAULT_THREADS]) for d in (args.docs or [1])]
+    calibrate(args.input, args.sample, args.max_pages, grid, args.max_memory_mb, save=not args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
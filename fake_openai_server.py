@@ -0,0 +1,149 @@
+"""
+假的 OpenAI 兼容服务器，用于在没有 LM Studio / Ollama / Gemini 的环境下测试客户端、代理和批处理。
+用法：python fake_openai_server.py --port 1235 --latency 0.5 --fail-rate 0.1 --rpm-limit 60
+"""
+import argparse
+import collections
+import http.server
+import json
+import random
+import threading
+import time
+
+
+class FakeOpenAIServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.2, fail_rate: float = 0.0,
+                 content: str = "# Fake page\n\nLorem ipsum.", model: str = "fake-vlm", rpm_limit: int = 0,
+                 rate_window: float = 60.0):
+        """
+        latency: 每个 chat completion 的固定延迟（秒）
+        fail_rate: 随机返回 500 的概率
+        rpm_limit: 每个 rate_window 秒内最多接受的请求数，超出时返回 429 和 Retry-After（0 表示不限）
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.content = content
+        self.model = model
+        self.rpm_limit = rpm_limit
+        self.rate_window = rate_window
+        self.requests = 0
+        self.rate_limited = 0
+        self._accepted = collections.deque()
+        self._lock = threading.Lock()
+        self.httpd = None
+        self.server_thread = None
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _send_json(self, status, payload, headers=None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/v1/models":
+                    self._send_json(200, {"object": "list", "data": [{"id": server.model, "object": "model"}]})
+                else:
+                    self._send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request_data = json.loads(self.rfile.read(length) or b"{}")
+                if self.path != "/v1/chat/completions":
+                    self._send_json(404, {"error": "not found"})
+                    return
+                retry_after = server.check_rate_limit()
+                if retry_after is not None:
+                    self._send_json(429, {"error": {"message": "rate limit exceeded", "code": 429}},
+                                    {"Retry-After": f"{retry_after:.2f}"})
+                    return
+                server.requests += 1
+                time.sleep(server.latency)
+                if random.random() < server.fail_rate:
+                    self._send_json(500, {"error": "fake upstream failure"})
+                    return
+                self._send_json(200, server.make_response(request_data))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def check_rate_limit(self):
+        """滑动窗口限流，超限时返回建议的 Retry-After 秒数，否则记录本次请求并返回 None"""
+        if not self.rpm_limit:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            while self._accepted and now - self._accepted[0] >= self.rate_window:
+                self._accepted.popleft()
+            if len(self._accepted) >= self.rpm_limit:
+                self.rate_limited += 1
+                return self.rate_window - (now - self._accepted[0])
+            self._accepted.append(now)
+        return None
+
+    def make_response(self, request_data: dict) -> dict:
+        images = sum(1 for message in request_data.get("messages", []) if isinstance(message.get("content"), list)
+                     for part in message["content"] if part.get("type") == "image_url")
+        content = self.content
+        if images > 1:  # 多页合并请求：按 page_batcher 的分隔标记逐页输出
+            content = "\n\n".join(f"<!-- page {i} -->\n{self.content}" for i in range(1, images + 1))
+        return {
+            "id": f"fake-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request_data.get("model", self.model),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1000, "completion_tokens": 200, "total_tokens": 1200},
+        }
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        self.httpd = http.server.ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.server_thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="假的 OpenAI 兼容服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1235)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--rpm-limit", type=int, default=0, help="每分钟最多接受的请求数，超出返回 429")
+    args = parser.parse_args()
+    server = FakeOpenAIServer(args.host, args.port, args.latency, args.fail_rate, rpm_limit=args.rpm_limit).start()
+    print(f"假服务器已启动: {server.url}")
+    try:
+        server.server_thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+class _Backend:
+    def __init__(self, url: str, pool_size: int):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.outstanding = 0
+        self.healthy = True
+        self.models = None
+
+
+class LocalVLMClient:
+    """
+    本地模型（LM Studio / Ollama 等 OpenAI 兼容服务）客户端：
+    - 每个后端一个 keep-alive 连接池
+    - 在健康的后端中按在途请求数最少路由
+    - 后台定期健康检查
+    - 后端卡住或报错时带抖动的指数退避重试（优先换到其他后端）
+    """
+
+    def __init__(self, backend_urls, timeout: int = 300, connect_timeout: float = 5.0, max_retries: int = 3,
+                 backoff_base: float = 1.0, backoff_max: float = 30.0, health_interval: float = 15.0,
+                 pool_size: int = 8):
+        if isinstance(backend_urls, str):
+            backend_urls = [backend_urls]
+        self.backends = [_Backend(url, pool_size) for url in backend_urls]
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+
+    def check_health(self) -> bool:
+        """检查所有后端，返回是否至少有一个可用"""
+        for backend in self.backends:
+            try:
+                response = backend.session.get(f"{backend.url}/v1/models", timeout=self.connect_timeout)
+                backend.healthy = response.status_code == 200
+                if backend.healthy:
+                    backend.models = response.json()
+            except requests.RequestException:
+                backend.healthy = False
+            if not backend.healthy:
+                logging.warning(f"后端不可用: {backend.url}")
+        return any(b.healthy for b in self.backends)
+
+    def start_health_checks(self):
+        def loop():
+            while not self._stop.wait(self.health_interval):
+                self.check_health()
+
+        self._stop.clear()
+        self._health_thread = threading.Thread(target=loop, daemon=True)
+        self._health_thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._health_thread:
+            self._health_thread.join(timeout=1)
+        for backend in self.backends:
+            backend.session.close()
+
+    def _acquire(self, exclude) -> _Backend:
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy and b not in exclude] \
+                or [b for b in self.backends if b.healthy] \
+                or self.backends  # 全部标记为不可用时仍然尝试，避免健康检查误判导致整体停摆
+            backend = min(candidates, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            return backend
+
+    def _release(self, backend: _Backend):
+        with self._lock:
+            backend.outstanding -= 1
+
+    def _backoff(self, attempt: int, retry_after=None):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def completion(self, request_data: dict) -> dict:
+        """发送一次 chat completion，失败时换后端重试"""
+        tried = set()
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            backend = self._acquire(tried)
+            tried.add(backend)
+            retry_after = None
+            try:
+                response = backend.session.post(f"{backend.url}/v1/chat/completions", json=request_data,
+                                                timeout=(self.connect_timeout, self.timeout))
+                if response.status_code == 429 or response.status_code >= 500:
+                    last_error = BackendUnavailable(f"{backend.url} 返回状态码 {response.status_code}")
+                    header = response.headers.get("Retry-After")
+                    retry_after = float(header) if header and header.isdigit() else None
+                    if response.status_code >= 500:
+                        backend.healthy = False
+                    logging.warning(f"{last_error}（第 {attempt + 1} 次尝试）")
+                else:
+                    response.raise_for_status()
+                    return response.json()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                backend.healthy = False  # 连接失败或卡住，等健康检查恢复
+                last_error = e
+                logging.warning(f"后端 {backend.url} 请求失败: {e}（第 {attempt + 1} 次尝试）")
+            finally:
+                self._release(backend)
+            # 先释放失败的后端再等待，等待期间它的 outstanding 不再偏高；最后一次失败后直接抛出，不再空等
+            if attempt < self.max_retries:
+                self._backoff(attempt, retry_after)
+        raise BackendUnavailable(f"所有重试均失败: {last_error}")
+
+    def stats(self) -> list:
+        return [{"url": b.url, "healthy": b.healthy, "outstanding": b.outstanding} for b in self.backends]
@@ -0,0 +1,170 @@
+"""
+marker 多进程批处理：每个 worker 启动时加载一次 create_model_dict()，
+任务按文件大小从大到小分发，转换结果经有界队列交回父进程统一写盘。
+"""
+import importlib
+import multiprocessing as mp
+import os
+import queue
+import time
+
+from page_selection import marker_convert, output_name, select_pages
+import tracing
+
+_SENTINEL = None
+
+
+def _load_factory(factory: str):
+    """factory 形如 "marker_default:build_converter" """
+    module_name, func_name = factory.split(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def _worker(worker_id, factory, factory_args, threads, job_queue, result_queue, workers=1, page_selection="",
+            current_jobs=None):
+    os.environ["RATE_LIMIT_WORKERS"] = str(workers)  # 各 worker 平分 API 配额（RPM/TPM）
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    start = time.perf_counter()
+    try:
+        converter = _load_factory(factory)(*factory_args)
+    except Exception as e:
+        # 模型加载失败：通知父进程后退出，任务留给其他 worker；所有 worker 都不可用时父进程把剩余文件记为失败
+        result_queue.put(("load_failed", worker_id, str(e)))
+        result_queue.put(("exit", worker_id))
+        return
+    result_queue.put(("ready", worker_id, time.perf_counter() - start))
+    while True:
+        job = job_queue.get()
+        if job is _SENTINEL:
+            break
+        index, pdf_path = job
+        if current_jobs is not None:
+            current_jobs[worker_id] = index  # 共享内存同步写入，worker 被杀时父进程也能知道它正在转换的文件
+        start = time.perf_counter()
+        try:
+            with tracing.document(os.path.basename(pdf_path), worker=worker_id):
+                with tracing.span("marker.convert"):
+                    rendered_output = marker_convert(converter, pdf_path, select_pages(pdf_path, page_selection))
+            pages = len(rendered_output.metadata.get("page_stats", []))
+            result_queue.put(("done", worker_id, pdf_path, rendered_output, pages, time.perf_counter() - start))
+        except Exception as e:
+            result_queue.put(("failed", worker_id, pdf_path, str(e), 0, time.perf_counter() - start))
+    tracing.get_tracer().close()
+    from rate_limiter import close_schedulers
+    close_schedulers()
+    result_queue.put(("exit", worker_id))
+
+
+def run_batch(pdf_files, output_dir, factory, factory_args=(), workers=None, result_queue_size=None, manifest=None,
+              page_selection=""):
+    """
+    多进程转换 pdf_files，父进程负责写出结果，返回每个 worker 的吞吐统计。
+    factory: "模块:函数"，在每个 worker 中调用一次构建 PdfConverter
+    result_queue_size: 结果队列上限，写盘跟不上时 worker 会阻塞，避免内存堆积
+    manifest: 可选的 RunManifest，父进程记录每个文件的状态
+    page_selection: 页面选择表达式（page_selection），worker 只转换选定页面
+    """
+    from marker_gemini import save_results
+
+    workers = workers or max(1, (os.cpu_count() or 1) // 8)
+    workers = min(workers, len(pdf_files)) or 1
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    result_queue_size = result_queue_size or workers * 2
+
+    ctx = mp.get_context("spawn")
+    job_queue = ctx.Queue()
+    result_queue = ctx.Queue(maxsize=result_queue_size)
+
+    # 大文件优先，减少尾部单个大文档拖慢整体的情况
+    for index, pdf_path in sorted(enumerate(pdf_files), key=lambda job: os.path.getsize(job[1]), reverse=True):
+        job_queue.put((index, pdf_path))
+    for _ in range(workers):
+        job_queue.put(_SENTINEL)
+
+    current_jobs = ctx.Array("i", [-1] * workers, lock=False)  # 各 worker 正在转换的文件序号
+    procs = [
+        ctx.Process(target=_worker, args=(i, factory, tuple(factory_args), threads, job_queue, result_queue, workers,
+                                        page_selection, current_jobs))
+        for i in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    print(f"启动 {workers} 个 worker，每个 {threads} 线程")
+
+    stats = {i: {"load_seconds": 0.0, "documents": 0, "failed": 0, "pages": 0, "convert_seconds": 0.0} for i in range(workers)}
+    reported = set()  # 已记录成功或失败的文件
+    load_errors = []
+
+    def record_failure(worker_id, pdf_path, error, seconds):
+        reported.add(pdf_path)
+        stats[worker_id]["failed"] += 1
+        if manifest is not None:
+            manifest.fail(pdf_path, error, seconds)
+        print(f"转换失败 {pdf_path}: {error}")
+
+    alive = set(range(workers))
+    while alive:
+        try:
+            msg = result_queue.get(timeout=5)
+        except queue.Empty:
+            # 被杀掉（如 OOM）的 worker 不会发送 exit，按退出码找出来并把它正在转换的文件记为失败
+            for worker_id in list(alive):
+                exitcode = procs[worker_id].exitcode
+                if exitcode is None:
+                    continue
+                alive.discard(worker_id)
+                print(f"worker {worker_id} 意外退出 (exitcode={exitcode})")
+                index = current_jobs[worker_id]
+                if index >= 0 and pdf_files[index] not in reported:
+                    record_failure(worker_id, pdf_files[index], f"worker {worker_id} 异常退出 (exitcode={exitcode})",
+                                   None)
+            continue
+        kind, worker_id = msg[0], msg[1]
+        if kind == "ready":
+            stats[worker_id]["load_seconds"] = msg[2]
+        elif kind == "load_failed":
+            load_errors.append(msg[2])
+            print(f"worker {worker_id} 加载转换器失败: {msg[2]}")
+        elif kind == "exit":
+            alive.discard(worker_id)
+        else:
+            _, _, pdf_path, payload, pages, seconds = msg
+            worker_stats = stats[worker_id]
+            worker_stats["convert_seconds"] += seconds
+            if kind == "done":
+                try:
+                    fname_base = output_name(os.path.splitext(os.path.basename(pdf_path))[0],
+                                             select_pages(pdf_path, page_selection))  # 试转结果不覆盖整篇输出
+                    with tracing.span("save_results", document=os.path.basename(pdf_path)):
+                        output_path = save_results(payload, output_dir=output_dir, fname_base=fname_base)
+                except Exception as e:
+                    kind, payload = "failed", f"保存结果失败: {e}"
+            if kind == "done":
+                reported.add(pdf_path)
+                worker_stats["documents"] += 1
+                worker_stats["pages"] += pages
+                if manifest is not None:
+                    manifest.finish(pdf_path, [output_path], seconds)
+                print(f"成功处理文件: {pdf_path} (worker {worker_id}, {seconds:.1f}s)")
+            else:
+                record_failure(worker_id, pdf_path, payload, seconds)
+
+    # 所有 worker 都已退出（加载失败或异常退出）时仍留在队列中的文件
+    for pdf_path in pdf_files:
+        if pdf_path not in reported:
+            record_failure(0, pdf_path, f"没有可用的 worker: {load_errors[-1]}" if load_errors else "没有可用的 worker",
+                           None)
+
+    for p in procs:
+        p.join(timeout=10)
+
+    for worker_id, worker_stats in stats.items():
+        busy = worker_stats["convert_seconds"]
+        worker_stats["docs_per_hour"] = round(worker_stats["documents"] * 3600 / busy, 1) if busy else 0.0
+        worker_stats["pages_per_sec"] = round(worker_stats["pages"] / busy, 2) if busy else 0.0
+        print(f"worker {worker_id}: {worker_stats}")
+    return stats
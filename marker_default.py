@@ -1,36 +1,67 @@
 import glob
 import os
-from pathlib import Path
+import time
 from marker.converters.pdf import PdfConverter
 from marker.models import create_model_dict
 from marker_gemini import save_results
+from page_selection import PAGE_SELECTION, marker_convert, output_name, select_pages
+from run_manifest import RunManifest
+import tracing
 
 
-converter = PdfConverter(
-    artifact_dict=create_model_dict(),  # 可传入参数device："cpu", "mps"（mac m系列）, "cuda", "xla"（GPU/CPU/TPU跨平台加速）
-)
+def build_converter():
+    """构建转换器，批处理模式下每个 worker 进程调用一次"""
+    return PdfConverter(
+        artifact_dict=create_model_dict(),  # 可传入参数device："cpu", "mps"（mac m系列）, "cuda", "xla"（GPU/CPU/TPU跨平台加速）
+    )
 
-source = "./input"  # document per local path or URL
-output_dir = "./output/default"
 
-# pdf_files = [os.path.join(source, file) for file in os.listdir(source) if file.endswith(".pdf")]
-pdf_files = glob.glob(os.path.join(source, "*.pdf"))  # 获取所有PDF文件列表
-print(f"找到 {len(pdf_files)} 个PDF文件待处理")
+def main(source="./input", output_dir="./output/default", workers=None, page_selection=PAGE_SELECTION):
+    # source: document per local path or URL
+    # page_selection: 只转换选定页面，如 "1-5,40,100-" 或 "sample=10"，空表示整篇（见 page_selection）
+    workers = workers or max(1, (os.cpu_count() or 1) // 8)  # 并行 worker 数，每个 worker 各自加载一份模型
 
-for pdf_path in pdf_files:  # 遍历所有PDF文件
+    # pdf_files = [os.path.join(source, file) for file in os.listdir(source) if file.endswith(".pdf")]
+    pdf_files = glob.glob(os.path.join(source, "*.pdf"))  # 获取所有PDF文件列表
+    print(f"找到 {len(pdf_files)} 个PDF文件待处理")
 
-    fname_base = os.path.splitext(os.path.basename(pdf_path))[0]
-    output_path = Path(os.path.join(output_dir, fname_base  + ".md"))  # 目标输出路径, 默认转换markdown
+    manifest = RunManifest("marker_default", {"output_dir": output_dir, "page_selection": page_selection})
+    pending = []
+    for pdf_path in pdf_files:  # 遍历所有PDF文件
+        if manifest.is_done(pdf_path):
+            print(f"跳过已处理文件: {pdf_path} (输入未变化)")
+            continue  # 跳过已处理文件
+        pending.append(pdf_path)
 
-    # 🔍 新增检查逻辑
-    if output_path.exists():
-        print(f"跳过已处理文件: {pdf_path} (输出目录已存在)")
-        continue  # 跳过已处理文件
+    if workers > 1 and len(pending) > 1:
+        from marker_batch import run_batch
+        run_batch(pending, output_dir, "marker_default:build_converter", workers=workers, manifest=manifest,
+                  page_selection=page_selection)
+        return
+
+    converter = build_converter()
+    for pdf_path in pending:
+        start = time.perf_counter()
+        manifest.start(pdf_path)
+        try:
+            pages = select_pages(pdf_path, page_selection)
+            fname_base = output_name(os.path.splitext(os.path.basename(pdf_path))[0], pages)  # 试转结果不覆盖整篇输出
+            with tracing.document(os.path.basename(pdf_path), engine="marker_default"):
+                # 执行转换
+                with tracing.span("marker.convert"):
+                    rendered_output = marker_convert(converter, pdf_path, pages)
+                # 保存结果到本地
+                with tracing.span("save_results"):
+                    output_path = save_results(rendered_output, output_dir=output_dir, fname_base=fname_base)
+            manifest.finish(pdf_path, [output_path], time.perf_counter() - start)
+            print(f"成功处理文件: {pdf_path}")
+        except Exception as e:
+            manifest.fail(pdf_path, e, time.perf_counter() - start)
+            print(f"转换失败 {pdf_path}: {str(e)}")
+
+
+if __name__ == "__main__":
     try:
-        # 执行转换
-        rendered_output = converter(pdf_path)
-        # 保存结果到本地
-        save_results(rendered_output, output_dir=output_dir, fname_base=fname_base)
-        print(f"成功处理文件: {pdf_path}")
-    except Exception as e:
-        print(f"转换失败 {pdf_path}: {str(e)}")
\ No newline at end of file
+        main()
+    finally:
+        tracing.get_tracer().close()
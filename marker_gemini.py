@@ -1,6 +1,9 @@
 import glob
 import json
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from marker.converters.pdf import PdfConverter
 from marker.models import create_model_dict
@@ -8,40 +11,64 @@ from marker.config.parser import ConfigParser
 from marker.output import text_from_rendered, convert_if_not_rgb
 from marker.services.gemini import GoogleGeminiService
 from marker.settings import settings
+from page_selection import PAGE_SELECTION, marker_convert, output_name, select_pages
+from rate_limiter import IMAGE_TOKENS, close_schedulers, get_scheduler
+from run_manifest import RunManifest
+import tracing
 from dotenv import load_dotenv
 load_dotenv()
 
 
-def save_results(rendered_output, output_dir="output", fname_base=None):
+IMAGE_EXTENSIONS = {"JPEG": "jpeg", "PNG": "png", "WEBP": "webp"}
+
+
+def _save_image(img, img_path, image_format, image_options):
+    img = convert_if_not_rgb(img)  # 确保图片格式为 RGB
+    img.save(img_path, image_format, **image_options)
+
+
+def save_results(rendered_output, output_dir="output", fname_base=None, image_format=None, image_options=None,
+                 max_workers=None):
     """
     终极优化版 save_results：
     1. 生成文本内容并直接替换图片路径
     2. 文本和元数据只写入一次
-    3. 图片直接保存到 fname_base 子目录
+    3. 图片在线程池中并行编码并保存到 fname_base 子目录
     4. Markdown 文件一次性写入最终结果
+    image_format: 图片格式，默认 settings.OUTPUT_IMAGE_FORMAT，可改为更快的格式（如 "WEBP"）
+    image_options: 传给 PIL save 的编码参数，如 {"quality": 80} 或 {"compress_level": 1}
     """
     # 默认文件名
     fname_base = fname_base or "document"
     image_subdir = Path(os.path.join(output_dir, fname_base, "images"))
+    image_format = image_format or settings.OUTPUT_IMAGE_FORMAT
+    image_options = image_options or {}
 
     # 1️⃣ 生成原始文本内容和图片字典
     raw_text, ext, images = text_from_rendered(rendered_output)
     # print(raw_text[:100], ext, images.keys())
 
-    # 2️⃣ 创建子目录并直接保存图片（同时构建路径映射）
+    # 2️⃣ 创建子目录并在线程池中并行保存图片（PIL 编码时会释放 GIL），同时构建路径映射
     image_subdir.mkdir(parents=True, exist_ok=True)
     path_mapping = {}
-
-    for img_name, img in images.items():
-        img = convert_if_not_rgb(img)  # 确保图片格式为 RGB
-        img_path = os.path.join(image_subdir, img_name)  # 🔥 直接定位到子目录
-        img.save(img_path, settings.OUTPUT_IMAGE_FORMAT)
-        path_mapping[img_name] = os.path.join("images", img_name)  # 构建相对路径映射
-
-    # 3️⃣ 替换原始文本中的图片路径（内存中一次性完成）
+    new_ext = IMAGE_EXTENSIONS.get(image_format.upper())
+    with ThreadPoolExecutor(max_workers=max_workers or min(8, os.cpu_count() or 1)) as pool:
+        futures = []
+        for img_name, img in images.items():
+            new_name = img_name
+            if new_ext and image_format != settings.OUTPUT_IMAGE_FORMAT:
+                new_name = f"{os.path.splitext(img_name)[0]}.{new_ext}"  # 更换格式时同步修改扩展名
+            img_path = os.path.join(image_subdir, new_name)  # 🔥 直接定位到子目录
+            futures.append(pool.submit(_save_image, img, img_path, image_format, image_options))
+            path_mapping[img_name] = os.path.join("images", new_name)  # 构建相对路径映射
+        for future in futures:
+            future.result()
+
+    # 3️⃣ 一次正则扫描替换原始文本中的所有图片路径
     updated_text = raw_text
-    for old, new in path_mapping.items():
-        updated_text = updated_text.replace(f"]({old})", f"]({new})")
+    if path_mapping:
+        pattern = re.compile(r"\]\((" + "|".join(re.escape(name) for name in path_mapping) + r")\)")
+        updated_text = pattern.sub(lambda m: f"]({path_mapping[m.group(1)]})", raw_text)
 
     # 4️⃣ 处理文本编码并一次性保存 Markdown 文件
     encoded_text = updated_text.encode(settings.OUTPUT_ENCODING, errors="replace").decode(settings.OUTPUT_ENCODING)
@@ -54,14 +81,46 @@ def save_results(rendered_output, output_dir="output", fname_base=None):
     with open(meta_path, "w+", encoding=settings.OUTPUT_ENCODING) as f:
         f.write(json.dumps(rendered_output.metadata, indent=2))
 
+    return markdown_path
+
+
+class _ScheduledModels:
+    def __init__(self, models, scheduler):
+        self._models = models
+        self._scheduler = scheduler
+
+    def generate_content(self, **kwargs):
+        contents = kwargs.get("contents") or []
+        tokens = sum(len(c) // 4 if isinstance(c, str) else IMAGE_TOKENS for c in contents)
+        return self._scheduler.call(self._models.generate_content, tokens=tokens,
+                                    usage=lambda r: getattr(r.usage_metadata, "total_token_count", 0) or 0, **kwargs)
+
+
+class _ScheduledClient:
+    def __init__(self, client, scheduler):
+        self._client = client
+        self.models = _ScheduledModels(client.models, scheduler)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
 
-def main():
-    # PDF路径处理
-    # pdf_path = "https://arxiv.org/pdf/2101.03961.pdf"  # url应该先请求文件，再处理
-    pdf_dir = "./input"  # 支持URL或本地路径
-    output_dir = "./output/Gemini"
-    output_format_dict = {"markdown":  "md",  "json": "json", "html": "html"}
-    output_format, output_ext = list(output_format_dict.items())[0]  # 默认输出markdown格式
+
+class ScheduledGeminiService(GoogleGeminiService):
+    """所有 Gemini 调用经过进程内共享的限流调度器（RPM/TPM 令牌桶、AIMD 自适应并发、按 Retry-After 重试）"""
+
+    def get_google_client(self, timeout: int):
+        return _ScheduledClient(super().get_google_client(timeout), get_scheduler("gemini"))
+
+
+OUTPUT_FORMAT_DICT = {"markdown":  "md",  "json": "json", "html": "html"}
+GEMINI_MODEL_NAME = "gemini-2.5-flash-preview-05-20"
+
+
+def build_converter(output_dir="./output/Gemini", output_format="markdown", llm_config=None):
+    """
+    构建带 Gemini 服务的转换器，批处理模式下每个 worker 进程调用一次。
+    llm_config: 覆盖默认 LLM 配置，例如改用 marker.services.openai.OpenAIService 指向本地假服务器做基准测试
+    """
 
     # 配置参数
     config = {
@@ -82,11 +141,12 @@ def main():
 
         # 使用指定的LLM服务
         "use_llm": True,
-        "gemini_model_name": "gemini-2.5-flash-preview-05-20",
-        "llm_service": "marker.services.gemini.GoogleGeminiService",  # 默认值，LLM类
+        "gemini_model_name": GEMINI_MODEL_NAME,
+        "llm_service": "marker_gemini.ScheduledGeminiService",  # GoogleGeminiService + 共享的限流调度
         "gemini_api_key": os.environ.get("GEMINI_API_KEY") or "YOUR_GEMINI_API_KEY",
         # "disable_image_extraction": True,  # 禁用图片提取，会填充LLM理解内容，默认False
     }
+    config.update(llm_config or {})
 
     # 初始化配置解析器
     config_parser = ConfigParser(config)
@@ -123,27 +183,60 @@ def main():
         if not config_parser.get_llm_service():
             print("  Reason: 'llm_service' was not specified or found.")
 
+    return converter
+
+
+def main(pdf_dir="./input", output_dir="./output/Gemini", workers=None, llm_config=None, page_selection=PAGE_SELECTION):
+    # PDF路径处理
+    # pdf_path = "https://arxiv.org/pdf/2101.03961.pdf"  # url应该先请求文件，再处理
+    # pdf_dir: 支持URL或本地路径
+    # page_selection: 只转换选定页面，如 "1-5,40,100-" 或 "sample=10"，空表示整篇（见 page_selection）
+    output_format, output_ext = list(OUTPUT_FORMAT_DICT.items())[0]  # 默认输出markdown格式
+    workers = workers or max(1, (os.cpu_count() or 1) // 8)  # 并行 worker 数，每个 worker 各自加载一份模型
 
     pdf_files = glob.glob(os.path.join(pdf_dir, "*.pdf"))  # 获取所有PDF文件列表
     print(f"找到 {len(pdf_files)} 个PDF文件待处理")
 
+    manifest = RunManifest("marker_gemini", {"output_dir": output_dir, "output_format": output_format,
+                                             "gemini_model_name": GEMINI_MODEL_NAME, "llm_config": llm_config,
+                                             "page_selection": page_selection})
+    pending = []
     for pdf_path in pdf_files:  # 遍历所有PDF文件
-        fname_base = os.path.splitext(os.path.basename(pdf_path))[0]
-        output_path = Path(os.path.join(output_dir, fname_base + "." + output_ext))  # 目标输出路径
-
-        # 🔍 新增检查逻辑
-        if output_path.exists():
-            print(f"跳过已处理文件: {pdf_path} (输出目录已存在)")
+        if manifest.is_done(pdf_path):
+            print(f"跳过已处理文件: {pdf_path} (输入未变化)")
             continue  # 跳过已处理文件
+        pending.append(pdf_path)
+
+    if workers > 1 and len(pending) > 1:
+        from marker_batch import run_batch
+        run_batch(pending, output_dir, "marker_gemini:build_converter", (output_dir, output_format, llm_config),
+                  workers=workers, manifest=manifest, page_selection=page_selection)
+        return
+
+    converter = build_converter(output_dir, output_format, llm_config)
+    for pdf_path in pending:
+        start = time.perf_counter()
+        manifest.start(pdf_path)
         try:
-            # 执行转换
-            rendered_output = converter(pdf_path)
-            # 保存结果到本地
-            save_results(rendered_output, output_dir=output_dir, fname_base=fname_base)
+            pages = select_pages(pdf_path, page_selection)
+            fname_base = output_name(os.path.splitext(os.path.basename(pdf_path))[0], pages)  # 试转结果不覆盖整篇输出
+            with tracing.document(os.path.basename(pdf_path), engine="marker_gemini"):
+                # 执行转换
+                with tracing.span("marker.convert"):
+                    rendered_output = marker_convert(converter, pdf_path, pages)
+                # 保存结果到本地
+                with tracing.span("save_results"):
+                    output_path = save_results(rendered_output, output_dir=output_dir, fname_base=fname_base)
+            manifest.finish(pdf_path, [output_path], time.perf_counter() - start)
             print(f"成功处理文件: {pdf_path}")
         except Exception as e:
+            manifest.fail(pdf_path, e, time.perf_counter() - start)
             print(f"转换失败 {pdf_path}: {str(e)}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        main()
+    finally:
+        tracing.get_tracer().close()
+        close_schedulers()
\ No newline at end of file
@@ -1,13 +1,357 @@
+import gc
 import glob
+import json
+import multiprocessing as mp
 import os
-from pathlib import Path
+import shutil
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import fitz
 from magic_pdf.data.data_reader_writer import FileBasedDataWriter, FileBasedDataReader
 from magic_pdf.data.dataset import PymuDocDataset
 from magic_pdf.model.doc_analyze_by_custom_model import doc_analyze
+try:
+    from magic_pdf.model.doc_analyze_by_custom_model import batch_doc_analyze
+except ImportError:  # magic_pdf 1.3 之前没有批量推理接口，目录模式退回逐文档推理
+    batch_doc_analyze = None
 from magic_pdf.config.enums import SupportedPdfParseMethod
+from magic_pdf.config.make_content_config import DropMode, MakeMode
+from magic_pdf.dict2md.ocr_mkcontent import union_make
+from magic_pdf.libs.version import __version__ as magic_pdf_version
+from page_checkpoint import source_hash
+from page_dedup import PageDedupIndex, page_hashes
+from page_selection import PAGE_SELECTION, describe, extract_pages, output_name, select_pages
+from run_manifest import RunManifest
+import tracing
 
 
-def process_single_pdf(name_without_suff, pdf_file_path, output_dir):
+CHUNK_PAGES = 0  # 大于 0 时按该页数分块处理，峰值内存只与分块大小相关；设置了页面选择（PAGE_SELECTION）时不分块
+# 输出档位：minimal 只输出 markdown；standard 再加 content_list / middle json；
+# debug 再加模型、版面、span 三个可视化 PDF（在独立进程中生成，不占用 markdown 交付时间）
+OUTPUT_PROFILE = "standard"
+OUTPUT_PROFILES = {
+    "minimal": {"md"},
+    "standard": {"md", "content_list", "middle"},
+    "debug": {"md", "content_list", "middle", "debug"},
+}
+# 逐页路由：只有没有可用文本层的页面走 OCR，关闭时由 ds.classify() 对整段统一判断
+PAGE_ROUTING = True
+TEXT_MIN_CHARS = 50  # 页面文本层少于该字符数视为不可用
+GARBLED_MAX_RATIO = 0.1  # 乱码字符比例超过该值视为不可用
+# 跨文档页面去重：与已转换页面相同或相似的页面直接复用保存的页面结构，不再做版面分析/OCR
+PAGE_DEDUP = True  # False 或环境变量 PAGE_DEDUP_BYPASS=1 关闭
+DEDUP_MIN_SIMILARITY = 1.0  # 1.0 只复用完全相同的页面；小于 1.0 开启感知哈希近似匹配（命中后还会逐块比对细节）
+DEDUP_ENGINE = f"minerU_default:{magic_pdf_version}"
+# 目录模式跨文档合并推理：多个文档待推理的页面汇集成一批送入版面/公式/OCR 模型，小文档多时吞吐明显更高
+BATCH_PAGES = 200  # 每批最多页数，0 表示逐文档推理；分块模式（CHUNK_PAGES > 0）下不生效
+AUTO = "auto"  # 不逐页路由时整段由 ds.classify() 判断
+DEDUP = "dedup"  # 去重命中的页面
+route_counts = Counter()  # 本次运行各路由的页数
+page_index = PageDedupIndex(min_similarity=DEDUP_MIN_SIMILARITY, enabled=PAGE_DEDUP)
+
+
+def _draw_debug_pdfs(name, model_list, pdf_bytes, pdf_info, out_dir):
+    """在调试进程中生成模型、版面、span 三个可视化 PDF，只接收可序列化的数据，在本进程内重建数据集"""
+    from magic_pdf.libs.draw_bbox import draw_layout_bbox, draw_model_bbox, draw_span_bbox
+    with tracing.span("draw_model", document=name):
+        draw_model_bbox(model_list, PymuDocDataset(pdf_bytes), out_dir, f"{name}_model.pdf")
+    with tracing.span("draw_layout", document=name):
+        draw_layout_bbox(pdf_info, pdf_bytes, out_dir, f"{name}_layout.pdf")
+    with tracing.span("draw_span", document=name):
+        draw_span_bbox(pdf_info, pdf_bytes, out_dir, f"{name}_spans.pdf")
+
+
+class DebugRenderer:
+    """
+    在独立进程中生成调试 PDF：PyMuPDF 不是线程安全的，绘制不能与主线程打开/渲染下一个文档并行放在同一进程。
+    最多积压 max_pending 个任务，避免结果数据堆积占用内存。
+    """
+
+    def __init__(self, max_pending=2):
+        self._executor = None  # 第一次需要时才启动调试进程
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+
+    def submit(self, name, model_list, pdf_bytes, pdf_info, out_dir):
+        """
+        model_list: 推理结果（infer_result.get_infer_res()）；pdf_bytes: 该分段的 PDF 字节；pdf_info: 已解析的 middle json 页面。
+        数据集持有 fitz 文档无法跨进程传递，只传原始 PDF 字节，由调试进程重建
+        """
+        self._slots.acquire()
+        try:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn"))
+            future = self._executor.submit(_draw_debug_pdfs, name, model_list, pdf_bytes, pdf_info, out_dir)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def wait(self):
+        """等待所有调试 PDF 生成完成"""
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"调试 PDF 生成失败: {str(e)}")
+        self._futures = []
+
+
+debug_renderer = DebugRenderer()
+
+
+def write_outputs(segments, writer, name, image_dir, out_dir, artifacts):
+    """
+    按档位写出结果，每种产物只计算一次。
+    segments 为 [(起始页, infer_result, pipe_result, middle, 分段 PDF 字节)]，按页序拼接；middle 为已解析的 middle json，
+    写入去重索引时已经计算过，为 None 时在这里计算，middle json 和调试 PDF 共用
+    """
+    if artifacts & {"middle", "debug"}:
+        segments = [(start, infer_result, pipe_result,
+                     middle if middle is not None else json.loads(pipe_result.get_middle_json()), data)
+                    for start, infer_result, pipe_result, middle, data in segments]
+    ### markdown
+    with tracing.span("dump_md"):
+        md_content = "\n\n".join(pipe_result.get_markdown(image_dir) for _, _, pipe_result, _, _ in segments)
+        writer.write_string(f"{name}.md", md_content)
+    ### content list
+    if "content_list" in artifacts:
+        with tracing.span("dump_content_list"):
+            content_list = []
+            for start, _, pipe_result, _, _ in segments:
+                content_list.extend(_shift_page_idx(pipe_result.get_content_list(image_dir), start))
+            writer.write_string(f"{name}_content_list.json", json.dumps(content_list, ensure_ascii=False, indent=4))
+    ### middle json
+    if "middle" in artifacts:
+        with tracing.span("dump_middle_json"):
+            if len(segments) == 1:
+                middle_json = json.dumps(segments[0][3], ensure_ascii=False, indent=4)
+            else:
+                pdf_info, parse_types, meta = [], set(), {}
+                for start, _, _, middle, _ in segments:
+                    # 复制页面再改页码，各分段的 middle 仍保持分段内的页码
+                    pdf_info.extend(_shift_page_idx([dict(page) for page in middle.get("pdf_info", [])], start))
+                    meta = {key: value for key, value in middle.items() if key != "pdf_info"}
+                    parse_types.add(meta.get("_parse_type"))
+                meta["_parse_type"] = parse_types.pop() if len(parse_types) == 1 else "mixed"
+                middle_json = json.dumps({"pdf_info": pdf_info, **meta}, ensure_ascii=False, indent=4)
+            writer.write_string(f"{name}_middle.json", middle_json)
+    ### 模型、版面、span 可视化 PDF，后台生成；多段时每段单独一组
+    if "debug" in artifacts:
+        for start, infer_result, _, middle, data in segments:
+            if infer_result is None:
+                continue  # 去重复用的页面没有推理结果
+            suffix = f"_from_p{start + 1}" if len(segments) > 1 else ""
+            debug_renderer.submit(f"{name}{suffix}", infer_result.get_infer_res(), data, middle["pdf_info"], out_dir)
+
+
+def _page_has_text_layer(page):
+    """页面是否有可用的文本层：字符足够多且乱码比例低"""
+    text = "".join(page.get_text("text").split())
+    if len(text) < TEXT_MIN_CHARS:
+        return False
+    garbled = sum(1 for ch in text if ch == "\ufffd" or not ch.isprintable())
+    return garbled / len(text) < GARBLED_MAX_RATIO
+
+
+def classify_pages(pdf_doc):
+    """逐页判断解析方式：有可用文本层走 TXT，否则有图像内容走 OCR；空白页返回 None，跟随相邻页段"""
+    methods = []
+    for page in pdf_doc:
+        if _page_has_text_layer(page):
+            methods.append(SupportedPdfParseMethod.TXT)
+        elif page.get_images(full=False):
+            methods.append(SupportedPdfParseMethod.OCR)
+        else:
+            methods.append(None)
+    return methods
+
+
+def route_segments(methods):
+    """把逐页解析方式合并为连续页段 [(起始页, 结束页, 解析方式)]，空白页并入前一段，避免无谓的拆分"""
+    segments = []
+    for page_idx, method in enumerate(methods):
+        if segments and (segments[-1][2] == method or (method is None and segments[-1][2] != DEDUP)):
+            segments[-1][1] = page_idx
+        else:
+            segments.append([page_idx, page_idx, method])
+    # 开头的空白页段并入后一段，全是空白页时按文本层解析
+    if len(segments) > 1 and segments[0][2] is None and segments[1][2] != DEDUP:
+        segments[1][0] = 0
+        segments.pop(0)
+    if segments and segments[0][2] is None:
+        segments[0][2] = SupportedPdfParseMethod.TXT
+    return [tuple(seg) for seg in segments]
+
+
+def analyze_dataset(ds, image_writer, parse_method=None):
+    """对数据集做推理并进入对应的解析流水线，parse_method 为空时整份文档自动判断"""
+    if parse_method is None:
+        with tracing.span("ds.classify"):
+            parse_method = ds.classify()
+    ocr = parse_method == SupportedPdfParseMethod.OCR
+    with tracing.span("doc_analyze", ocr=ocr, pages=len(ds)):
+        infer_result = ds.apply(doc_analyze, ocr=ocr)
+    return infer_result, run_pipeline(infer_result, len(ds), image_writer, parse_method)
+
+
+def run_pipeline(infer_result, pages, image_writer, parse_method):
+    """推理结果进入 OCR / 文本层解析流水线"""
+    ## pipeline
+    if parse_method == SupportedPdfParseMethod.OCR:
+        with tracing.span("pipe_ocr_mode", pages=pages):
+            return infer_result.pipe_ocr_mode(image_writer)
+    with tracing.span("pipe_txt_mode", pages=pages):
+        return infer_result.pipe_txt_mode(image_writer)
+
+
+class StoredPages:
+    """去重命中的连续页面：用索引中保存的 middle json 页面结构生成输出，接口与 PipeResult 一致"""
+
+    def __init__(self, page_infos):
+        self.pdf_info = [dict(info, page_idx=i) for i, info in enumerate(page_infos)]
+
+    def get_markdown(self, image_dir):
+        return union_make(self.pdf_info, MakeMode.MM_MD, DropMode.NONE, image_dir)
+
+    def get_content_list(self, image_dir):
+        return union_make(self.pdf_info, MakeMode.STANDARD_FORMAT, DropMode.NONE, image_dir)
+
+    def get_middle_json(self):
+        return json.dumps({"pdf_info": self.pdf_info, "_parse_type": DEDUP, "_version_name": magic_pdf_version},
+                          ensure_ascii=False, indent=4)
+
+
+def _image_paths(node):
+    """遍历页面结构中引用的图片文件名"""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "image_path" and value:
+                yield value
+            else:
+                yield from _image_paths(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _image_paths(value)
+
+
+def _restore_page(payload, local_image_dir):
+    """把复用页面引用的图片复制到当前文档的 images 目录，源图片已不存在时返回 None（按未命中处理）"""
+    for image_path in set(_image_paths(payload["page_info"])):
+        dst = os.path.join(local_image_dir, image_path)
+        if os.path.exists(dst):
+            continue
+        src = os.path.join(payload["image_dir"], image_path)
+        if not os.path.exists(src):
+            return None
+        shutil.copyfile(src, dst)
+    return payload["page_info"]
+
+
+def _remember_pages(pdf_info, hashes, start, local_image_dir):
+    """把新解析页面的结构（middle json 的 pdf_info）写入去重索引"""
+    for offset, page_info in enumerate(pdf_info):
+        exact, phash, detail = hashes[start + offset]
+        page_index.put(DEDUP_ENGINE, exact, phash, detail,
+                       {"page_info": page_info, "image_dir": os.path.abspath(local_image_dir)})
+
+
+def _remember_segment(pipe_result, hashes, start, local_image_dir):
+    """开启去重时计算分段的 middle json 并写入去重索引，返回解析后的 middle 供写出结果复用；未开启时返回 None"""
+    if not hashes:
+        return None
+    middle = json.loads(pipe_result.get_middle_json())
+    _remember_pages(middle.get("pdf_info", []), hashes, start, local_image_dir)
+    return middle
+
+
+def plan_pdf(pdf_bytes, local_image_dir, name=""):
+    """
+    推理前的准备：逐页路由和去重查找，返回 (分段, 页面哈希)。
+    分段为按页序排列的 [(起始页, 解析方式, 数据集, 分段 PDF 字节)]，去重命中的分段解析方式为 DEDUP、数据集位置为 StoredPages，
+    其余分段的解析方式已确定为 OCR 或 TXT。全文档只有一种路由时不拆分。
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_doc:
+        page_count = pdf_doc.page_count
+        with tracing.span("classify_pages", pages=page_count):
+            methods = classify_pages(pdf_doc) if PAGE_ROUTING else [AUTO] * page_count
+
+        stored, hashes = {}, []
+        if page_index.enabled:
+            with tracing.span("dedup_lookup", pages=page_count):
+                hashes = page_hashes(pdf_doc)
+                for page_idx, (exact, phash, detail) in enumerate(hashes):
+                    payload = page_index.lookup(DEDUP_ENGINE, exact, phash, detail)
+                    page_info = _restore_page(payload, local_image_dir) if payload is not None else None
+                    if page_info is not None:
+                        stored[page_idx] = page_info
+                        methods[page_idx] = DEDUP
+
+        segments = route_segments(methods)
+        pages_by_route = Counter()
+        for start, end, method in segments:
+            pages_by_route[{SupportedPdfParseMethod.OCR: "ocr", DEDUP: "dedup", AUTO: "auto"}.get(method, "txt")] += end - start + 1
+        route_counts.update(pages_by_route)
+        if pages_by_route["ocr"] or pages_by_route["dedup"]:
+            print(f"{name}: {pages_by_route['txt']} 页走文本层，{pages_by_route['ocr']} 页走 OCR，"
+                  f"{pages_by_route['dedup']} 页复用已有结果，共 {len(segments)} 段")
+
+        jobs = []
+        for start, end, method in segments:
+            if method == DEDUP:
+                jobs.append((start, DEDUP, StoredPages([stored[i] for i in range(start, end + 1)]), None))
+                continue
+            if len(segments) == 1:
+                data = pdf_bytes
+            else:
+                segment_doc = fitz.open()
+                segment_doc.insert_pdf(pdf_doc, from_page=start, to_page=end)
+                data = segment_doc.tobytes()
+                segment_doc.close()
+            ds = PymuDocDataset(data)
+            if method == AUTO:
+                with tracing.span("ds.classify"):
+                    method = ds.classify()
+            jobs.append((start, method, ds, data))
+        return jobs, hashes
+
+
+def analyze_pdf(pdf_bytes, local_image_dir, name=""):
+    """
+    逐页路由：去重命中的页面直接复用保存的结果，没有可用文本层的页面走 OCR，其余页面走文本层解析，
+    返回按页序排列的分段结果 [(起始页, infer_result, pipe_result, middle, 分段 PDF 字节)]，middle 在写入去重索引时计算，否则为 None。
+    """
+    image_writer = FileBasedDataWriter(local_image_dir)
+    jobs, hashes = plan_pdf(pdf_bytes, local_image_dir, name)
+    results = []
+    for start, method, ds, data in jobs:
+        if method == DEDUP:
+            results.append((start, None, ds, None, None))
+            continue
+        with tracing.span("route_segment", first_page=start, last_page=start + len(ds) - 1, method=str(method)):
+            infer_result, pipe_result = analyze_dataset(ds, image_writer, method)
+        results.append((start, infer_result, pipe_result, _remember_segment(pipe_result, hashes, start, local_image_dir),
+                        data))
+    return results
+
+
+def _read_selected(pdf_file_path, pages, name):
+    """读取 PDF 字节；pages 为选定的页码列表时只取这些页面组成的子文档，未选中的页面不做版面分析/OCR"""
+    if not pages:
+        return FileBasedDataReader("").read(pdf_file_path)
+    print(f"{name}: 只转换第 {describe(pages)} 页")
+    return extract_pages(pdf_file_path, pages)
+
+
+def process_single_pdf(name_without_suff, pdf_file_path, output_dir, profile=OUTPUT_PROFILE,
+                       page_selection=PAGE_SELECTION):
+    """转换单个文档，返回 Markdown 路径；试转结果按所选页码单独命名，不覆盖整篇转换的输出"""
+    pages = select_pages(pdf_file_path, page_selection)
+    name_without_suff = output_name(name_without_suff, pages)
+
     # prepare env
     local_image_dir, local_md_dir = os.path.join(output_dir, name_without_suff, "images"), os.path.join(output_dir,
                                                                                                         name_without_suff)
@@ -16,73 +360,318 @@ def process_single_pdf(name_without_suff, pdf_file_path, output_dir):
     os.makedirs(local_image_dir, exist_ok=True)
 
     # prepare writer
-    image_writer, md_writer = FileBasedDataWriter(local_image_dir), FileBasedDataWriter(local_md_dir)
+    md_writer = FileBasedDataWriter(local_md_dir)
 
-    # read bytes
-    reader1 = FileBasedDataReader("")
-    pdf_bytes = reader1.read(pdf_file_path)  # read the pdf content
+    # read bytes（只含选定页面）
+    pdf_bytes = _read_selected(pdf_file_path, pages, name_without_suff)  # read the pdf content
 
     # proc
-    ## Create Dataset Instance
-    ds = PymuDocDataset(pdf_bytes)
-
-    ## inference
-    if ds.classify() == SupportedPdfParseMethod.OCR:
-        infer_result = ds.apply(doc_analyze, ocr=True)
-        ## pipeline
-        pipe_result = infer_result.pipe_ocr_mode(image_writer)
-    else:
-        infer_result = ds.apply(doc_analyze, ocr=False)
-        ## pipeline
-        pipe_result = infer_result.pipe_txt_mode(image_writer)
-
-    ### draw model result on each page
-    infer_result.draw_model(os.path.join(local_md_dir, f"{name_without_suff}_model.pdf"))
-
-    ### get model inference result
-    model_inference_result = infer_result.get_infer_res()
-    ### draw layout result on each page
-    pipe_result.draw_layout(os.path.join(local_md_dir, f"{name_without_suff}_layout.pdf"))
-    ### draw spans result on each page
-    pipe_result.draw_span(os.path.join(local_md_dir, f"{name_without_suff}_spans.pdf"))
-
-    ### get markdown content
-    md_content = pipe_result.get_markdown(image_dir)
-    ### dump markdown
-    pipe_result.dump_md(md_writer, f"{name_without_suff}.md", image_dir)
-
-    ### get content list content
-    content_list_content = pipe_result.get_content_list(image_dir)
-    ### dump content list
-    pipe_result.dump_content_list(md_writer, f"{name_without_suff}_content_list.json", image_dir)
-
-    ### get middle json
-    middle_json_content = pipe_result.get_middle_json()
-    ### dump middle json
-    pipe_result.dump_middle_json(md_writer, f'{name_without_suff}_middle.json')
-
-
-def process_pdf_folder(input_dir, output_dir):
+    ## inference（逐页路由到 OCR / 文本层解析）
+    segments = analyze_pdf(pdf_bytes, local_image_dir, name_without_suff)
+
+    write_outputs(segments, md_writer, name_without_suff, image_dir, local_md_dir, OUTPUT_PROFILES[profile])
+    return os.path.join(local_md_dir, f"{name_without_suff}.md")
+
+
+def _shift_page_idx(items, offset):
+    for item in items:
+        if "page_idx" in item:
+            item["page_idx"] += offset
+    return items
+
+
+def _prepare_chunk_dir(chunk_dir, pdf_file_path, chunk_pages, profile):
+    """
+    chunks 目录中的 _header.json 记录源文件哈希和影响分块结果的配置，不一致时（同名文件内容变化、改了分块大小/路由/去重/档位）
+    整个目录作废重建，避免把旧文件的分块拼进新输出
+    """
+    header = {"source_sha256": source_hash(pdf_file_path),
+              "config": {"chunk_pages": chunk_pages, "profile": profile, "page_routing": PAGE_ROUTING,
+                         "text_min_chars": TEXT_MIN_CHARS, "garbled_max_ratio": GARBLED_MAX_RATIO,
+                         "page_dedup": page_index.enabled, "dedup_min_similarity": DEDUP_MIN_SIMILARITY,
+                         "magic_pdf": magic_pdf_version}}
+    header_path = os.path.join(chunk_dir, "_header.json")
+    if os.path.isdir(chunk_dir):
+        try:
+            with open(header_path, encoding="utf-8") as f:
+                matched = json.load(f) == header
+        except (OSError, ValueError):
+            matched = False
+        if matched:
+            return
+        print(f"{chunk_dir} 与当前输入或配置不一致，重新分块")
+        shutil.rmtree(chunk_dir)
+    os.makedirs(chunk_dir)
+    with open(header_path, "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False)
+
+
+def process_single_pdf_chunked(name_without_suff, pdf_file_path, output_dir, chunk_pages=50, profile=OUTPUT_PROFILE):
+    """
+    按页范围分块处理大文件：每块完成后立即把 markdown / content_list / middle json 写到 chunks 目录，
+    全部完成后再按输出档位拼接成最终文件并删除 chunks 目录。中断后重跑时复用源文件和配置都未变化的分块结果。
+    """
+    artifacts = OUTPUT_PROFILES[profile]
+    local_image_dir, local_md_dir = os.path.join(output_dir, name_without_suff, "images"), os.path.join(output_dir,
+                                                                                                        name_without_suff)
+    chunk_dir = os.path.join(local_md_dir, "chunks")
+    image_dir = str(os.path.basename(local_image_dir))
+    os.makedirs(local_image_dir, exist_ok=True)
+    _prepare_chunk_dir(chunk_dir, pdf_file_path, chunk_pages, profile)
+    chunk_writer = FileBasedDataWriter(chunk_dir)
+
+    # 只打开文件句柄，不把整个 PDF 读进内存
+    src = fitz.open(pdf_file_path)
+    page_count = src.page_count
+    chunks = []
+    for start in range(0, page_count, chunk_pages):
+        end = min(start + chunk_pages, page_count) - 1
+        chunk_name = f"{name_without_suff}_p{start + 1:05d}-{end + 1:05d}"
+        chunks.append((start, chunk_name))
+        if os.path.exists(os.path.join(chunk_dir, f"{chunk_name}_middle.json")):
+            continue  # 该分块已完成（中断后重跑）
+
+        chunk_doc = fitz.open()
+        chunk_doc.insert_pdf(src, from_page=start, to_page=end)
+        chunk_bytes = chunk_doc.tobytes()
+        chunk_doc.close()
+
+        with tracing.span("chunk", first_page=start, last_page=end):
+            segments = analyze_pdf(chunk_bytes, local_image_dir, chunk_name)
+        # 分块总是写出全部三种结果（middle json 最后写，作为分块完成的标记），调试 PDF 按档位决定，写到文档目录
+        write_outputs(segments, chunk_writer, chunk_name, image_dir, local_md_dir,
+                      {"md", "content_list", "middle"} | (artifacts & {"debug"}))
+        print(f"{name_without_suff}: 第 {start + 1}-{end + 1}/{page_count} 页已完成")
+
+        del chunk_bytes, segments
+        gc.collect()
+    src.close()
+
+    # 拼接各分块结果，逐块读取以保持内存有界
+    with open(os.path.join(local_md_dir, f"{name_without_suff}.md"), "w", encoding="utf-8") as md_file:
+        for i, (start, chunk_name) in enumerate(chunks):
+            with open(os.path.join(chunk_dir, f"{chunk_name}.md"), encoding="utf-8") as f:
+                if i:
+                    md_file.write("\n\n")
+                shutil.copyfileobj(f, md_file)
+
+    if "content_list" in artifacts:
+        with open(os.path.join(local_md_dir, f"{name_without_suff}_content_list.json"), "w", encoding="utf-8") as cl_file:
+            cl_file.write("[")
+            first_item = True
+            for start, chunk_name in chunks:
+                with open(os.path.join(chunk_dir, f"{chunk_name}_content_list.json"), encoding="utf-8") as f:
+                    for item in _shift_page_idx(json.load(f), start):
+                        cl_file.write(("" if first_item else ",") + json.dumps(item, ensure_ascii=False))
+                        first_item = False
+            cl_file.write("]")
+
+    if "middle" in artifacts:
+        with open(os.path.join(local_md_dir, f"{name_without_suff}_middle.json"), "w", encoding="utf-8") as mid_file:
+            mid_file.write('{"pdf_info": [')
+            first_page, middle_meta = True, {}
+            for start, chunk_name in chunks:
+                with open(os.path.join(chunk_dir, f"{chunk_name}_middle.json"), encoding="utf-8") as f:
+                    middle = json.load(f)
+                for page in _shift_page_idx(middle.pop("pdf_info", []), start):
+                    mid_file.write(("" if first_page else ",") + json.dumps(page, ensure_ascii=False))
+                    first_page = False
+                middle_meta = middle
+            mid_file.write("]")
+            for key, value in middle_meta.items():
+                mid_file.write(f", {json.dumps(key)}: {json.dumps(value, ensure_ascii=False)}")
+            mid_file.write("}")
+    shutil.rmtree(chunk_dir)  # 拼接完成后分块结果不再需要
+
+
+class _PendingDocument:
+    """合并推理模式下等待推理结果的文档"""
+
+    def __init__(self, pdf_path, output_dir, page_selection=PAGE_SELECTION):
+        self.pdf_path = pdf_path
+        self.pages = select_pages(pdf_path, page_selection)
+        self.name = output_name(os.path.splitext(os.path.basename(pdf_path))[0], self.pages)  # 试转结果不覆盖整篇输出
+        self.local_md_dir = os.path.join(output_dir, self.name)
+        self.local_image_dir = os.path.join(self.local_md_dir, "images")
+        self.output_path = os.path.join(self.local_md_dir, self.name + ".md")
+        self.started = time.perf_counter()
+        self.jobs, self.hashes = [], []
+        self.infer_results = {}  # 分段序号 -> infer_result
+        self.error = None
+
+    def plan(self):
+        os.makedirs(self.local_image_dir, exist_ok=True)
+        pdf_bytes = _read_selected(self.pdf_path, self.pages, self.name)
+        with tracing.document(os.path.basename(self.pdf_path), engine="minerU_default"):
+            self.jobs, self.hashes = plan_pdf(pdf_bytes, self.local_image_dir, self.name)
+
+    def pending(self):
+        """[(分段序号, 解析方式, 数据集)]，去重命中的分段不需要推理"""
+        return [(i, method, ds) for i, (_, method, ds, _) in enumerate(self.jobs) if method != DEDUP]
+
+    @property
+    def ready(self):
+        return self.error is not None or len(self.infer_results) == len(self.pending())
+
+    def finish(self, profile):
+        """推理结果分回各分段的解析流水线，写出结果"""
+        image_writer = FileBasedDataWriter(self.local_image_dir)
+        with tracing.document(os.path.basename(self.pdf_path), engine="minerU_default"):
+            segments = []
+            for i, (start, method, ds, data) in enumerate(self.jobs):
+                if method == DEDUP:
+                    segments.append((start, None, ds, None, None))
+                    continue
+                infer_result = self.infer_results[i]
+                pipe_result = run_pipeline(infer_result, len(ds), image_writer, method)
+                segments.append((start, infer_result, pipe_result,
+                                 _remember_segment(pipe_result, self.hashes, start, self.local_image_dir), data))
+            write_outputs(segments, FileBasedDataWriter(self.local_md_dir), self.name,
+                          os.path.basename(self.local_image_dir), self.local_md_dir, OUTPUT_PROFILES[profile])
+
+
+class CrossDocumentBatcher:
+    """
+    跨文档合并推理：各文档待推理的分段按解析方式（OCR / 文本层）分别汇集，攒满 batch_pages 页后
+    用 batch_doc_analyze 一次推理，结果按分段分回各文档，文档的所有分段都有结果后进入 pipe_*_mode 并写出。
+    """
+
+    def __init__(self, batch_pages, profile, manifest):
+        self.batch_pages = batch_pages
+        self.profile = profile
+        self.manifest = manifest
+        self.pools = {SupportedPdfParseMethod.OCR: [], SupportedPdfParseMethod.TXT: []}  # [(文档, 分段序号, 数据集)]
+        self.documents = []
+        self.infer_pages = 0
+        self.infer_seconds = 0.0
+        self.batches = 0
+        # batch_doc_analyze 内部按该环境变量切分批次，与这里的批大小保持一致
+        os.environ["MINERU_MIN_BATCH_INFERENCE_SIZE"] = str(batch_pages)
+
+    @staticmethod
+    def _pool_pages(pool):
+        return sum(len(ds) for _, _, ds in pool)
+
+    def add(self, doc: _PendingDocument):
+        self.documents.append(doc)
+        for index, method, ds in doc.pending():
+            if self.pools[method] and self._pool_pages(self.pools[method]) + len(ds) > self.batch_pages:
+                self.flush(method)
+            self.pools[method].append((doc, index, ds))
+            if self._pool_pages(self.pools[method]) >= self.batch_pages:
+                self.flush(method)
+        self._finish_ready()
+
+    def flush(self, method=None):
+        """推理指定解析方式（默认全部）已汇集的分段"""
+        for parse_method in ([method] if method is not None else list(self.pools)):
+            pool, self.pools[parse_method] = self.pools[parse_method], []
+            if not pool:
+                continue
+            ocr = parse_method == SupportedPdfParseMethod.OCR
+            pages = self._pool_pages(pool)
+            documents = {id(doc) for doc, _, _ in pool}
+            start = time.perf_counter()
+            try:
+                with tracing.span("batch_doc_analyze", ocr=ocr, pages=pages, documents=len(documents)):
+                    infer_results = batch_doc_analyze([ds for _, _, ds in pool], "ocr" if ocr else "txt")
+            except Exception as e:
+                print(f"合并推理失败（{len(documents)} 个文档），这些文档改为逐文档推理: {str(e)}")
+                for doc, index, ds in pool:
+                    if doc.error is not None:
+                        continue
+                    try:
+                        doc.infer_results[index] = ds.apply(doc_analyze, ocr=ocr)
+                    except Exception as doc_error:
+                        doc.error = doc_error
+            else:
+                for (doc, index, _), infer_result in zip(pool, infer_results):
+                    doc.infer_results[index] = infer_result
+            self.infer_pages += pages
+            self.infer_seconds += time.perf_counter() - start
+            self.batches += 1
+            print(f"合并推理 {len(documents)} 个文档共 {pages} 页（{'OCR' if ocr else '文本层'}），"
+                  f"耗时 {time.perf_counter() - start:.1f}s")
+        self._finish_ready()
+
+    def _finish_ready(self):
+        remaining = []
+        for doc in self.documents:
+            if not doc.ready:
+                remaining.append(doc)
+                continue
+            try:
+                if doc.error is not None:
+                    raise doc.error
+                doc.finish(self.profile)
+                self.manifest.finish(doc.pdf_path, [doc.output_path], time.perf_counter() - doc.started)
+                print(f"成功处理文件: {doc.pdf_path}")
+            except Exception as e:
+                self.manifest.fail(doc.pdf_path, e, time.perf_counter() - doc.started)
+                print(f"转换失败 {doc.pdf_path}: {str(e)}")
+        self.documents = remaining
+
+    def close(self):
+        self.flush()
+        if self.infer_seconds:
+            print(f"合并推理统计: {self.batches} 批 {self.infer_pages} 页，"
+                  f"{self.infer_pages / self.infer_seconds:.2f} 页/秒")
+
+
+def process_pdf_folder(input_dir, output_dir, profile=OUTPUT_PROFILE):
     pdf_files = glob.glob(os.path.join(input_dir, "*.pdf"))  # 获取所有PDF文件列表
     print(f"找到 {len(pdf_files)} 个PDF文件待处理")
 
+    manifest = RunManifest("minerU_default", {"output_dir": output_dir, "profile": profile,
+                                              "page_selection": PAGE_SELECTION})
+    chunked = CHUNK_PAGES > 0 and not PAGE_SELECTION  # 试转只有少量页面，不需要分块
+    batcher = None
+    if BATCH_PAGES > 0 and not chunked:
+        if batch_doc_analyze is not None:
+            batcher = CrossDocumentBatcher(BATCH_PAGES, profile, manifest)
+        else:
+            print("当前 magic_pdf 版本没有 batch_doc_analyze，逐文档推理")
     for pdf_path in pdf_files:  # 遍历所有PDF文件
         fname_base = os.path.splitext(os.path.basename(pdf_path))[0]
-        output_path = Path(os.path.join(output_dir, fname_base, fname_base + ".md"))  # 目标输出路径
 
-        # 🔍 新增检查逻辑
-        if output_path.exists():
-            print(f"跳过已处理文件: {pdf_path} (输出目录已存在)")
+        if manifest.is_done(pdf_path):
+            print(f"跳过已处理文件: {pdf_path} (输入未变化)")
             continue  # 跳过已处理文件
+        start = time.perf_counter()
+        manifest.start(pdf_path)
         try:
-            process_single_pdf(fname_base, pdf_path, output_dir)
+            if batcher is not None:
+                doc = _PendingDocument(pdf_path, output_dir)
+                doc.plan()
+                batcher.add(doc)  # 攒满一批后推理，完成的文档在批处理器中写出并记录
+                continue
+            with tracing.document(os.path.basename(pdf_path), engine="minerU_default"):
+                if chunked:
+                    process_single_pdf_chunked(fname_base, pdf_path, output_dir, CHUNK_PAGES, profile)
+                    output_path = os.path.join(output_dir, fname_base, fname_base + ".md")
+                else:
+                    output_path = process_single_pdf(fname_base, pdf_path, output_dir, profile)
+            manifest.finish(pdf_path, [output_path], time.perf_counter() - start)
             print(f"成功处理文件: {pdf_path}")
         except Exception as e:
+            manifest.fail(pdf_path, e, time.perf_counter() - start)
             print(f"转换失败 {pdf_path}: {str(e)}")
+    if batcher is not None:
+        batcher.close()
+
+    # 等待后台调试 PDF 全部生成
+    debug_renderer.wait()
+    if route_counts:
+        print(f"页面路由统计（页数）: {dict(route_counts)}")
+    if page_index.enabled:
+        print(f"页面去重统计: {page_index.stats()}")
 
 
 if __name__ == '__main__':
     input_dir = "./input"
     output_dir = "./output/minerU"
 
-    process_pdf_folder(input_dir, output_dir)
\ No newline at end of file
+    try:
+        process_pdf_folder(input_dir, output_dir)
+    finally:
+        tracing.get_tracer().close()
\ No newline at end of file
@@ -0,0 +1,242 @@
+"""
+多页合并请求：把同一配置（model/prompt/参数）下并发到达的单页 VLM 请求攒成一批，
+一次请求发送多张页面图片，只重复一次长提示词，要求模型在每页输出前写分隔行，再按分隔行拆回各页结果。
+拆分失败（页数不符、输出被截断）时整批退回逐页请求。截断按上游响应的 finish_reason == "length" 判断，
+截断发生在最后一页中间时分隔行仍然齐全，不能只靠拆分结果判断。
+
+python page_batcher.py 用截断的假响应自检退回逐页请求的逻辑。
+"""
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import re
+import threading
+import time
+
+PAGE_MARKER = "<!-- page {} -->"
+_PAGE_MARKER = re.compile(r"^[ \t]*<!--\s*page\s+(\d+)\s*-->[ \t]*$", re.MULTILINE | re.IGNORECASE)
+BATCH_INSTRUCTION = (
+    "下面依次给出 {n} 张连续的文档页面图片。请对每一页分别完成要求的转换，"
+    "并在每一页的输出之前单独一行写出分隔标记 {example}（页码从 1 到 {n}），不要遗漏或合并页面。"
+)
+
+
+def split_pages(content: str, count: int):
+    """按分隔行把合并输出拆成 count 页，分隔标记缺失、重复或乱序时返回 None"""
+    matches = list(_PAGE_MARKER.finditer(content or ""))
+    if [int(m.group(1)) for m in matches] != list(range(1, count + 1)):
+        return None
+    if content[:matches[0].start()].strip():  # 第一个分隔行前有正文，无法确定归属
+        return None
+    pages = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(content)
+        pages.append(content[match.end():end].strip("\n"))
+    return pages
+
+
+def _split_request(request_data: dict):
+    """拆出单页请求中的 (提示词文本列表, 图片部分)，不是单图请求时返回 None"""
+    texts, images = [], []
+    for message in request_data.get("messages", []):
+        if message.get("role", "user") != "user":
+            return None
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                images.append(part)
+            elif part.get("type") == "text":
+                texts.append(part.get("text", ""))
+    return (texts, images[0]) if len(images) == 1 else None
+
+
+class _Batch:
+    def __init__(self, key):
+        self.key = key
+        self.items = []  # [(请求, 图片部分)]
+        self.results = []
+        self.error = None
+        self.created = time.monotonic()
+        self.closed = False
+        self.done = threading.Event()
+
+
+class PageBatcher:
+    """
+    代理内的页面攒批器：第一个到达的请求作为发起者，等待最多 max_wait 秒或攒满 pages_per_request 页后发出合并请求，
+    其他请求等待结果。合并请求的结果按页拆成普通的单页响应，缓存和页面去重仍按页生效。
+    """
+
+    def __init__(self, pages_per_request: int = 4, max_wait: float = 0.3, max_output_tokens: int = 65536):
+        """
+        pages_per_request: 每个合并请求最多包含的页数，1 表示不合并
+        max_wait: 发起者等待其他页面加入的最长时间（秒）
+        max_output_tokens: 合并请求的 max_tokens 上限（单页 max_tokens × 页数，不超过模型输出上限）
+        """
+        self.pages_per_request = pages_per_request
+        self.max_wait = max_wait
+        self.max_output_tokens = max_output_tokens
+        self._open = {}  # 配置 key -> 正在攒的批次
+        self._cond = threading.Condition()
+        self.counts = {"batches": 0, "batched_pages": 0, "fallback_batches": 0, "single_pages": 0,
+                       "upstream_requests": 0, "tokens": 0}
+        self._first_submit = None
+        self._last_done = None
+
+    @staticmethod
+    def batch_key(request_data: dict, texts) -> str:
+        params = {k: v for k, v in request_data.items() if k != "messages"}
+        return repr((sorted(params.items()), texts))
+
+    def submit(self, request_data: dict, completion) -> dict:
+        """提交单页请求，返回该页的 OpenAI 格式响应；completion 为实际的上游调用（已包含并发和限流控制）"""
+        with self._cond:
+            if self._first_submit is None:
+                self._first_submit = time.perf_counter()
+        parts = _split_request(request_data) if self.pages_per_request > 1 else None
+        if parts is None:
+            return self._single(request_data, completion)
+        texts, image = parts
+        key = self.batch_key(request_data, texts)
+        with self._cond:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _Batch(key)
+            index = len(batch.items)
+            batch.items.append((request_data, image))
+            if len(batch.items) >= self.pages_per_request:
+                self._close(batch)
+            if leader:
+                deadline = batch.created + self.max_wait
+                while not batch.closed and time.monotonic() < deadline:
+                    self._cond.wait(timeout=deadline - time.monotonic())
+                self._close(batch)
+        if leader:
+            self._run(batch, texts, completion)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def _close(self, batch: _Batch):
+        """调用方需持有 self._cond"""
+        if not batch.closed:
+            batch.closed = True
+            if self._open.get(batch.key) is batch:
+                del self._open[batch.key]
+            self._cond.notify_all()
+
+    def _single(self, request_data: dict, completion) -> dict:
+        result = completion(request_data)
+        with self._cond:
+            self.counts["single_pages"] += 1
+            self.counts["upstream_requests"] += 1
+            self.counts["tokens"] += (result.get("usage") or {}).get("total_tokens", 0)
+            self._last_done = time.perf_counter()
+        return result
+
+    def _run(self, batch: _Batch, texts, completion):
+        try:
+            if len(batch.items) == 1:
+                batch.results = [self._single(batch.items[0][0], completion)]
+            else:
+                batch.results = self._run_batch(batch, texts, completion)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def build_request(self, batch: _Batch, texts) -> dict:
+        """以第一页请求为模板构造多图请求：提示词只出现一次，每张图前标注页码"""
+        template = batch.items[0][0]
+        count = len(batch.items)
+        content = [{"type": "text", "text": "\n".join(texts)},
+                   {"type": "text", "text": BATCH_INSTRUCTION.format(n=count, example=PAGE_MARKER.format(1))}]
+        for i, (_, image) in enumerate(batch.items, 1):
+            content.append({"type": "text", "text": PAGE_MARKER.format(i)})
+            content.append(image)
+        request = {k: copy.deepcopy(v) for k, v in template.items() if k != "messages"}
+        request["messages"] = [{"role": "user", "content": content}]
+        if template.get("max_tokens"):
+            request["max_tokens"] = min(self.max_output_tokens, template["max_tokens"] * count)
+        return request
+
+    def _run_batch(self, batch: _Batch, texts, completion):
+        count = len(batch.items)
+        result = completion(self.build_request(batch, texts))
+        usage = result.get("usage") or {}
+        choice = result["choices"][0]
+        pages = None if choice.get("finish_reason") == "length" else \
+            split_pages(choice["message"].get("content"), count)
+        with self._cond:
+            self.counts["upstream_requests"] += 1
+            self.counts["tokens"] += usage.get("total_tokens", 0)
+        if pages is None:
+            logging.warning(f"{count} 页合并请求的输出无法按页拆分，改为逐页请求")
+            with self._cond:
+                self.counts["fallback_batches"] += 1
+            with ThreadPoolExecutor(max_workers=count) as pool:
+                return list(pool.map(lambda item: self._single(item[0], completion), batch.items))
+        with self._cond:
+            self.counts["batches"] += 1
+            self.counts["batched_pages"] += count
+            self._last_done = time.perf_counter()
+        return [self._page_response(result, page, count) for page in pages]
+
+    @staticmethod
+    def _page_response(result: dict, page: str, count: int) -> dict:
+        """把合并响应转换成单页响应，usage 按页数平均分摊"""
+        response = {k: v for k, v in result.items() if k not in ("choices", "usage")}
+        response["choices"] = [{"index": 0, "message": {"role": "assistant", "content": page},
+                                "finish_reason": "stop"}]
+        usage = {k: round(v / count) for k, v in (result.get("usage") or {}).items() if isinstance(v, (int, float))}
+        response["usage"] = {**usage, "batch_pages": count}
+        return response
+
+    def stats(self) -> dict:
+        with self._cond:
+            counts = dict(self.counts)
+            pages = counts["batched_pages"] + counts["single_pages"]
+            elapsed = (self._last_done - self._first_submit) if self._last_done and self._first_submit else 0.0
+        counts["pages"] = pages
+        counts["pages_per_second"] = round(pages / elapsed, 2) if elapsed > 0 else 0.0
+        counts["tokens_per_page"] = round(counts["tokens"] / pages, 1) if pages else 0.0
+        return counts
+
+
+def self_check(pages: int = 3) -> dict:
+    """
+    假上游检查：合并请求的输出带齐全部分隔行、但最后一页在中间被截断（finish_reason 为 length）时，
+    整批必须退回逐页请求，各页拿到逐页请求的结果；不满足时抛 AssertionError
+    """
+    def completion(request_data):
+        images = sum(1 for message in request_data["messages"] for part in message["content"]
+                     if part.get("type") == "image_url")
+        if images > 1:
+            content = "\n".join(f"{PAGE_MARKER.format(i)}\n# 第 {i} 页\n完整的正文" for i in range(1, images + 1))
+            return {"choices": [{"index": 0, "message": {"role": "assistant", "content": content[:-3]},
+                                 "finish_reason": "length"}], "usage": {"total_tokens": 100}}
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": "# 单页"},
+                             "finish_reason": "stop"}], "usage": {"total_tokens": 40}}
+
+    def request(i):
+        return {"model": "self-check", "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "转换为 markdown"},
+            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{i}"}}]}]}
+
+    batcher = PageBatcher(pages_per_request=pages, max_wait=5.0)
+    with ThreadPoolExecutor(max_workers=pages) as pool:
+        results = list(pool.map(lambda i: batcher.submit(request(i), completion), range(pages)))
+    stats = batcher.stats()
+    assert stats["fallback_batches"] == 1 and stats["batches"] == 0, f"截断的合并输出没有退回逐页请求: {stats}"
+    assert all(r["choices"][0]["message"]["content"] == "# 单页" for r in results), "截断的页面结果被返回"
+    return stats
+
+
+if __name__ == "__main__":
+    print(f"自检通过: {self_check()}")
@@ -0,0 +1,119 @@
+"""
+VLM 转换的逐页断点续传：长文档按页段转换，每段完成后立即把各页 markdown 追加到输出目录的 sidecar 文件
+（<输出文件>.pages.jsonl），失败重跑时跳过已完成的页面，从第一个缺失的页段继续，全部完成后再拼接最终 markdown。
+中途失败只需重新支付失败页段的 VLM 调用。
+"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import tracing
+
+
+def source_hash(pdf_path) -> str:
+    h = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class PageCheckpoint:
+    """
+    sidecar 文件：第一行为头（源文件哈希、配置），之后每行一页 {"page": 页码, "markdown": ...}。
+    源文件或配置变化时旧的 sidecar 作废。每行写完立即 flush + fsync，进程被杀也最多丢失正在写的一行。
+    """
+
+    def __init__(self, path, pdf_path, config=None):
+        self.path = Path(path)
+        self.header = {"source_sha256": source_hash(pdf_path), "config": config or {}}
+        self.pages = {}  # 页码 -> markdown
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, encoding="utf-8") as f:
+            lines = f.readlines()
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except ValueError:
+            header = {}
+        if {k: header.get(k) for k in self.header} != self.header:
+            logging.info(f"{self.path.name} 与当前输入或配置不一致，重新开始")
+            self.path.unlink()
+            return
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # 最后一行可能在写入时被中断
+            self.pages[record["page"]] = record["markdown"]
+
+    def missing(self, page_count):
+        return [page_no for page_no in range(1, page_count + 1) if page_no not in self.pages]
+
+    def append(self, pages: dict):
+        """追加一批已完成页面 {页码: markdown}"""
+        new_file = not self.path.exists()
+        with open(self.path, "a", encoding="utf-8") as f:
+            if new_file:
+                f.write(json.dumps(self.header, ensure_ascii=False) + "\n")
+            for page_no in sorted(pages):
+                f.write(json.dumps({"page": page_no, "markdown": pages[page_no]}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.pages.update(pages)
+
+    def assemble(self, page_count) -> str:
+        return "\n\n".join(self.pages[page_no] for page_no in range(1, page_count + 1) if self.pages[page_no])
+
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+def _page_ranges(page_numbers, chunk_pages):
+    """把缺失页码切成连续页段，每段最多 chunk_pages 页"""
+    ranges = []
+    for page_no in page_numbers:
+        if ranges and page_no == ranges[-1][1] + 1 and ranges[-1][1] - ranges[-1][0] + 1 < chunk_pages:
+            ranges[-1][1] = page_no
+        else:
+            ranges.append([page_no, page_no])
+    return [tuple(r) for r in ranges]
+
+
+def convert_with_checkpoints(session, pdf_path: Path, output_file: Path, chunk_pages: int, config=None) -> str:
+    """
+    按页段转换并逐段写入 sidecar，返回完整 markdown（同时写出 output_file 并删除 sidecar）。
+    chunk_pages: 每次 convert 的页数，取 VLM 并发数左右既能保持并发又能让失败只损失一段。
+    某一页段失败时异常向上抛出，已完成页段保留在 sidecar 中，重跑时从第一个缺失的页段继续。
+    """
+    import fitz
+    from docling.datamodel.base_models import ConversionStatus
+    with fitz.open(pdf_path) as pdf_doc:
+        page_count = pdf_doc.page_count
+    checkpoint = PageCheckpoint(f"{output_file}.pages.jsonl", pdf_path, config)
+    missing = checkpoint.missing(page_count)
+    if missing and len(missing) < page_count:
+        logging.info(f"{pdf_path.name}: 已完成 {page_count - len(missing)}/{page_count} 页，"
+                     f"从第 {missing[0]} 页继续")
+    with session.document():  # 各页段的 convert 在会话统计中计为一个文档
+        for first, last in _page_ranges(missing, chunk_pages):
+            with tracing.span("checkpoint.chunk", first_page=first, last_page=last):
+                result = session.convert(pdf_path, page_range=(first, last))
+                if result.status != ConversionStatus.SUCCESS:  # 部分页面失败时整段不记录，重跑时重新转换该段
+                    raise RuntimeError(f"第 {first}-{last} 页转换状态为 {result.status}: {result.errors}")
+                with tracing.span("export_to_markdown"):
+                    pages = {page_no: result.document.export_to_markdown(page_no=page_no)
+                             for page_no in range(first, last + 1)}
+                checkpoint.append(pages)
+            logging.info(f"{pdf_path.name}: 第 {first}-{last}/{page_count} 页已保存")
+    markdown_content = checkpoint.assemble(page_count)
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(markdown_content)
+    checkpoint.remove()
+    return markdown_content
@@ -0,0 +1,209 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from PIL import Image, ImageChops
+
+DEFAULT_INDEX_PATH = "./cache/page_index.sqlite"
+HASH_SIZE = 64  # dHash 边长，64x64 = 4096 位；太小时版式相同、正文不同的文字页会被误判为重复
+# 默认只复用精确哈希相同的页面；小于 1.0 时启用感知哈希近似匹配，候选页面还要通过逐块细节比对才会复用。
+# 仅靠整页 dHash 不可靠：金额、日期、客户不同的两张发票只差约 10 位，0.997（约 12 位）会把 A 的结果返回给 B
+DEFAULT_MIN_SIMILARITY = 1.0
+DETAIL_SIZE = 512  # 细节指纹：DETAIL_SIZE² 位的 dHash 位图
+DETAIL_TILES = 16  # 细节指纹按 DETAIL_TILES x DETAIL_TILES 分块比对
+DETAIL_MAX_TILE_DIFF = 0.08  # 任一分块中不同位的比例超过该值（局部内容不同，如改了一个数字）即判为不同页面
+RENDER_DPI = 72  # 预扫描时的渲染分辨率，只用于计算哈希
+
+
+def detail_fingerprint(gray: Image.Image) -> bytes:
+    """高分辨率 dHash 位图（zlib 压缩），用于确认感知哈希的候选页面：局部改动会集中在少数分块中"""
+    resized = gray.resize((DETAIL_SIZE + 1, DETAIL_SIZE), Image.BILINEAR)
+    left = resized.crop((0, 0, DETAIL_SIZE, DETAIL_SIZE))
+    right = resized.crop((1, 0, DETAIL_SIZE + 1, DETAIL_SIZE))
+    bits = ImageChops.subtract(left, right).point(lambda v: 255 if v > 0 else 0).convert("1")
+    return zlib.compress(bits.tobytes())
+
+
+def detail_distance(a: bytes, b: bytes) -> float:
+    """两个细节指纹中差异最大的分块的不同位比例"""
+    size = (DETAIL_SIZE, DETAIL_SIZE)
+    diff = ImageChops.logical_xor(Image.frombytes("1", size, zlib.decompress(a)),
+                                  Image.frombytes("1", size, zlib.decompress(b)))
+    tiles = diff.convert("L").resize((DETAIL_TILES, DETAIL_TILES), Image.BOX)
+    return max(tiles.getextrema()[1], 0) / 255.0
+
+
+def image_hashes(image: Image.Image):
+    """
+    返回 (精确哈希, 感知哈希, 细节指纹)。
+    精确哈希基于归一化后的灰度像素，感知哈希为 HASH_SIZE² 位的 dHash（相邻像素亮度差），对重新渲染、压缩噪声不敏感；
+    细节指纹只在近似匹配时用于二次确认。
+    """
+    gray = image.convert("L")
+    exact = hashlib.sha256(gray.resize((256, 256), Image.BILINEAR).tobytes()).hexdigest()
+    pixels = list(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).getdata())
+    phash = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            phash = (phash << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return exact, phash, detail_fingerprint(gray)
+
+
+def page_hashes(pdf_doc, dpi: int = RENDER_DPI):
+    """以低分辨率渲染 PyMuPDF 文档的每一页，返回 [(精确哈希, 感知哈希, 细节指纹)]"""
+    import fitz
+    hashes = []
+    for page in pdf_doc:
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+        hashes.append(image_hashes(Image.frombytes("L", (pix.width, pix.height), pix.samples)))
+    return hashes
+
+
+def request_image_hashes(request_data: dict):
+    """从 OpenAI 格式请求中取出页面图片并计算哈希，只处理单页请求，其余返回 None"""
+    images = []
+    for message in request_data.get("messages", []):
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                _, sep, data = part.get("image_url", {}).get("url", "").partition(";base64,")
+                if sep:
+                    images.append(data)
+    if len(images) != 1:
+        return None
+    return image_hashes(Image.open(io.BytesIO(base64.b64decode(images[0]))))
+
+
+def request_engine_key(request_data: dict) -> str:
+    """同一页面在不同 model/prompt/参数下的结果不能复用，按这些参数区分索引"""
+    texts = []
+    for message in request_data.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(part.get("text", "") for part in content or [] if part.get("type") == "text")
+    return "vlm:" + hashlib.sha256(json.dumps({
+        "model": request_data.get("model"),
+        "prompt": texts,
+        "temperature": request_data.get("temperature"),
+        "max_tokens": request_data.get("max_tokens"),
+    }, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class PageDedupIndex:
+    """
+    跨文档的页面去重索引（SQLite）：保存已转换页面的结果，重复页面（封面、法律声明、标准附录等）直接复用。
+    先按精确哈希查找；min_similarity 小于 1.0 时再按感知哈希查找相似度不低于 min_similarity 的页面，
+    候选页面的细节指纹中任一分块差异超过 DETAIL_MAX_TILE_DIFF 时不复用（计入 rejected_similar）。
+    感知哈希按 (最大汉明距离 + 1) 段分桶索引，根据抽屉原理，距离不超过阈值的页面至少有一段完全相同。
+    """
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH, min_similarity: float = DEFAULT_MIN_SIMILARITY,
+                 enabled: bool = True):
+        """
+        min_similarity: 判为相同页面的感知哈希相似度（0~1），默认 1.0 只做精确匹配，近似匹配需显式开启
+        enabled: 为 False（或环境变量 PAGE_DEDUP_BYPASS=1）时不查也不写
+        """
+        self.path = path
+        self.hash_bits = HASH_SIZE * HASH_SIZE
+        self.max_distance = int(self.hash_bits * (1 - min_similarity))
+        self.enabled = enabled and os.getenv("PAGE_DEDUP_BYPASS", "0") != "1"
+        self.bands = self.max_distance + 1
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.rejected_similar = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "engine TEXT NOT NULL, exact TEXT NOT NULL, phash TEXT NOT NULL, payload BLOB NOT NULL, "
+                "created REAL NOT NULL, PRIMARY KEY (engine, exact))"
+            )
+            if "detail" not in [r[1] for r in self._conn.execute("PRAGMA table_info(pages)")]:
+                self._conn.execute("ALTER TABLE pages ADD COLUMN detail BLOB")  # 旧索引的页面没有细节指纹，不参与近似匹配
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS phash_bands ("
+                "engine TEXT NOT NULL, bands INTEGER NOT NULL, band INTEGER NOT NULL, value TEXT NOT NULL, "
+                "exact TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_bands ON phash_bands(engine, bands, band, value)")
+            self._conn.commit()
+
+    def _band_values(self, phash: int):
+        bits = self.hash_bits // self.bands
+        mask = (1 << bits) - 1
+        return [format((phash >> (i * bits)) & mask, "x") for i in range(self.bands)]
+
+    def lookup(self, engine: str, exact: str, phash: int, detail: bytes = None):
+        """命中返回保存的结果字典，否则返回 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM pages WHERE engine = ? AND exact = ?",
+                                     (engine, exact)).fetchone()
+            if row is not None:
+                self.exact_hits += 1
+                return json.loads(row[0])
+            if self.max_distance > 0 and detail is not None:
+                candidates = set()
+                for band, value in enumerate(self._band_values(phash)):
+                    candidates.update(r[0] for r in self._conn.execute(
+                        "SELECT exact FROM phash_bands WHERE engine = ? AND bands = ? AND band = ? AND value = ?",
+                        (engine, self.bands, band, value)))
+                for candidate in candidates:
+                    row = self._conn.execute("SELECT phash, payload, detail FROM pages WHERE engine = ? AND exact = ?",
+                                             (engine, candidate)).fetchone()
+                    if row is None or bin(int(row[0], 16) ^ phash).count("1") > self.max_distance:
+                        continue
+                    if row[2] is None or detail_distance(row[2], detail) > DETAIL_MAX_TILE_DIFF:
+                        self.rejected_similar += 1  # 整体相似但局部内容不同（如发票金额、日期）
+                        continue
+                    self.similar_hits += 1
+                    return json.loads(row[1])
+            self.misses += 1
+        return None
+
+    def put(self, engine: str, exact: str, phash: int, detail: bytes, payload: dict):
+        if not self.enabled:
+            return
+        value = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO pages (engine, exact, phash, payload, created, detail) VALUES (?, ?, ?, ?, ?, ?)",
+                (engine, exact, f"{phash:x}", value, time.time(), detail),
+            )
+            if cur.rowcount:
+                self._conn.executemany(
+                    "INSERT INTO phash_bands (engine, bands, band, value, exact) VALUES (?, ?, ?, ?, ?)",
+                    [(engine, self.bands, band, v, exact) for band, v in enumerate(self._band_values(phash))],
+                )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "skipped_pages": self.exact_hits + self.similar_hits,
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "rejected_similar": self.rejected_similar,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,121 @@
+"""
+页面选择：只转换文档中选定的页面，用于快速试转（判断新一类文档适合哪个引擎或提示词、抽查上千页的上传文件）。
+选择表达式：页码和页码范围用逗号分隔，如 "1-5,40,100-"（页码从 1 开始，"100-" 表示第 100 页到最后一页，"-5" 表示前 5 页）；
+"sample=10" 表示在全文中均匀抽取 10 页（包含首页和末页）。
+各引擎只渲染和推理选定的页面：docling / MinerU 转换只包含选定页面的子文档，marker 通过 PdfConverter 的 page_range 配置。
+
+环境变量 PAGE_SELECTION 设置各脚本的默认选择，为空时转换整篇文档。
+试转结果按所选页码单独命名（见 output_name），不会覆盖整篇转换的输出。
+"""
+import hashlib
+import os
+import re
+from io import BytesIO
+
+import fitz
+
+PAGE_SELECTION = os.getenv("PAGE_SELECTION", "")
+_SAMPLE = re.compile(r"^sample\s*=\s*(\d+)$", re.IGNORECASE)
+_RANGE = re.compile(r"^(\d*)\s*-\s*(\d*)$")
+MAX_NAME_PAGES = 40  # 输出文件名中页码描述的最大长度，超过时改用页码列表的哈希
+
+
+def parse_selection(spec: str, page_count: int) -> list:
+    """把选择表达式解析为排好序的页码列表（从 1 开始），超出文档页数的部分被忽略；表达式无效时抛 ValueError"""
+    spec = (spec or "").strip()
+    if not spec:
+        return list(range(1, page_count + 1))
+    sample = _SAMPLE.match(spec)
+    if sample:
+        count = int(sample.group(1))
+        if count <= 0:
+            raise ValueError(f"无效的页面选择: {spec}")
+        if count >= page_count:
+            return list(range(1, page_count + 1))
+        if count == 1:
+            return [1]
+        step = (page_count - 1) / (count - 1)
+        return sorted({1 + round(i * step) for i in range(count)})
+    pages = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if part.isdigit():
+            first = last = int(part)
+        else:
+            match = _RANGE.match(part)
+            if not match or not (match.group(1) or match.group(2)):
+                raise ValueError(f"无效的页面选择: {part}")
+            first = int(match.group(1) or 1)
+            last = int(match.group(2)) if match.group(2) else max(first, page_count)
+        if first < 1 or last < first:
+            raise ValueError(f"无效的页面选择: {part}")
+        pages.update(range(first, min(last, page_count) + 1))
+    return sorted(pages)
+
+
+def select_pages(pdf_path, spec: str = PAGE_SELECTION):
+    """返回 pdf_path 中选定的页码列表；未设置选择或选中了全部页面时返回 None，表示转换整篇"""
+    if not (spec or "").strip():
+        return None
+    with fitz.open(pdf_path) as pdf_doc:
+        page_count = pdf_doc.page_count
+    pages = parse_selection(spec, page_count)
+    if not pages:
+        raise ValueError(f"页面选择 {spec} 没有选中任何页面（文档共 {page_count} 页）")
+    return None if len(pages) == page_count else pages
+
+
+def page_ranges(pages) -> list:
+    """把页码列表合并成连续的 (起始页, 结束页)"""
+    ranges = []
+    for page_no in pages:
+        if ranges and page_no == ranges[-1][1] + 1:
+            ranges[-1][1] = page_no
+        else:
+            ranges.append([page_no, page_no])
+    return [tuple(r) for r in ranges]
+
+
+def describe(pages) -> str:
+    """日志用的页码描述，如 "1-5,40,100-120" """
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in page_ranges(pages))
+
+
+def output_name(name: str, pages=None) -> str:
+    """输出文件名（不含扩展名）：整篇转换为 name，试转为 "name.pages-1-5,40"（页码很多时为页码列表的短哈希）"""
+    if not pages:
+        return name
+    label = describe(pages)
+    if len(label) > MAX_NAME_PAGES:
+        label = f"{len(pages)}p-" + hashlib.sha1(label.encode()).hexdigest()[:10]
+    return f"{name}.pages-{label}"
+
+
+def extract_pages(pdf_path, pages) -> bytes:
+    """只包含选定页面的子文档（PDF 字节），未选中的页面不会被渲染"""
+    with fitz.open(pdf_path) as src, fitz.open() as dst:
+        for first, last in page_ranges(pages):
+            dst.insert_pdf(src, from_page=first - 1, to_page=last - 1)
+        return dst.tobytes()
+
+
+def docling_source(pdf_path, pages=None):
+    """docling convert 的输入：选定部分页面时为只含这些页面的 DocumentStream，否则为原路径"""
+    if not pages:
+        return pdf_path
+    from docling.datamodel.base_models import DocumentStream
+    return DocumentStream(name=os.path.basename(pdf_path), stream=BytesIO(extract_pages(pdf_path, pages)))
+
+
+def marker_convert(converter, pdf_path, pages=None):
+    """marker 转换：通过 PdfConverter 的 page_range 配置（从 0 开始的页码列表）只处理选定页面"""
+    if not pages:
+        return converter(pdf_path)
+    config = converter.config
+    converter.config = {**(config or {}), "page_range": [page_no - 1 for page_no in pages]}
+    try:
+        return converter(pdf_path)
+    finally:
+        converter.config = config
@@ -0,0 +1,317 @@
+"""
+Gemini 等有配额限制的 API 共用的调度器：
+- 令牌桶控制每分钟请求数（RPM）和每分钟 tokens（TPM）
+- AIMD 自适应并发：成功时加性增加，收到 429 或延迟超标时乘性减小
+- 遵循 Retry-After（以及 Gemini 错误中的 retryDelay）重试，重试期间所有调用一起暂停
+- 学到的并发上限和暂停时间持久化到 cache/，下次运行直接从可持续的速率开始；
+  同时运行的其他脚本在申请并发槽位时检查状态文件的修改时间，其他进程被限流后的暂停和降低的上限随即生效
+
+环境变量：GEMINI_RPM / GEMINI_TPM 覆盖默认配额；RATE_LIMIT_WORKERS 为共享同一配额的进程数（批处理时自动设置）
+"""
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+
+DEFAULT_STATE_DIR = "./cache"
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "1000"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+IMAGE_TOKENS = 258  # Gemini 每张图片按固定 tokens 计费
+STATE_CHECK_INTERVAL = 1.0  # 申请槽位时最多每隔多少秒检查一次状态文件是否被其他进程更新
+_RETRY_DELAY = re.compile(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s")
+
+
+class RateLimitExceeded(Exception):
+    """重试次数用尽仍被限流"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def error_status(exc):
+    """从 litellm / requests / google-genai 等不同客户端的异常中取 HTTP 状态码"""
+    for attr in ("status_code", "code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_rate_limit(exc) -> bool:
+    if error_status(exc) == 429:
+        return True
+    text = str(exc)
+    return "RESOURCE_EXHAUSTED" in text or "RateLimitError" in type(exc).__name__
+
+
+def retry_after_seconds(exc):
+    """Retry-After 响应头或 Gemini 错误详情中的 retryDelay，没有时返回 None"""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+    match = _RETRY_DELAY.search(str(exc))
+    return float(match.group(1)) if match else None
+
+
+def estimate_tokens(request_data: dict) -> int:
+    """按 OpenAI 格式请求粗略估计输入 tokens（文本按 4 字符 1 token，图片按固定值）"""
+    tokens = 0
+    for message in request_data.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part.get("text", "")) // 4
+            elif part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+    return tokens
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst_seconds: float = 10.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1.0):
+        """取出 amount 个令牌；超过桶容量的大请求在桶满时放行（余额变为负数，后续请求等待补足）"""
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(amount, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(min(wait, 1.0))
+
+    def adjust(self, amount: float):
+        """按实际用量修正估计值（amount 为多用的令牌数，可为负）"""
+        with self._lock:
+            self.tokens -= amount
+
+
+class RateLimitScheduler:
+    def __init__(self, name: str = "gemini", rpm: int = None, tpm: int = None, max_concurrency: int = 16,
+                 min_concurrency: int = 1, latency_target: float = None, max_retries: int = 6,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0, state_dir: str = DEFAULT_STATE_DIR,
+                 burst_seconds: float = 10.0):
+        """
+        rpm/tpm: 配额，None 表示不限制
+        burst_seconds: 令牌桶容量，按多少秒的配额计算，越小越平滑
+        max_concurrency/min_concurrency: AIMD 并发上限的范围
+        latency_target: 单次调用延迟超过该值（秒）也视为拥塞信号，None 表示只看 429
+        state_dir: 持久化学到的并发上限和暂停时间，None 表示不持久化
+        """
+        self.name = name
+        self.rpm_bucket = TokenBucket(rpm, burst_seconds) if rpm else None
+        self.tpm_bucket = TokenBucket(tpm, burst_seconds) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.state_path = os.path.join(state_dir, f"rate_limit_{name}.json") if state_dir else None
+        self.limit = float(max_concurrency)
+        self.paused_until = 0.0  # time.time()，持久化时可跨进程使用
+        self.inflight = 0
+        self._last_decrease = 0.0
+        self._state_mtime = None  # 最近一次读取或写入时状态文件的修改时间
+        self._state_checked = 0.0
+        self._cond = threading.Condition()
+        self.counts = {"requests": 0, "succeeded": 0, "rate_limited": 0, "retries": 0, "failed": 0,
+                       "tokens": 0, "latency_seconds": 0.0}
+        self._load_state()
+
+    # ---------- 持久化 ----------
+
+    def _read_state(self):
+        """读取状态文件，返回 (并发上限, 暂停截止时间)，文件不存在或无法解析时返回 None"""
+        try:
+            mtime = os.path.getmtime(self.state_path)
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            limit = min(self.max_concurrency, max(self.min_concurrency, float(state.get("limit", self.limit))))
+            self._state_mtime = mtime
+            return limit, float(state.get("paused_until", 0.0))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"读取限流状态失败: {e}")
+            return None
+
+    def _load_state(self):
+        if not self.state_path:
+            return
+        state = self._read_state()
+        if state is not None:
+            self.limit, self.paused_until = state
+            logging.info(f"{self.name} 调度器恢复状态: 并发上限 {self.limit:.1f}")
+
+    def _refresh_state(self):
+        """状态文件被其他进程更新（被限流）后，采用其中更长的暂停和更低的并发上限；调用方持有 self._cond"""
+        now = time.monotonic()
+        if not self.state_path or now - self._state_checked < STATE_CHECK_INTERVAL:
+            return
+        self._state_checked = now
+        try:
+            if os.path.getmtime(self.state_path) == self._state_mtime:
+                return
+        except OSError:
+            return
+        state = self._read_state()
+        if state is not None:
+            limit, paused_until = state
+            self.limit = min(self.limit, limit)
+            self.paused_until = max(self.paused_until, paused_until)
+
+    def save_state(self):
+        if not self.state_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        tmp = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"limit": round(self.limit, 3), "paused_until": self.paused_until, "updated": time.time()}, f)
+        os.replace(tmp, self.state_path)
+        self._state_mtime = os.path.getmtime(self.state_path)
+
+    # ---------- AIMD ----------
+
+    def _acquire_slot(self):
+        with self._cond:
+            while True:
+                self._refresh_state()
+                pause = self.paused_until - time.time()
+                if pause <= 0 and self.inflight < max(self.min_concurrency, int(self.limit)):
+                    self.inflight += 1
+                    return
+                self._cond.wait(timeout=pause if pause > 0 else 1.0)
+
+    def _release_slot(self, latency=None, rate_limited=False, retry_after=None):
+        with self._cond:
+            self.inflight -= 1
+            now = time.time()
+            if rate_limited:
+                self.counts["rate_limited"] += 1
+                if now - self._last_decrease > 1.0:  # 同一波并发的 429 只减一次
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self._last_decrease = now
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif latency is not None:
+                if self.latency_target and latency > self.latency_target and now - self._last_decrease > 1.0:
+                    self.limit = max(self.min_concurrency, self.limit * 0.9)
+                    self._last_decrease = now
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+        if rate_limited:
+            self.save_state()
+
+    # ---------- 调用 ----------
+
+    def call(self, fn, *args, tokens: int = 0, usage=None, **kwargs):
+        """
+        按配额和自适应并发执行 fn(*args, **kwargs)，限流和临时错误按 Retry-After / 指数退避重试。
+        tokens: 本次调用的估计 tokens；usage: 从返回值取实际 tokens 的函数，用于修正 TPM 令牌桶
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.rpm_bucket:
+                self.rpm_bucket.acquire(1)
+            if self.tpm_bucket and tokens:
+                self.tpm_bucket.acquire(tokens)
+            self._acquire_slot()
+            start = time.perf_counter()
+            with self._cond:
+                self.counts["requests"] += 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                status = error_status(e)
+                rate_limited = is_rate_limit(e)
+                retry_after = retry_after_seconds(e)
+                self._release_slot(rate_limited=rate_limited, retry_after=retry_after)
+                transient = rate_limited or (status is not None and status >= 500)
+                if not transient or attempt == self.max_retries:
+                    with self._cond:
+                        self.counts["failed"] += 1
+                    if rate_limited:
+                        raise RateLimitExceeded(f"{self.name} 重试 {attempt} 次后仍被限流: {e}", retry_after) from e
+                    raise
+                delay = retry_after if retry_after is not None else \
+                    min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+                with self._cond:
+                    self.counts["retries"] += 1
+                logging.warning(f"{self.name} 请求{'被限流' if rate_limited else f'失败（{status}）'}，"
+                                f"{delay:.1f}s 后重试（第 {attempt + 1} 次），当前并发上限 {self.limit:.1f}")
+                time.sleep(delay)
+                continue
+            latency = time.perf_counter() - start
+            self._release_slot(latency=latency)
+            used = usage(result) if usage else 0
+            if used and self.tpm_bucket:
+                self.tpm_bucket.adjust(used - tokens)
+            with self._cond:
+                self.counts["succeeded"] += 1
+                self.counts["tokens"] += used or tokens
+                self.counts["latency_seconds"] += latency
+            return result
+
+    def stats(self) -> dict:
+        with self._cond:
+            counts = dict(self.counts)
+            succeeded = counts["succeeded"]
+            counts["avg_latency_seconds"] = round(counts.pop("latency_seconds") / succeeded, 3) if succeeded else 0.0
+            counts["concurrency_limit"] = round(self.limit, 2)
+        return counts
+
+    def close(self):
+        self.save_state()
+        logging.info(f"{self.name} 调度器统计: {self.stats()}")
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(name: str = "gemini", **kwargs) -> RateLimitScheduler:
+    """
+    进程内共享的调度器，同名调度器只创建一次。
+    gemini 默认使用 GEMINI_RPM / GEMINI_TPM；多个进程共享配额时按 RATE_LIMIT_WORKERS 平分。
+    """
+    with _schedulers_lock:
+        scheduler = _schedulers.get(name)
+        if scheduler is None:
+            if name == "gemini":
+                share = max(1, int(os.getenv("RATE_LIMIT_WORKERS", "1")))
+                kwargs.setdefault("rpm", math.ceil(GEMINI_RPM / share))
+                kwargs.setdefault("tpm", math.ceil(GEMINI_TPM / share))
+            scheduler = _schedulers[name] = RateLimitScheduler(name, **kwargs)
+        return scheduler
+
+
+def close_schedulers():
+    """保存所有调度器的状态并输出统计"""
+    with _schedulers_lock:
+        for scheduler in _schedulers.values():
+            scheduler.close()
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_MANIFEST_PATH = os.getenv("RUN_MANIFEST_PATH", "./output/manifest.sqlite")
+
+
+def config_hash(config) -> str:
+    """配置的稳定哈希，配置变化后同一文件会被重新处理"""
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+class RunManifest:
+    """
+    增量运行清单（SQLite）：按 (输入路径, 输入内容哈希, 引擎, 配置哈希) 记录状态、耗时和输出路径。
+    入口脚本重跑时用 is_done() 跳过已处理的文件：输入内容或配置变化、上次失败、输出文件被删除的文件会重新处理；
+    内容相同但路径不同的文件各自记录，各自的输出都会生成。
+    文件哈希按 (路径, 大小, mtime) 缓存，未改动的文件无需重新读取。
+    """
+
+    def __init__(self, engine: str, config=None, path: str = DEFAULT_MANIFEST_PATH):
+        self.engine = engine
+        self.config_hash = config_hash(config or {})
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS file_hashes ("
+            "  path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT);"
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "  sha256 TEXT, engine TEXT, config_hash TEXT, source_path TEXT, status TEXT,"
+            "  started_at REAL, finished_at REAL, seconds REAL, outputs TEXT, error TEXT,"
+            "  PRIMARY KEY (source_path, sha256, engine, config_hash));"
+        )
+        self._conn.commit()
+
+    def file_hash(self, pdf_path) -> str:
+        pdf_path = os.path.abspath(pdf_path)
+        st = os.stat(pdf_path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256 FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (pdf_path, st.st_size, st.st_mtime_ns),
+            ).fetchone()
+        if row:
+            return row[0]
+        h = hashlib.sha256()
+        with open(pdf_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                (pdf_path, st.st_size, st.st_mtime_ns, digest),
+            )
+            self._conn.commit()
+        return digest
+
+    def is_done(self, pdf_path) -> bool:
+        """该文件（按路径）已成功处理、内容和配置未变且输出文件仍在时返回 True"""
+        digest = self.file_hash(pdf_path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT outputs FROM runs WHERE source_path = ? AND sha256 = ? AND engine = ? AND config_hash = ?"
+                " AND status = 'done'",
+                (os.path.abspath(pdf_path), digest, self.engine, self.config_hash),
+            ).fetchone()
+        if row is None:
+            return False
+        return all(os.path.exists(p) for p in json.loads(row[0] or "[]"))
+
+    def _record(self, pdf_path, status, seconds=None, outputs=None, error=None):
+        now = time.time()
+        digest = self.file_hash(pdf_path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO runs "
+                "(sha256, engine, config_hash, source_path, status, started_at, finished_at, seconds, outputs, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (digest, self.engine, self.config_hash, os.path.abspath(pdf_path), status,
+                 now - (seconds or 0), now if status != "running" else None, seconds,
+                 json.dumps([str(p) for p in outputs or []]), error),
+            )
+            self._conn.commit()
+
+    def start(self, pdf_path):
+        self._record(pdf_path, "running")
+
+    def finish(self, pdf_path, outputs, seconds=None):
+        self._record(pdf_path, "done", seconds, outputs)
+
+    def fail(self, pdf_path, error, seconds=None):
+        self._record(pdf_path, "failed", seconds, error=str(error))
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,167 @@
+"""
+各转换脚本共用的阶段计时与性能分析。
+
+环境变量：
+    TRACE_OUTPUT   输出文件路径，未设置时所有 span 都是空操作
+    TRACE_FORMAT   jsonl（默认，每行一个 span）或 chrome（可直接拖进 chrome://tracing / Perfetto）
+    PROFILE_TOP_N  大于 0 时对每个文档做 cProfile，只保留最慢 N 个文档的 .prof 文件。
+                   cProfile 只记录调用 document() 的线程（VLM 请求、代理等其他线程不在 .prof 中）；
+                   同一进程同时只能有一个 profiler，多个文档并行转换时（如 conversion_daemon serve --workers N）
+                   只分析先开始的那个，其余文档照常转换、不做 cProfile
+"""
+import contextvars
+import cProfile
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+_current_document = contextvars.ContextVar("trace_document", default=None)
+_profile_lock = threading.Lock()  # Python 3.12 起同时启用第二个 profiler 会抛 ValueError
+
+
+class Tracer:
+    def __init__(self, output_path=None, fmt="jsonl", profile_top_n=0):
+        self.output_path = output_path
+        self.fmt = fmt
+        self.profile_top_n = profile_top_n
+        self.enabled = bool(output_path)
+        self._lock = threading.Lock()
+        self._file = None
+        self._slowest = []  # (耗时, prof 路径) 小顶堆
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+            self._file = open(output_path, "a", encoding="utf-8")
+            if fmt == "chrome" and self._file.tell() == 0:
+                self._file.write("[\n")  # chrome 的 JSON 数组格式允许省略结尾的 ]，多进程追加也安全
+
+    def _emit(self, name, start, duration, attrs):
+        if self.fmt == "chrome":
+            line = json.dumps({"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6,
+                               "pid": os.getpid(), "tid": threading.get_ident(), "args": attrs},
+                              ensure_ascii=False, default=str) + ",\n"
+        else:
+            line = json.dumps({"name": name, "start": start, "seconds": round(duration, 6), "pid": os.getpid(),
+                               "tid": threading.get_ident(), **attrs}, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._file is None:  # 已 close()，关闭前已开始的 span 结束时直接丢弃
+                return
+            self._file.write(line)
+            self._file.flush()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """记录一个阶段的耗时，自动带上当前文档名"""
+        if not self.enabled:
+            yield attrs
+            return
+        document = _current_document.get()
+        if document is not None:
+            attrs.setdefault("document", document)
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield attrs  # 调用方可以在 span 内补充属性，例如 cache_hit
+        except Exception as e:
+            attrs["error"] = str(e)
+            raise
+        finally:
+            self._emit(name, start, time.perf_counter() - t0, attrs)
+
+    @contextmanager
+    def document(self, name, **attrs):
+        """
+        文档级 span；开启 PROFILE_TOP_N 时同时对调用线程做 cProfile，只保留最慢的 N 个。
+        已有其他文档在做 cProfile（或有其他 profiler 在运行）时本文档跳过 cProfile，不影响转换
+        """
+        token = _current_document.set(str(name))
+        profiler = None
+        if self.enabled and self.profile_top_n > 0 and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # 其他分析工具已在运行
+                profiler = None
+                _profile_lock.release()
+        t0 = time.perf_counter()
+        try:
+            with self.span("document", **attrs):
+                yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                _profile_lock.release()
+                self._keep_profile(str(name), time.perf_counter() - t0, profiler)
+            _current_document.reset(token)
+
+    def _keep_profile(self, name, duration, profiler):
+        prof_dir = os.path.join(os.path.dirname(os.path.abspath(self.output_path)), "profiles")
+        with self._lock:
+            if len(self._slowest) >= self.profile_top_n and duration <= self._slowest[0][0]:
+                return
+            os.makedirs(prof_dir, exist_ok=True)
+            safe_name = re.sub(r"[^\w.-]", "_", name)
+            path = os.path.join(prof_dir, f"{safe_name}_{os.getpid()}.prof")
+            profiler.dump_stats(path)
+            heapq.heappush(self._slowest, (duration, path))
+            if len(self._slowest) > self.profile_top_n:
+                _, dropped = heapq.heappop(self._slowest)
+                if os.path.exists(dropped):
+                    os.remove(dropped)
+
+    def record_docling_timings(self, conv_result):
+        """把 docling 的逐页阶段耗时（需开启 settings.debug.profile_pipeline_timings）转成 span"""
+        if not self.enabled:
+            return
+        for stage, item in (getattr(conv_result, "timings", None) or {}).items():
+            starts = getattr(item, "start_timestamps", None) or []
+            for page_no, duration in enumerate(getattr(item, "times", None) or []):
+                start = starts[page_no].timestamp() if page_no < len(starts) else time.time()
+                attrs = {"document": _current_document.get(), "stage": stage}
+                if getattr(item, "scope", None) is not None and str(item.scope).endswith("PAGE"):
+                    attrs["page"] = page_no
+                self._emit(f"docling.{stage}", start, duration, attrs)
+
+    def close(self):
+        with self._lock:
+            self.enabled = False  # 之后的 span 都是空操作（常驻服务关闭时可能还有转换在运行）
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self._slowest:
+            logging.info(f"最慢文档的 cProfile 结果: {[p for _, p in sorted(self._slowest, reverse=True)]}")
+
+
+_tracer = None
+
+
+def get_tracer() -> Tracer:
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(os.getenv("TRACE_OUTPUT"), os.getenv("TRACE_FORMAT", "jsonl"),
+                         int(os.getenv("PROFILE_TOP_N", "0")))
+    return _tracer
+
+
+def span(name, **attrs):
+    return get_tracer().span(name, **attrs)
+
+
+def document(name, **attrs):
+    return get_tracer().document(name, **attrs)
+
+
+def record_docling_timings(conv_result):
+    get_tracer().record_docling_timings(conv_result)
+
+
+def enable_docling_page_timings():
+    """开启 docling 的逐页阶段计时（仅在启用 tracing 时）"""
+    if not get_tracer().enabled:
+        return
+    from docling.datamodel.settings import settings
+    settings.debug.profile_pipeline_timings = True
@@ -0,0 +1,110 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "./cache/vlm_cache.sqlite"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2GB
+
+
+def request_cache_key(request_data: dict) -> str:
+    """按 (model, prompt, temperature, max_tokens, 页面图片字节) 计算内容哈希"""
+    texts = []
+    images = []
+    for message in request_data.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                url = part.get("image_url", {}).get("url", "")
+                _, _, data = url.partition(";base64,")
+                images.append(base64.b64decode(data) if data else url.encode())
+    h = hashlib.sha256()
+    h.update(json.dumps({
+        "model": request_data.get("model"),
+        "prompt": texts,
+        "temperature": request_data.get("temperature"),
+        "max_tokens": request_data.get("max_tokens"),
+    }, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    for image in images:
+        h.update(hashlib.sha256(image).digest())
+    return h.hexdigest()
+
+
+class VLMResponseCache:
+    """持久化的 VLM 响应缓存（SQLite），按总字节数做 LRU 淘汰"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES, enabled: bool = True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = enabled and os.getenv("VLM_CACHE_BYPASS", "0") != "1"
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+            self._conn.commit()
+
+    def get(self, key: str):
+        """命中返回响应字典，否则返回 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, response: dict):
+        if not self.enabled:
+            return
+        value = json.dumps(response, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """总大小超过上限时按最近访问时间从旧到新淘汰"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logging.info(f"VLM 缓存淘汰 {len(evicted)} 条记录")
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,187 @@
+"""
+VLM 代理的运行指标：按 (model, status, source) 统计请求数和延迟直方图，按模型统计输入/输出 tokens 和估算费用，
+运行中通过代理的 /metrics（Prometheus 文本格式）和 /stats（JSON）查看，结束时输出逐文档汇总。
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+# 每百万 tokens 的美元价格 (输入, 输出)，按模型名前缀匹配，未列出的模型费用记为 0；价格变化时在这里修改
+MODEL_PRICES = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-pro": (1.25, 10.00),
+    "gemini-2.0-flash": (0.10, 0.40),
+}
+
+
+def model_price(model):
+    for prefix, price in sorted(MODEL_PRICES.items(), key=lambda item: -len(item[0])):
+        if (model or "").startswith(prefix):
+            return price
+    return 0.0, 0.0
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{str(value).replace(chr(34), chr(39))}"' for key, value in labels.items())
+
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class ProxyMetrics:
+    """
+    线程安全的内存指标。source 为结果来源：upstream（调用了上游）、cache（响应缓存）、dedup（页面去重）。
+    document() 标记当前文档，期间到达的请求计入该文档的汇总（各脚本逐个文档转换，代理请求都属于当前文档）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}  # (model, status, source) -> 次数
+        self.latency = {}  # (model, status) -> _Histogram
+        self.tokens = {}  # model -> {"prompt": n, "completion": n}
+        self.cost = {}  # model -> 美元
+        self.inflight = 0
+        self.documents = []  # 已结束文档的汇总
+        self._document = None
+
+    @staticmethod
+    def _empty_document(name):
+        return {"document": name, "requests": 0, "errors": 0, "cache_hits": 0, "dedup_hits": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "latency_seconds": 0.0,
+                "slowest_request_seconds": 0.0, "started": time.time()}
+
+    def request_started(self):
+        with self._lock:
+            self.inflight += 1
+
+    def observe(self, model, status, seconds, usage=None, source="upstream"):
+        usage = usage or {}
+        prompt = int(usage.get("prompt_tokens") or 0)
+        completion = int(usage.get("completion_tokens") or 0)
+        cost = 0.0
+        if source == "upstream":  # 缓存和去重命中不产生费用
+            price_in, price_out = model_price(model)
+            cost = (prompt * price_in + completion * price_out) / 1e6
+        with self._lock:
+            self.inflight -= 1
+            key = (model, status, source)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.setdefault((model, status), _Histogram()).observe(seconds)
+            if source == "upstream":
+                tokens = self.tokens.setdefault(model, {"prompt": 0, "completion": 0})
+                tokens["prompt"] += prompt
+                tokens["completion"] += completion
+                self.cost[model] = self.cost.get(model, 0.0) + cost
+            doc = self._document
+            if doc is not None:
+                doc["requests"] += 1
+                doc["errors"] += status != 200
+                doc["cache_hits"] += source == "cache"
+                doc["dedup_hits"] += source == "dedup"
+                if source == "upstream":
+                    doc["prompt_tokens"] += prompt
+                    doc["completion_tokens"] += completion
+                    doc["cost_usd"] += cost
+                doc["latency_seconds"] += seconds
+                doc["slowest_request_seconds"] = max(doc["slowest_request_seconds"], seconds)
+
+    @contextmanager
+    def document(self, name):
+        """标记当前转换的文档，结束时把该文档的汇总加入 documents"""
+        doc = self._empty_document(str(name))
+        with self._lock:
+            self._document = doc
+        try:
+            yield doc
+        finally:
+            with self._lock:
+                self._document = None
+                doc["wall_seconds"] = round(time.time() - doc.pop("started"), 3)
+                doc["avg_latency_seconds"] = round(doc["latency_seconds"] / doc["requests"], 3) \
+                    if doc["requests"] else 0.0
+                doc["latency_seconds"] = round(doc["latency_seconds"], 3)
+                doc["slowest_request_seconds"] = round(doc["slowest_request_seconds"], 3)
+                doc["cost_usd"] = round(doc["cost_usd"], 6)
+                self.documents.append(doc)
+
+    def snapshot(self) -> dict:
+        """/stats 的 JSON 内容"""
+        with self._lock:
+            models = {}
+            for (model, status, source), count in self.requests.items():
+                entry = models.setdefault(model, {"requests": {}, "latency": {}, "tokens": {}, "cost_usd": 0.0})
+                entry["requests"][f"{status}/{source}"] = count
+            for (model, status), hist in self.latency.items():
+                models.setdefault(model, {"requests": {}, "latency": {}, "tokens": {}, "cost_usd": 0.0})
+                models[model]["latency"][str(status)] = {
+                    "count": hist.count, "avg_seconds": round(hist.total / hist.count, 3) if hist.count else 0.0,
+                    "max_seconds": round(hist.max, 3),
+                }
+            for model, tokens in self.tokens.items():
+                models[model]["tokens"] = dict(tokens)
+                models[model]["cost_usd"] = round(self.cost.get(model, 0.0), 6)
+            return {"uptime_seconds": round(time.time() - self.started, 1), "inflight": self.inflight,
+                    "models": models, "current_document": self._document["document"] if self._document else None,
+                    "documents": list(self.documents)}
+
+    def prometheus_text(self) -> str:
+        """/metrics 的 Prometheus 文本格式内容"""
+        lines = []
+        with self._lock:
+            lines += ["# HELP vlm_proxy_requests_total 代理处理的请求数",
+                      "# TYPE vlm_proxy_requests_total counter"]
+            for (model, status, source), count in sorted(self.requests.items(), key=str):
+                lines.append(f"vlm_proxy_requests_total{{{_labels(model=model, status=status, source=source)}}} {count}")
+            lines += ["# HELP vlm_proxy_request_seconds 请求延迟（秒）",
+                      "# TYPE vlm_proxy_request_seconds histogram"]
+            for (model, status), hist in sorted(self.latency.items(), key=str):
+                labels = _labels(model=model, status=status)
+                for bound, count in zip(LATENCY_BUCKETS, hist.buckets):
+                    lines.append(f'vlm_proxy_request_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'vlm_proxy_request_seconds_bucket{{{labels},le="+Inf"}} {hist.count}')
+                lines.append(f"vlm_proxy_request_seconds_sum{{{labels}}} {hist.total:.6f}")
+                lines.append(f"vlm_proxy_request_seconds_count{{{labels}}} {hist.count}")
+            lines += ["# HELP vlm_proxy_tokens_total 上游调用消耗的 tokens",
+                      "# TYPE vlm_proxy_tokens_total counter"]
+            for model, tokens in sorted(self.tokens.items(), key=str):
+                for direction, count in tokens.items():
+                    lines.append(f"vlm_proxy_tokens_total{{{_labels(model=model, direction=direction)}}} {count}")
+            lines += ["# HELP vlm_proxy_cost_usd_total 按 MODEL_PRICES 估算的费用（美元）",
+                      "# TYPE vlm_proxy_cost_usd_total counter"]
+            for model, cost in sorted(self.cost.items(), key=str):
+                lines.append(f"vlm_proxy_cost_usd_total{{{_labels(model=model)}}} {cost:.6f}")
+            lines += ["# HELP vlm_proxy_inflight 正在处理的请求数", "# TYPE vlm_proxy_inflight gauge",
+                      f"vlm_proxy_inflight {self.inflight}"]
+        return "\n".join(lines) + "\n"
+
+    def write_summary(self, path):
+        """写出逐文档汇总（JSON），并在日志中列出最慢的文档"""
+        summary = self.snapshot()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        slowest = sorted(summary["documents"], key=lambda d: d["slowest_request_seconds"], reverse=True)[:5]
+        for doc in slowest:
+            logging.info(f"{doc['document']}: {doc['requests']} 次请求，平均 {doc['avg_latency_seconds']}s，"
+                         f"最慢 {doc['slowest_request_seconds']}s，tokens {doc['prompt_tokens']}/"
+                         f"{doc['completion_tokens']}，约 ${doc['cost_usd']}")
+        logging.info(f"VLM 指标汇总已写入: {path}")
+        return summary
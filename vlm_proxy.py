@@ -0,0 +1,236 @@
+import http.server
+import json
+import logging
+import threading
+import time
+import traceback
+
+import tracing
+from page_dedup import request_engine_key, request_image_hashes
+from rate_limiter import RateLimitExceeded, estimate_tokens
+from vlm_cache import request_cache_key
+from vlm_metrics import ProxyMetrics
+
+DEFAULT_MODEL = "gemini-2.5-flash-preview-05-20"
+
+
+def build_http_client(max_connections: int = 8):
+    """创建与上游共享的连接池客户端（litellm 未安装时返回 None）"""
+    try:
+        from litellm.llms.custom_httpx.http_handler import HTTPHandler
+    except ImportError:
+        return None
+    return HTTPHandler(concurrent_limit=max_connections)
+
+
+def make_litellm_completion(max_connections: int = 8):
+    """返回通过 litellm 调用 Gemini 的上游函数，所有请求共享同一个连接池"""
+    import litellm
+    client = build_http_client(max_connections)
+
+    def completion(request_data: dict) -> dict:
+        model = request_data.get("model", DEFAULT_MODEL)
+        kwargs = dict(
+            model=f"gemini/{model}",
+            messages=request_data.get("messages", []),
+            temperature=request_data.get("temperature", 0.1),
+            max_tokens=request_data.get("max_tokens", 8192),
+        )
+        if client is not None:
+            kwargs["client"] = client
+        response = litellm.completion(**kwargs)
+        return {
+            "id": response.id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": response.choices[0].message.content
+                    },
+                    "finish_reason": response.choices[0].finish_reason or "stop"  # length 表示输出被截断
+                }
+            ],
+            "usage": response.usage.dict() if response.usage else {}
+        }
+
+    return completion
+
+
+class _ProxyHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+# 本地 OpenAI 兼容代理服务器（默认转发到 Gemini）
+class VLMProxyServer:
+    def __init__(self, host: str = "", port: int = 4000, max_inflight: int = 8, completion_fn=None, cache=None,
+                 page_scaler=None, page_index=None, scheduler=None, batcher=None, metrics=None):
+        """
+        host/port: 监听地址
+        max_inflight: 同时在途的上游请求上限
+        completion_fn: 上游调用函数，输入 OpenAI 格式请求体，返回 OpenAI 格式响应；默认使用 litellm 调用 Gemini
+        cache: 可选的 VLMResponseCache，命中时不再请求上游
+        page_scaler: 可选的 AdaptivePageScaler，按页面内容密度缩放图片后再转发
+        page_index: 可选的 PageDedupIndex，与已转换页面相同或相似（感知哈希）的页面直接复用结果
+        scheduler: 可选的 RateLimitScheduler，上游调用按 RPM/TPM 配额和自适应并发调度，被限流时按 Retry-After 重试
+        batcher: 可选的 PageBatcher，并发到达的单页请求合并成多页请求发给上游，再按页拆分返回
+        metrics: ProxyMetrics，默认新建；运行中可通过 GET /metrics（Prometheus）和 GET /stats（JSON）查看
+        """
+        self.host = host
+        self.port = port
+        self.max_inflight = max_inflight
+        self.completion_fn = completion_fn
+        self.cache = cache
+        self.page_scaler = page_scaler
+        self.page_index = page_index
+        self.scheduler = scheduler
+        self.batcher = batcher
+        self.metrics = metrics or ProxyMetrics()
+        self.is_running = False
+        self.server_thread = None
+        self.httpd = None
+
+    def _make_handler(self):
+        completion_fn = self.completion_fn
+        cache = self.cache
+        page_scaler = self.page_scaler
+        page_index = self.page_index
+        scheduler = self.scheduler
+        batcher = self.batcher
+        metrics = self.metrics
+        inflight = threading.BoundedSemaphore(self.max_inflight)
+
+        def upstream(request_data: dict) -> dict:
+            with inflight, tracing.span("proxy.completion", model=request_data.get("model")):
+                if scheduler is not None:
+                    return scheduler.call(completion_fn, request_data, tokens=estimate_tokens(request_data),
+                                          usage=lambda r: (r.get("usage") or {}).get("total_tokens", 0))
+                return completion_fn(request_data)
+
+        class CustomHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 支持 keep-alive
+            disable_nagle_algorithm = True  # keep-alive 下避免小包延迟确认
+
+            def _send_json(self, status: int, payload: dict, headers: dict = None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.prometheus_text().encode()
+                    self.send_response(200)
+                    self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                elif self.path == '/stats':
+                    self._send_json(200, metrics.snapshot())
+                else:
+                    self._send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                if self.path != '/v1/chat/completions':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                content_length = int(self.headers['Content-Length'])
+                post_data = self.rfile.read(content_length)
+                start = time.perf_counter()
+                metrics.request_started()
+                model, source, status, result = None, "upstream", 500, None
+                try:
+                    request_data = json.loads(post_data.decode('utf-8'))
+                    model = request_data.get("model")
+                    page_stat = None
+                    with tracing.span("proxy.request", model=request_data.get("model")) as attrs:
+                        if page_scaler is not None:
+                            with tracing.span("proxy.rescale"):
+                                request_data, page_stat = page_scaler.rescale(request_data)
+                            attrs.update(page_stat)
+                        key = request_cache_key(request_data) if cache is not None and cache.enabled else None
+                        result = cache.get(key) if key else None
+                        attrs["cache_hit"] = result is not None
+                        page_key = None
+                        if result is None and page_index is not None and page_index.enabled:
+                            with tracing.span("proxy.dedup_lookup"):
+                                hashes = request_image_hashes(request_data)
+                                if hashes is not None:
+                                    page_key = (request_engine_key(request_data), *hashes)
+                                    result = page_index.lookup(*page_key)
+                            attrs["dedup_hit"] = result is not None
+                        if result is not None:
+                            source = "cache" if attrs["cache_hit"] else "dedup"
+                        else:
+                            result = batcher.submit(request_data, upstream) if batcher is not None \
+                                else upstream(request_data)
+                            # 被截断的输出不缓存也不写入去重索引，以后的运行重新请求
+                            truncated = (result.get("choices") or [{}])[0].get("finish_reason") == "length"
+                            attrs["truncated"] = truncated
+                            if key and not truncated:
+                                cache.put(key, result)
+                            if page_key and not truncated:
+                                page_index.put(*page_key, result)
+                        attrs["usage"] = result.get("usage")
+                    if page_stat is not None:
+                        page_scaler.record(page_stat, result.get("usage"))
+                    status = 200
+                    self._send_json(200, result)
+                except RateLimitExceeded as e:
+                    status = 429
+                    retry_after = {"Retry-After": str(int(e.retry_after or 1))}
+                    self._send_json(429, {"error": str(e)}, retry_after)
+                except Exception as e:
+                    tb = traceback.format_exc()
+                    self._send_json(500, {"error": str(e), "traceback": tb})
+                finally:
+                    metrics.observe(model, status, time.perf_counter() - start,
+                                    result.get("usage") if status == 200 else None, source)
+
+            def log_message(self, format, *args):
+                pass
+
+        return CustomHandler
+
+    def start(self):
+        if self.completion_fn is None:
+            self.completion_fn = make_litellm_completion(self.max_inflight)
+        self.httpd = _ProxyHTTPServer((self.host, self.port), self._make_handler())
+        self.port = self.httpd.server_address[1]  # port=0 时取实际分配的端口
+        self.is_running = True
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.5}, daemon=True)
+        self.server_thread.start()
+        logging.info(f"API 服务器监听端口 {self.port}，最大并发上游请求数 {self.max_inflight}")
+
+    def stop(self):
+        self.is_running = False
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        if self.server_thread:
+            self.server_thread.join(timeout=5)
+        if self.cache is not None:
+            logging.info(f"VLM 缓存统计: {self.cache.stats()}")
+        if self.page_scaler is not None:
+            logging.info(f"自适应缩放统计: {self.page_scaler.stats()}")
+        if self.page_index is not None:
+            logging.info(f"页面去重统计: {self.page_index.stats()}")
+        if self.batcher is not None:
+            logging.info(f"多页合并统计: {self.batcher.stats()}")
+        if self.scheduler is not None:
+            self.scheduler.close()
+        logging.info("API 服务器已停止")
+
+
+GeminiAPIServer = VLMProxyServer  # 兼容旧名称
@@ -0,0 +1,238 @@
+"""
+监视目录：上游持续投放的 PDF 写完后几秒内即提交给常驻转换服务（conversion_daemon），不再定时重跑整个目录。
+Linux 上用 inotify（ctypes 直接调用 libc，无额外依赖），其他平台或 inotify 不可用时退回定时扫描。
+文件在 debounce 秒内大小和修改时间都不再变化才视为写完；转换服务队列满时文件留在待提交列表，等队列有空位再提交。
+
+用法：python conversion_daemon.py watch ./input --engine minerU_default
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import queue
+import select
+import struct
+import threading
+import time
+
+from page_selection import PAGE_SELECTION
+from run_manifest import RunManifest
+
+# inotify 事件掩码（linux/inotify.h）
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """inotify 监视单个目录，wait() 返回有变化的文件名集合；不可用时构造函数抛 OSError"""
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name or not hasattr(os, "O_NONBLOCK"):
+            raise OSError("inotify 不可用")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify 不可用")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | getattr(os, "O_CLOEXEC", 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch 失败: {directory}")
+        self.overflowed = False
+
+    def wait(self, timeout):
+        """等待最多 timeout 秒，返回有事件的文件名；事件队列溢出时 overflowed 置为 True，调用方应全量扫描"""
+        names = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return names
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += _EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """监视 input_dir 中的新增或修改文件，写完后提交给 ConversionDaemon 的 engine 引擎"""
+
+    def __init__(self, daemon, input_dir, engine, output_dir=None, profile=None, debounce: float = 1.0,
+                 poll_interval: float = 2.0, priority=None, suffixes=(".pdf",), use_inotify: bool = True):
+        """
+        debounce: 文件大小和修改时间保持不变的秒数，达到后才视为写完
+        poll_interval: 定时扫描间隔（inotify 模式下作为兜底的全量扫描间隔）
+        priority: 提交的任务优先级，None 时由转换服务按文件大小排序（小文件先转）
+        """
+        self.daemon = daemon
+        self.input_dir = os.path.abspath(input_dir)
+        self.engine = engine
+        self.output_dir = output_dir
+        self.profile = profile
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.priority = priority
+        self.suffixes = tuple(s.lower() for s in suffixes)
+        self.use_inotify = use_inotify
+        # 与批处理脚本一样按输入内容哈希判断是否已转换，重启后不重复处理；转换服务的引擎按 PAGE_SELECTION 试转，
+        # 页面选择记入配置，试转记录不会让之后的整篇转换被跳过
+        self.manifest = RunManifest(f"watch:{engine}", {"output_dir": output_dir, "profile": profile,
+                                                        "page_selection": PAGE_SELECTION})
+        self._candidates = {}  # 路径 -> (大小, mtime_ns, 最近一次变化的时间)
+        self._submitted = {}  # 路径 -> 已提交时的 (大小, mtime_ns)
+        self._ready = []  # 已写完但队列满、等待提交的路径
+        self._stop = threading.Event()
+        self._thread = None
+        self.counts = {"detected": 0, "submitted": 0, "done": 0, "failed": 0, "backpressure_waits": 0}
+        self.latencies = []  # 从提交到转换完成的秒数
+
+    def _scan(self):
+        try:
+            return [name for name in os.listdir(self.input_dir) if name.lower().endswith(self.suffixes)]
+        except FileNotFoundError:
+            return []
+
+    def _observe(self, names):
+        """记录文件的大小和修改时间，有变化时重新开始计时"""
+        now = time.monotonic()
+        for name in names:
+            path = os.path.join(self.input_dir, name)
+            if not name.lower().endswith(self.suffixes):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self._candidates.pop(path, None)
+                continue
+            signature = (st.st_size, st.st_mtime_ns)
+            if self._submitted.get(path) == signature or path in self._ready:
+                continue
+            previous = self._candidates.get(path)
+            if previous is None or previous[:2] != signature:
+                if previous is None:
+                    self.counts["detected"] += 1
+                self._candidates[path] = (*signature, now)
+
+    def _settled(self):
+        """返回已在 debounce 秒内没有变化的文件，重新 stat 确认"""
+        now = time.monotonic()
+        settled = []
+        for path, (size, mtime_ns, changed) in list(self._candidates.items()):
+            if now - changed < self.debounce:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self._candidates[path]
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns) or st.st_size == 0:
+                self._candidates[path] = (st.st_size, st.st_mtime_ns, now)
+                continue
+            del self._candidates[path]
+            settled.append(path)
+        return settled
+
+    def _submit_ready(self):
+        while self._ready:
+            path = self._ready[0]
+            try:
+                st = os.stat(path)
+                if self.manifest.is_done(path):
+                    logging.info(f"跳过已转换文件: {path}")
+                    self._submitted[path] = (st.st_size, st.st_mtime_ns)
+                else:
+                    self.manifest.start(path)  # 先记录，避免任务很快完成时被覆盖
+                    self._submitted[path] = (st.st_size, st.st_mtime_ns)  # 同理，完成回调据此判断转换期间是否被修改
+                    self.daemon.submit(path, self.engine, self.output_dir, self.profile, priority=self.priority,
+                                       callback=self._on_done)
+                    self.counts["submitted"] += 1
+            except queue.Full:
+                self._submitted.pop(path, None)
+                self.counts["backpressure_waits"] += 1
+                return  # 转换服务跟不上，等队列有空位再提交，保持文件在待提交列表
+            except (OSError, ValueError) as e:
+                logging.warning(f"提交失败 {path}: {e}")
+            self._ready.pop(0)
+
+    def _on_done(self, job):
+        seconds = job["finished_at"] - job["submitted_at"]
+        try:
+            st = os.stat(job["path"])
+            modified = (st.st_size, st.st_mtime_ns) != self._submitted.get(job["path"])
+        except OSError:
+            modified = True
+        if modified:  # 转换期间文件又被写入（包括大小不变的重写）或删除，结果不记入清单，新内容写完后会重新提交
+            logging.info(f"{os.path.basename(job['path'])} 在转换期间被修改，等待重新提交")
+            return
+        if job["status"] == "done":
+            self.counts["done"] += 1
+            self.latencies.append(seconds)
+            self.manifest.finish(job["path"], job["outputs"], seconds)
+            logging.info(f"{os.path.basename(job['path'])} 转换完成，从提交到输出 {seconds:.2f}s")
+        else:
+            self.counts["failed"] += 1
+            self.manifest.fail(job["path"], job["error"], seconds)  # 文件再次修改或服务重启后重试
+
+    def run(self):
+        watcher = None
+        if self.use_inotify:
+            try:
+                watcher = InotifyWatcher(self.input_dir)
+                logging.info(f"使用 inotify 监视 {self.input_dir}")
+            except (OSError, AttributeError) as e:
+                logging.info(f"inotify 不可用（{e}），改为每 {self.poll_interval}s 扫描 {self.input_dir}")
+        self._observe(self._scan())  # 启动时已有的文件
+        last_scan = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                timeout = min(self.poll_interval, self.debounce / 2) if self._candidates or self._ready \
+                    else self.poll_interval
+                if watcher is not None:
+                    self._observe(watcher.wait(timeout))
+                    if watcher.overflowed or time.monotonic() - last_scan >= self.poll_interval * 30:
+                        watcher.overflowed = False
+                        self._observe(self._scan())
+                        last_scan = time.monotonic()
+                else:
+                    self._stop.wait(timeout)
+                    self._observe(self._scan())
+                self._ready.extend(p for p in self._settled() if p not in self._ready)
+                self._submit_ready()
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def start(self):
+        os.makedirs(self.input_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self.run, name="folder-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        logging.info(f"监视统计: {self.stats()}")
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {**self.counts, "pending": len(self._candidates) + len(self._ready),
+                "p50_latency_seconds": round(latencies[len(latencies) // 2], 2) if latencies else None,
+                "max_latency_seconds": round(latencies[-1], 2) if latencies else None}